@@ -14,6 +14,11 @@ LEAN_WORKDIR = env('LEAN_WORKDIR', f'{WORKDIR}/app/libs/external_repository/repl
 ERROR_CASE_SAVE_PATH = env('ERROR_CASE_SAVE_PATH', '')  # default empty, which means not save error case
 
 MAX_STDOUT_ERROR_LENGTH = int(env('MAX_STDOUT_ERROR_LENGTH', 1000))
+# 1 means the output of a submission with expected_output is compared as it arrives,
+# and the submission is killed as soon as the output diverges (reason `wrong_answer`)
+STREAMING_OUTPUT_CHECK = int(env('STREAMING_OUTPUT_CHECK', 1))
+# max size of the stdout of a python/cpp submission. It is killed as soon as its stdout exceeds it (reason `output_limit_exceeded`)
+MAX_OUTPUT_SIZE = int(env('MAX_OUTPUT_SIZE', 64))  # default 64 MB
 
 # timeline:
 # |-----------------MAX_QUEUE_WAIT_TIME-------------------------------|
@@ -35,23 +40,117 @@ if LONG_BATCH_MAX_QUEUE_WAIT_TIME < 60 * 60 + MAX_PROCESS_TIME:
 
 MAX_MEMORY = int(env('MAX_MEMORY', 256))  # default 256 MB
 MAX_WORKERS = int(env('MAX_WORKERS', os.cpu_count())) or os.cpu_count()  # default os.cpu_count()
+# number of work items judged at the same time by each worker process. Above 1, a worker pops work items with
+# one async redis client and judges them in a thread per slot, so fewer worker processes (MAX_WORKERS) are needed.
+WORKER_SLOTS = max(int(env('WORKER_SLOTS', 1)), 1)
+# max number of work items a worker claims from the work queue at a time, which saves the redis round trips of
+# short submissions. It is adapted to the recent judge times, so the claimed work items wait about WORKER_PREFETCH_TIME
+# seconds at most in the worker, after which they are put back to the work queue. 1 disables it.
+WORKER_PREFETCH = max(int(env('WORKER_PREFETCH', 1)), 1)
+WORKER_PREFETCH_TIME = float(env('WORKER_PREFETCH_TIME', 1))
+if WORKER_PREFETCH_TIME >= MAX_QUEUE_WORK_LIFE_TIME:
+    raise ValueError('WORKER_PREFETCH_TIME must be smaller than MAX_QUEUE_WORK_LIFE_TIME')
+# 1 means a work item popped by a worker is leased: it is moved atomically to the in-flight set of the worker
+# until its result is pushed, and the worker managers put it back to the work queue when the lease expires
+# (e.g. the worker died), instead of losing it.
+RELIABLE_QUEUE = int(env('RELIABLE_QUEUE', 0))
+# seconds a lease lasts over the max time of its work item (its timeout plus 5 seconds)
+WORK_LEASE_GRACE = int(env('WORK_LEASE_GRACE', 5))
+# how often (in seconds) the worker manager checks for the expired leases
+WORK_LEASE_REAP_INTERVAL = int(env('WORK_LEASE_REAP_INTERVAL', 5))
 
 RUN_WORKERS = int(env('RUN_WORKERS', 0))  # default 0, which means run workers in a separate process
 
+# number of cgroup v2 slots created by each worker at startup. Submissions are moved into a slot with
+# cpu.max/memory.max set from cpu_core/memory_limit, instead of a `systemd-run --scope` per run.
+# 0 (default, or when cgroup v2 is not writable) means systemd-run is used.
+CGROUP_SLOTS = int(env('CGROUP_SLOTS', 0))
+# the cgroup the slots are created in, which must be delegated to the user running the workers.
+# Default is the cgroup of the worker manager, which is refused if it has other processes.
+CGROUP_ROOT = env('CGROUP_ROOT', '')
+
+# the RAM-backed directory where every worker creates its workspaces once at startup.
+# Submissions are prepared and run in a workspace, which is emptied after the run, instead of a new temporary directory.
+# Empty (or when it is not writable) means temporary directories are used.
+WORKSPACE_ROOT = env('WORKSPACE_ROOT', '/dev/shm/code-judge')
+# the directory of the local caches of a node (c++ binaries, runtime and artifacts), outside of the source tree
+CACHE_ROOT = env('CACHE_ROOT', '/tmp/code-judge')
+
 MAX_BATCH_CHUNK_SIZE = int(env('MAX_BATCH_CHUNK_SIZE', 2))  # 0 means no limit
 MAX_LONG_BATCH_CHUNK_SIZE = int(env('MAX_LONG_BATCH_CHUNK_SIZE', 100))
+# max number of lean submissions (with the same resource limits) in a batch
+# that are sent to a worker as a single work item and checked in one REPL session. 1 means no packing.
+LEAN_BATCH_SIZE = int(env('LEAN_BATCH_SIZE', 16))
 
 PYTHON_EXECUTOR_PATH = env('PYTHON_EXECUTOR_PATH', 'python3')
 CPP_COMPILER_PATH = env('CPP_COMPILER_PATH', 'g++')
 LEAN_COMPILER_PATH = env('LEAN_COMPILER_PATH', 'lake')
 
 PYTHON_EXECUTE_COMMAND = env('PYTHON_EXECUTE_COMMAND', f'{PYTHON_EXECUTOR_PATH} {{source}}')
+# 1 means python submissions are run in children forked from a warm interpreter (zygote) of each worker,
+# instead of starting a new interpreter with PYTHON_EXECUTE_COMMAND
+PYTHON_ZYGOTE = int(env('PYTHON_ZYGOTE', 0))
+# comma separated modules imported by the zygote in advance, e.g. 'numpy,sympy'
+PYTHON_ZYGOTE_PRELOAD = env('PYTHON_ZYGOTE_PRELOAD', '')
 CPP_COMPILE_COMMAND = env('CPP_COMPILE_COMMAND', f'{CPP_COMPILER_PATH} -O2 -o {{exe}} {{source}}')
 CPP_EXECUTE_COMMAND = env('CPP_EXECUTE_COMMAND', '{exe}')
+# the local cache of compiled c++ binaries shared by the workers of a node, keyed by everything the binary depends on
+CPP_BINARY_CACHE_PATH = env('CPP_BINARY_CACHE_PATH', f'{CACHE_ROOT}/cpp_binaries')
+# max size of the local cache in MB. Least recently used binaries are evicted. 0 means no cache.
+CPP_BINARY_CACHE_SIZE = int(env('CPP_BINARY_CACHE_SIZE', 1024))
+# an optional directory shared by all nodes (e.g. NFS), where binaries are published and looked up on a local miss
+CPP_BINARY_CACHE_SHARED_PATH = env('CPP_BINARY_CACHE_SHARED_PATH', '')
+# headers precompiled during registration with the flags of CPP_COMPILE_COMMAND.
+# `;` separates precompiled headers and `,` the headers in each, e.g. 'bits/stdc++.h;iostream,vector'. Empty means no PCH.
+CPP_PCH_HEADERS = env('CPP_PCH_HEADERS', 'bits/stdc++.h')
+CPP_PCH_PATH = env('CPP_PCH_PATH', f'{WORKDIR}/.state/cpp_pch')
+# where the resource limit runtime linked into every c++ binary is compiled once per compile command
+CPP_RUNTIME_PATH = env('CPP_RUNTIME_PATH', f'{CACHE_ROOT}/cpp_runtime')
+# number of compile workers per node. When > 0, workers hand c++ submissions which are not in the binary cache
+# to the compile workers, and run the compiled binaries when they are ready. 0 means workers compile themselves.
+CPP_COMPILE_WORKERS = int(env('CPP_COMPILE_WORKERS', 0))
+# max number of submissions waiting for the compile workers of a node. Workers compile themselves when it is full.
+CPP_COMPILE_QUEUE_SIZE = int(env('CPP_COMPILE_QUEUE_SIZE', 16))
+# where the compile workers put the binaries for the workers of the node
+CPP_ARTIFACT_PATH = env('CPP_ARTIFACT_PATH', f'{CACHE_ROOT}/cpp_artifacts')
+# c++ submissions with at least this number of test cases are compiled once,
+# and their test cases are spread over the idle workers of the node. 0 means no fan-out.
+CPP_FANOUT_MIN_CASES = int(env('CPP_FANOUT_MIN_CASES', 16))
 LEAN_COMPILER_COMMAND = env(
     'LEAN_COMPILER_COMMAND',
     'bash -lc "cd ' + LEAN_WORKDIR + ' && (echo $1; echo) | ' + LEAN_COMPILER_PATH + ' exe repl" _ {json}'
 )
+# the command to start a long-lived REPL, which reads commands from stdin
+LEAN_REPL_COMMAND = env(
+    'LEAN_REPL_COMMAND',
+    'bash -lc "cd ' + LEAN_WORKDIR + ' && ' + LEAN_COMPILER_PATH + ' exe repl"'
+)
+# number of warm REPL processes (with the header imported) kept by each worker
+# 0 means no pool, and every submission starts a new REPL with LEAN_COMPILER_COMMAND
+LEAN_REPL_POOL_SIZE = int(env('LEAN_REPL_POOL_SIZE', 1))
+# a pooled REPL is restarted after this number of submissions (0 means no limit)
+LEAN_REPL_MAX_USES = int(env('LEAN_REPL_MAX_USES', 100))
+# a pooled REPL is restarted when its memory usage exceeds this value in MB (0 means no limit)
+LEAN_REPL_MAX_MEMORY = int(env('LEAN_REPL_MAX_MEMORY', 16 * 1024))  # default 16 GB
+# max time to start a REPL and import the header
+LEAN_REPL_START_TIMEOUT = int(env('LEAN_REPL_START_TIMEOUT', 600))  # default 10 minutes
+# the REPL binary and the environment (LEAN_PATH, etc.) it needs, resolved with lake during bootstrap.
+# REPLs are executed directly instead of with LEAN_REPL_COMMAND when it exists.
+LEAN_REPL_RUNTIME_PATH = env('LEAN_REPL_RUNTIME_PATH', f'{WORKDIR}/.state/lean_repl_runtime.json')
+# the environment of the header pickled by the REPL during bootstrap.
+# REPLs load it instead of elaborating the header when it exists.
+LEAN_HEADER_PICKLE_PATH = env('LEAN_HEADER_PICKLE_PATH', f'{WORKDIR}/.state/lean_header.olean')
+# the imports of a lean submission without the `imports` option.
+# '' means PRE_TEMPLATE (import Mathlib), 'auto' infers the modules a submission needs with the import index.
+LEAN_DEFAULT_IMPORTS = env('LEAN_DEFAULT_IMPORTS', '')
+# max number of distinct import sets with warm REPLs kept by each worker
+LEAN_REPL_MAX_HEADERS = int(env('LEAN_REPL_MAX_HEADERS', 4))
+# max number of environments after the leading commands of submissions cached in each REPL,
+# so submissions sharing definitions and lemmas only elaborate the rest. 0 means no cache.
+LEAN_ENV_CACHE_SIZE = int(env('LEAN_ENV_CACHE_SIZE', 64))
+# the identifier -> module index built by bootstrap from the sources in LEAN_IMPORT_INDEX_SOURCE
+LEAN_IMPORT_INDEX_PATH = env('LEAN_IMPORT_INDEX_PATH', f'{WORKDIR}/.state/lean_import_index.json')
+LEAN_IMPORT_INDEX_SOURCE = env('LEAN_IMPORT_INDEX_SOURCE', f'{LEAN_WORKDIR}/.lake/packages/mathlib')
 
 
 
@@ -64,6 +163,10 @@ REDIS_RESULT_PREFIX = env('REDIS_RESULT_QUEUE_PREFIX', f'{REDIS_KEY_PREFIX}:{ver
 REDIS_RESULT_EXPIRE = int(env('REDIS_RESULT_EXPIRE', 60))  # default 1 minute
 REDIS_RESULT_LONG_BATCH_EXPIRE = int(env('REDIS_RESULT_LONG_BATCH_EXPIRE', LONG_BATCH_MAX_QUEUE_WAIT_TIME))  # default 1 hour
 REDIS_WORK_QUEUE_NAME = env('WORK_QUEUE_NAME', f'{REDIS_KEY_PREFIX}:{version}:work-queue')
+# 'zset': the work queue is a sorted set of the work ids ordered by the submission time, whose payloads are kept in a hash.
+# 'stream': the work queue is a stream with a consumer group. An entry read by a worker stays pending until its result
+# is pushed, and the entries pending over MAX_PROCESS_TIME + WORK_LEASE_GRACE (e.g. of dead workers) are claimed by other workers.
+REDIS_WORK_QUEUE_BACKEND = env('REDIS_WORK_QUEUE_BACKEND', 'zset')
 
 REDIS_WORK_QUEUE_BLOCK_TIMEOUT = int(env('REDIS_WORK_QUEUE_BLOCK_TIMEOUT', 30))  # default 30 seconds
 REDIS_WORKER_ID_PREFIX = env('REDIS_WORKER_ID_PREFIX', f'{REDIS_KEY_PREFIX}:{version}:work-ids:')
@@ -3,6 +3,8 @@ from time import time
 import asyncio
 import uuid
 
+from pydantic import ValidationError
+
 import app.config as app_config
 from app.libs.redis_queue import RedisQueue
 from app.libs.utils import chunkify
@@ -24,24 +26,81 @@ def _to_result(submission: Submission, start_time: float, result_json: tuple[str
         return SubmissionResult(sub_id=submission.sub_id, run_success=False, success=False, cost=time() - start_time, reason=ResultReason.QUEUE_TIMEOUT)
     else:
         result = SubmissionResult.model_validate_json(result_json[1])
-        if not result.run_success and result.cost >= submission.timeout:
+        # the cost of test cases is the sum, and their timeouts are reported by the worker
+        if not result.run_success and result.test_results is None and result.cost >= submission.timeout:
             result.reason = ResultReason.WORKER_TIMEOUT
         return result
 
 
+def _to_results(submission: Submission | BatchSubmission, start_time: float, result_json: tuple[str, bytes] | None) -> list[SubmissionResult]:
+    """Get the results of all submissions in a work item"""
+    if not isinstance(submission, BatchSubmission):
+        return [_to_result(submission, start_time, result_json)]
+    if result_json is None:
+        return [_to_result(sub, start_time, None) for sub in submission.submissions]
+    try:
+        results = BatchSubmissionResult.model_validate_json(result_json[1]).results
+    except ValidationError:
+        # the worker failed before judging the batch, and returned a single result for all submissions
+        result = SubmissionResult.model_validate_json(result_json[1])
+        results = [result.model_copy(update={'sub_id': sub.sub_id}) for sub in submission.submissions]
+    for sub, result in zip(submission.submissions, results):
+        if not result.run_success and result.cost >= sub.timeout:
+            result.reason = ResultReason.WORKER_TIMEOUT
+    return results
+
+
+def _pack_submissions(subs: list[Submission]) -> list[tuple[list[int], Submission | BatchSubmission]]:
+    """
+    Pack lean submissions with the same resource limits and options into batches of at most LEAN_BATCH_SIZE,
+    so they are checked by one worker in one REPL session.
+    Return the work items with the indices of their submissions in `subs`.
+    """
+    items = []
+    lean_groups: dict[tuple, list[int]] = {}
+    for idx, sub in enumerate(subs):
+        if sub.type != 'lean' or app_config.LEAN_BATCH_SIZE <= 1:
+            items.append(([idx], sub))
+            continue
+        key = (sub.timeout, sub.memory_limit, sub.cpu_core, tuple(sorted((sub.options or {}).items())))
+        group = lean_groups.setdefault(key, [])
+        group.append(idx)
+        if len(group) == app_config.LEAN_BATCH_SIZE:
+            items.append((group, BatchSubmission(submissions=[subs[i] for i in group])))
+            lean_groups[key] = []
+    for group in lean_groups.values():
+        if len(group) == 1:
+            items.append((group, subs[group[0]]))
+        elif group:
+            items.append((group, BatchSubmission(submissions=[subs[i] for i in group])))
+    return items
+
+
+async def _discard(redis_queue: RedisQueue, work_ids: list[str]):
+    """
+    Drop the work items of the timed-out submissions with their payloads, which are left if they are not judged yet
+    or their worker died. The entries of a stream work queue are dropped by the workers past their lifetime.
+    """
+    if work_ids and app_config.REDIS_WORK_QUEUE_BACKEND == 'zset':
+        await redis_queue.wqueue.discard(app_config.REDIS_WORK_QUEUE_NAME, *work_ids)
+
+
 async def judge(redis_queue: RedisQueue, submission: Submission):
     start_time = time()
     try:
         payload = WorkPayload(submission=submission)
         payload_json = payload.model_dump_json()
-        await redis_queue.pqueue.push(app_config.REDIS_WORK_QUEUE_NAME, {payload_json: time()})
+        # the work queue only holds the work id, and the payload is stored apart
+        await redis_queue.wqueue.push(app_config.REDIS_WORK_QUEUE_NAME, {payload.work_id: time()}, {payload.work_id: payload_json})
         result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{payload.work_id}'
         # align with the computation of MAX_QUEUE_WAIT_TIME in config.py: MAX_QUEUE_WAIT_TIME = MAX_EXECUTION_TIME + 5 + MAX_QUEUE_WORK_LIFE_TIME
-        submission_wait_time = submission.timeout + 5 + app_config.MAX_QUEUE_WORK_LIFE_TIME
+        submission_wait_time = submission.total_timeout + 5 + app_config.MAX_QUEUE_WORK_LIFE_TIME
         max_wait_time = submission_wait_time  if submission_wait_time  > app_config.MAX_QUEUE_WAIT_TIME else app_config.MAX_QUEUE_WAIT_TIME
        
         result_json = await redis_queue.queue.block_pop(result_queue_name, timeout=max_wait_time)
         await redis_queue.delete(result_queue_name)
+        if result_json is None:
+            await _discard(redis_queue, [payload.work_id])
         return _to_result(submission, start_time, result_json)
     except Exception:
         logger.exception(f'Failed to judge submission {submission.sub_id}')
@@ -52,8 +111,9 @@ async def _judge_batch_impl(redis_queue: RedisQueue, subs: list[Submission], lon
     start_time = time()
     # Provide the max_wait_time for the batch processing
     max_wait_time = app_config.LONG_BATCH_MAX_QUEUE_WAIT_TIME if long_batch else app_config.MAX_QUEUE_WAIT_TIME
-    for sub in subs:
-        sub_wait_time = sub.timeout + 5 + app_config.MAX_QUEUE_WORK_LIFE_TIME
+    work_items = _pack_submissions(subs)
+    for _, item in work_items:
+        sub_wait_time = item.total_timeout + 5 + app_config.MAX_QUEUE_WORK_LIFE_TIME
         if sub_wait_time > max_wait_time:
             max_wait_time = sub_wait_time
 
@@ -61,12 +121,12 @@ async def _judge_batch_impl(redis_queue: RedisQueue, subs: list[Submission], lon
         if long_batch else app_config.MAX_BATCH_CHUNK_SIZE
     # use a hash tag to make sure all payloads are in the same slot in redis cluster
     hash_tag = '{' + str(uuid.uuid4()) + '}'
-    sub_chunks = chunkify(subs, batch_chunk_size)
+    sub_chunks = chunkify([item for _, item in work_items], batch_chunk_size)
 
     async def _submit(payloads: list[WorkPayload]):
-        # payload.work_id is different, so we can safely use dict
-        payload_jsons = {payload.model_dump_json(): payload.timestamp for payload in payloads}
-        await redis_queue.pqueue.push(app_config.REDIS_WORK_QUEUE_NAME, payload_jsons)
+        work_ids = {payload.work_id: payload.timestamp for payload in payloads}
+        payload_jsons = {payload.work_id: payload.model_dump_json() for payload in payloads}
+        await redis_queue.wqueue.push(app_config.REDIS_WORK_QUEUE_NAME, work_ids, payload_jsons)
 
     async def _sync_pop(queue_names: list[str]):
         step_results = await redis_queue.queue.pop_multi(*queue_names)
@@ -106,7 +166,7 @@ async def _judge_batch_impl(redis_queue: RedisQueue, subs: list[Submission], lon
             if not name_results: # if no result, check if timeout
                 if start_working_time == 0:
                     # the queue is ordered by timestamp
-                    next_payload_info = await redis_queue.pqueue.peak(app_config.REDIS_WORK_QUEUE_NAME)
+                    next_payload_info = await redis_queue.wqueue.peak(app_config.REDIS_WORK_QUEUE_NAME)
                     if not next_payload_info:
                         start_working_time = time()
                     else:
@@ -131,7 +191,7 @@ async def _judge_batch_impl(redis_queue: RedisQueue, subs: list[Submission], lon
             for name_result in name_results:
                 result_queue_name, _ = name_result
                 payload = result_queue_names[result_queue_name]
-                results[result_queue_name] = _to_result(payload.submission, start_time, name_result)
+                results[result_queue_name] = _to_results(payload.submission, start_time, name_result)
                 left_result_queue_names.remove(result_queue_name)
 
             left_time = max_chunk_wait_time - int(time() - result_start_time)
@@ -140,9 +200,10 @@ async def _judge_batch_impl(redis_queue: RedisQueue, subs: list[Submission], lon
 
         # fill non-ready work as timeout
         for result_queue_name in left_result_queue_names:
-            results[result_queue_name] = _to_result(result_queue_names[result_queue_name].submission, start_time, None)
+            results[result_queue_name] = _to_results(result_queue_names[result_queue_name].submission, start_time, None)
 
         await redis_queue.delete(*result_queue_names)
+        await _discard(redis_queue, [result_queue_names[name].work_id for name in left_result_queue_names])
         return [results[result_queue_name] for result_queue_name in result_queue_names]
 
     # submit all submissions to the queue
@@ -155,13 +216,19 @@ async def _judge_batch_impl(redis_queue: RedisQueue, subs: list[Submission], lon
         payload_chunks.append(payload_chunk)
         await _submit(payload_chunk)
 
-    results = []
+    item_results = []
     wait_start_time = time()
     for chunk in payload_chunks:
         # get all results from the queue
         left_time = max_wait_time - int(time() - wait_start_time)
         chunk_results = await _get_result(chunk, left_time)
-        results.extend(chunk_results)
+        item_results.extend(chunk_results)
+
+    # unpack the results of the work items to the order of the submissions
+    results = [None] * len(subs)
+    for (indices, _), item_result in zip(work_items, item_results):
+        for idx, result in zip(indices, item_result):
+            results[idx] = result
     return results
 
 
@@ -0,0 +1,169 @@
+import logging
+import os
+import time
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+CGROUP_FS = '/sys/fs/cgroup'
+# the period of cpu.max in microseconds
+CPU_PERIOD = 100000
+_CONTROLLERS = ('cpu', 'memory')
+
+
+class CgroupError(Exception):
+    pass
+
+
+def _write(path: Path, value: str):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def current_cgroup() -> Path:
+    """The cgroup v2 directory of the current process"""
+    with open('/proc/self/cgroup') as f:
+        for line in f:
+            if line.startswith('0::'):
+                return Path(CGROUP_FS) / line[3:].strip().lstrip('/')
+    raise CgroupError('cgroup v2 is not available')
+
+
+def prepare_cgroup_root(root: str | None = None) -> Path:
+    """
+    Make `root` (default: the cgroup of the current process) a cgroup whose children can have cpu/memory limits.
+    A cgroup with controllers enabled for its children can't have processes itself,
+    so the current process is moved to the leaf `manager`.
+    The cgroup is refused if it has other processes (e.g. a systemd scope or a container shared with other programs),
+    which are never moved.
+    """
+    try:
+        root = Path(root) if root else current_cgroup()
+        controllers = (root / 'cgroup.controllers').read_text().split()
+        missing = [c for c in _CONTROLLERS if c not in controllers]
+        if missing:
+            raise CgroupError(f'cgroup controllers {missing} are not available in {root}')
+        enabled = (root / 'cgroup.subtree_control').read_text().split()
+        if all(c in enabled for c in _CONTROLLERS):
+            return root
+        pids = (root / 'cgroup.procs').read_text().split()
+        if others := [pid for pid in pids if pid != str(os.getpid())]:
+            raise CgroupError(f'cgroup {root} has other processes {others[:10]}. Use a cgroup delegated to the workers.')
+        manager = root / 'manager'
+        manager.mkdir(exist_ok=True)
+        if pids:
+            _write(manager / 'cgroup.procs', str(os.getpid()))
+        _write(root / 'cgroup.subtree_control', ' '.join(f'+{c}' for c in _CONTROLLERS))
+    except OSError as e:
+        raise CgroupError(f'Failed to prepare cgroup {root or "of the current process"}: {e}')
+    return root
+
+
+class CgroupSlot:
+    """
+    A leaf cgroup created once and reused for one command at a time.
+    The command moves itself into the slot right before exec by writing to `procs` (see exec_limits.py),
+    instead of creating a transient unit per run.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        try:
+            self.path.mkdir(exist_ok=True)
+        except OSError as e:
+            raise CgroupError(f'Failed to create cgroup {path}: {e}')
+        self.procs = str(self.path / 'cgroup.procs')
+        # whether memory.peak is reset by `configure`, otherwise it is the peak of all commands run in the slot
+        self._peak_reset = False
+
+    def configure(self, cpu_core: float | None = None, memory_limit: int | None = None):
+        """Set the limits (memory_limit in bytes) for the next command, and reset the usage"""
+        self.kill()
+        quota = f'{int(round(cpu_core * CPU_PERIOD))} {CPU_PERIOD}' if cpu_core else f'max {CPU_PERIOD}'
+        _write(self.path / 'cpu.max', quota)
+        _write(self.path / 'memory.max', str(memory_limit) if memory_limit else 'max')
+        try:
+            _write(self.path / 'memory.swap.max', '0' if memory_limit else 'max')
+        except FileNotFoundError:
+            pass  # no swap accounting
+        try:
+            # supported since linux 6.12
+            _write(self.path / 'memory.peak', 'reset')
+            self._peak_reset = True
+        except OSError:
+            self._peak_reset = False
+
+    def stats(self) -> dict[str, int]:
+        """The cpu usage (in microseconds) and memory peak (in bytes) of the slot"""
+        stats = {}
+        try:
+            for line in (self.path / 'cpu.stat').read_text().splitlines():
+                key, value = line.split()
+                if key in ('usage_usec', 'user_usec', 'system_usec'):
+                    stats[key] = int(value)
+            stats['memory_peak'] = int((self.path / 'memory.peak').read_text())
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    def usage(self, start: dict[str, int]) -> dict[str, float | int]:
+        """
+        The user/sys cpu time (in seconds) and memory peak (in bytes) of the slot
+        since `start` (the `stats` before the command), as far as they are available.
+        """
+        stats = self.stats()
+        usage = {}
+        if 'user_usec' in stats and 'user_usec' in start:
+            usage['user_time'] = (stats['user_usec'] - start['user_usec']) / 1e6
+            usage['sys_time'] = (stats['system_usec'] - start['system_usec']) / 1e6
+        if 'memory_peak' in stats and self._peak_reset:
+            usage['memory_peak'] = stats['memory_peak']
+        return usage
+
+    def kill(self):
+        """Kill all processes in the slot, including the ones escaped from the process group"""
+        try:
+            _write(self.path / 'cgroup.kill', '1')
+        except OSError:
+            pass  # not supported before linux 5.14
+
+    def remove(self):
+        self.kill()
+        for _ in range(10):
+            try:
+                self.path.rmdir()
+                return
+            except FileNotFoundError:
+                return
+            except OSError:
+                # the killed processes may not have exited yet
+                time.sleep(0.1)
+        logger.warning(f'Failed to remove cgroup {self.path}')
+
+
+class CgroupSlotPool:
+    """The slots `<root>/<name>-<i>` of a worker, created once at startup"""
+    def __init__(self, root: Path, name: str, size: int):
+        self.root = Path(root)
+        self.name = name
+        self.slots = [CgroupSlot(self.root / f'{name}-{i}') for i in range(size)]
+        self._idle = list(self.slots)
+
+    def acquire(self) -> CgroupSlot | None:
+        """Get a free slot, or None if all slots are in use"""
+        return self._idle.pop() if self._idle else None
+
+    def release(self, slot: CgroupSlot):
+        slot.kill()
+        self._idle.append(slot)
+
+    def close(self):
+        for slot in self.slots:
+            slot.remove()
+
+
+def remove_slots(root: Path, name: str):
+    """Remove the slots left by a dead worker"""
+    for path in Path(root).glob(f'{name}-*'):
+        CgroupSlot(path).remove()
@@ -0,0 +1,109 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(**parts) -> str:
+    """The content address of a binary built from `parts`"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False).encode()
+    return hashlib.sha256(payload).hexdigest()
+
+
+class BinaryCache:
+    """
+    A content-addressed cache of compiled executables in a local directory shared by the workers of a node,
+    evicted by least recent use when it grows over `max_size` bytes.
+    With `shared_path` (e.g. a shared filesystem), binaries are also published there for other nodes,
+    and a local miss is looked up there before compiling.
+    """
+    def __init__(self, path: str, max_size: int, shared_path: str | None = None):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.shared_path = Path(shared_path) if shared_path else None
+        self.path.mkdir(parents=True, exist_ok=True)
+        if self.shared_path is not None:
+            self.shared_path.mkdir(parents=True, exist_ok=True)
+
+    def _install(self, src: Path, dest: Path):
+        """Copy `src` to `dest` atomically, so readers never see a partial binary"""
+        # a unique name, as the same binary can be installed by the threads of a worker (e.g. AsyncWorker) at once
+        fd, tmp = tempfile.mkstemp(prefix=f'.{dest.name}.', suffix='.tmp', dir=dest.parent)
+        os.close(fd)
+        tmp = Path(tmp)
+        try:
+            shutil.copy2(src, tmp)
+            os.replace(tmp, dest)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def has(self, key: str) -> bool:
+        """Whether `key` is in the local cache"""
+        return (self.path / key).exists()
+
+    def get(self, key: str, dest: str) -> bool:
+        """Copy the cached binary of `key` to `dest`. Return False if it is not cached."""
+        local = self.path / key
+        try:
+            shutil.copy2(local, dest)
+            # the mtime is the last use for LRU
+            os.utime(local)
+            return True
+        except FileNotFoundError:
+            pass
+        if self.shared_path is None:
+            return False
+        try:
+            self._install(self.shared_path / key, local)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            logger.exception(f'Failed to fetch binary {key} from {self.shared_path}')
+            return False
+        self._evict()
+        shutil.copy2(local, dest)
+        return True
+
+    def put(self, key: str, src: str):
+        try:
+            self._install(Path(src), self.path / key)
+            self._evict()
+            if self.shared_path is not None and not (self.shared_path / key).exists():
+                self._install(Path(src), self.shared_path / key)
+        except OSError:
+            # a cache failure shouldn't fail the submission
+            logger.exception(f'Failed to cache binary {key}')
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # evicted by another worker
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+@functools.cache
+def get_binary_cache(path: str, max_size: int, shared_path: str | None = None) -> BinaryCache:
+    return BinaryCache(path, max_size, shared_path)
@@ -1,21 +1,40 @@
 from contextlib import contextmanager
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
 import tempfile
 import shlex
 from typing import Any, Generator
+from app.libs.cgroup import CgroupSlot
+from app.libs.workspace import Workspace
+from app.libs.executors.binary_cache import BinaryCache, cache_key
+from app.libs.executors.cpp_pch import compile_args, insert_before_source, profile_dir, select_pch
 from app.libs.executors.executor import (
     COMPILE_ERROR_EXIT_CODE, TIMEOUT_EXIT_CODE,
     ProcessExecuteResult, ScriptExecutor, CompileError
 )
+from app.model import CompileArtifact
 
 
-RESOURCE_LIMIT_TEMPLATE = """
+logger = logging.getLogger(__name__)
+
+
+TIMEOUT_ENV = 'CODE_JUDGE_TIMEOUT'
+MEMORY_LIMIT_ENV = 'CODE_JUDGE_MEMORY_LIMIT'
+
+# the limits are read from the environment when the binary starts,
+# so the binary doesn't depend on them, and the runtime is compiled once (see get_resource_limit_object)
+RESOURCE_LIMIT_SOURCE = f"""
 #include <sys/resource.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <unistd.h>
 #include <signal.h>
 
-static void handler(int sig) {{
+static void _exec_timeout_handler(int sig) {{
     printf("Suicide from timeout.\\n");
     fflush(stdout);
     killpg(0, SIGKILL);
@@ -23,69 +42,186 @@ static void handler(int sig) {{
     _exit({TIMEOUT_EXIT_CODE});
 }}
 
-class ResourceLimit {{
-public:
-    ResourceLimit(int timeout, int memory_limit) {{
-        struct rlimit rlim;
-        if (timeout > 0) {{
-            getrlimit(RLIMIT_CPU, &rlim);
-            rlim.rlim_cur = timeout;
-            setrlimit(RLIMIT_CPU, &rlim);
-        }}
-        if (memory_limit > 0) {{
-            getrlimit(RLIMIT_AS, &rlim);
-            rlim.rlim_cur = memory_limit;
-            setrlimit(RLIMIT_AS, &rlim);
-        }}
-        getrlimit(RLIMIT_CORE, &rlim);
-        rlim.rlim_cur = 0;
-        setrlimit(RLIMIT_CORE, &rlim);
-
-        alarm(timeout);
-        signal(SIGALRM, handler);
+// runs before the static initializers of the submission
+__attribute__((constructor(101))) static void _exec_resource_limit() {{
+    const char *value = getenv("{TIMEOUT_ENV}");
+    unsigned int timeout = value ? strtoul(value, NULL, 10) : 0;
+    value = getenv("{MEMORY_LIMIT_ENV}");
+    rlim_t memory_limit = value ? strtoull(value, NULL, 10) : 0;
+    struct rlimit rlim;
+    if (timeout > 0) {{
+        getrlimit(RLIMIT_CPU, &rlim);
+        rlim.rlim_cur = timeout;
+        setrlimit(RLIMIT_CPU, &rlim);
     }}
-}};
+    if (memory_limit > 0) {{
+        getrlimit(RLIMIT_AS, &rlim);
+        rlim.rlim_cur = memory_limit;
+        setrlimit(RLIMIT_AS, &rlim);
+    }}
+    getrlimit(RLIMIT_CORE, &rlim);
+    rlim.rlim_cur = 0;
+    setrlimit(RLIMIT_CORE, &rlim);
 
-ResourceLimit _exec_resource_limit = ResourceLimit({timeout}, {memory_limit});
+    alarm(timeout);
+    signal(SIGALRM, _exec_timeout_handler);
+}}
 """.strip()
+RESOURCE_LIMIT_VERSION = hashlib.sha256(RESOURCE_LIMIT_SOURCE.encode()).hexdigest()[:16]
+
+
+@functools.cache
+def get_resource_limit_object(root: str, compiler_cl: str) -> str | None:
+    """
+    Compile RESOURCE_LIMIT_SOURCE once per compile command to an object linked into every binary.
+    Return None if it can't be compiled, and the source is included into the submission instead.
+    """
+    directory = profile_dir(root, compiler_cl)
+    obj_path = directory / f'resource_limit-{RESOURCE_LIMIT_VERSION}.o'
+    if obj_path.exists():
+        return str(obj_path)
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=directory) as tmp_path:
+            source_path = f'{tmp_path}/resource_limit.cpp'
+            tmp_obj_path = f'{tmp_path}/resource_limit.o'
+            with open(source_path, 'w') as f:
+                f.write(RESOURCE_LIMIT_SOURCE)
+            args = insert_before_source(compile_args(compiler_cl, source_path, tmp_obj_path, tmp_path), source_path, ['-c'])
+            completed = subprocess.run(args, cwd=tmp_path, capture_output=True)
+            if completed.returncode != 0:
+                logger.error(f'Failed to compile the resource limit runtime: {completed.stderr.decode(errors="replace")}')
+                return None
+            os.replace(tmp_obj_path, obj_path)
+    except OSError:
+        logger.exception('Failed to compile the resource limit runtime')
+        return None
+    return str(obj_path)
 
 
 class CppExecutor(ScriptExecutor):
-    def __init__(self, compiler_cl: str, run_cl:str, timeout: int = None, memory_limit: int = None, cpu_core: int = None):
+    def __init__(self, compiler_cl: str, run_cl:str, timeout: int = None, memory_limit: int = None, cpu_core: int = None,
+            cgroup_slot: CgroupSlot | None = None, binary_cache: BinaryCache | None = None,
+            options: dict[str, str] | None = None, pch: list[tuple[frozenset[str], str]] | None = None,
+            resource_limit_object: str | None = None, artifact: CompileArtifact | None = None,
+            output_limit: int | None = None, workspace: Workspace | None = None):
         self.compiler_cl = compiler_cl
         self.run_cl = run_cl
         self.timeout = timeout
         self.memory_limit = memory_limit
         self.cpu_core = cpu_core
+        self.cgroup_slot = cgroup_slot
+        # when set, a submission compiled before skips the compilation
+        self.binary_cache = binary_cache
+        self.options = options
+        # the precompiled headers of compiler_cl, see cpp_pch.load_pch
+        self.pch = pch
+        # the prebuilt RESOURCE_LIMIT_SOURCE linked into the binary, see get_resource_limit_object
+        self.resource_limit_object = resource_limit_object
+        # when set, the binary compiled by the compile stage is run instead of compiling the script
+        self.artifact = artifact
+        if output_limit is not None:
+            self.output_limit = output_limit
+        self.workspace = workspace
+        self._cache_stats = None
+        self._compiling = False
 
-    def setup_command(self, tmp_path: str, script: str) -> Generator[list[str], ProcessExecuteResult, None]:
+    def confine(self, step: int) -> bool:
+        # the compiler is not limited by the resource limits of the submission
+        return not self._compiling
+
+    def compare_output(self, step: int) -> bool:
+        return not self._compiling
+
+    def command_env(self, step: int) -> dict[str, str] | None:
+        if self._compiling:
+            return None
+        # read by RESOURCE_LIMIT_SOURCE in the binary
+        return {
+            **os.environ,
+            TIMEOUT_ENV: str(self.timeout or 0),
+            MEMORY_LIMIT_ENV: str(self.memory_limit or 0),
+        }
+
+    def binary_key(self, script: str) -> str | None:
+        """The key of the binary of `script` in the binary cache, None without a binary cache"""
+        if not self.binary_cache:
+            return None
+        # everything the binary depends on
+        return cache_key(
+            solution=script,
+            compiler_cl=self.compiler_cl,
+            resource_limit=RESOURCE_LIMIT_VERSION,
+            options=self.options or {},
+        )
+
+    def _compile_command(self, tmp_path: str, script: str, exec_path: str) -> list[str]:
         source_path = f"{tmp_path}/source.cpp"
-        resource_limit_path = f"{tmp_path}/resource_limit.h"
-        exec_path = f"{tmp_path}/run"
-        with open(resource_limit_path, "w") as f:
-            f.write(RESOURCE_LIMIT_TEMPLATE.format(
-                timeout=self.timeout or 0,
-                memory_limit=self.memory_limit or 0,
-                TIMEOUT_EXIT_CODE=TIMEOUT_EXIT_CODE)
-            )
         with open(source_path, "w") as f:
-            f.write('#include "resource_limit.h"\n')
+            if not self.resource_limit_object:
+                with open(f"{tmp_path}/resource_limit.h", "w") as h:
+                    h.write(RESOURCE_LIMIT_SOURCE)
+                f.write('#include "resource_limit.h"\n')
             f.write(script)
-        result = yield shlex.split(
-                self.compiler_cl.format(
-                    source=shlex.quote(source_path),
-                    exe=shlex.quote(exec_path),
-                    workdir=shlex.quote(str(tmp_path))
-            ))
-        if not result.success:
-            raise CompileError(result.stderr)
+        args = compile_args(self.compiler_cl, source_path, exec_path, str(tmp_path))
+        if self.resource_limit_object:
+            args = insert_before_source(args, source_path, [self.resource_limit_object])
+        pch_header = select_pch(script, self.pch)
+        if pch_header:
+            # gcc uses `<header>.gch` instead of parsing the header when it is included first
+            args = insert_before_source(args, source_path, ['-include', pch_header])
+        return args
+
+    def setup_command(self, tmp_path: str, script: str) -> Generator[list[str], ProcessExecuteResult, None]:
+        exec_path = f"{tmp_path}/run"
+        key = self.binary_key(script)
+        if self.artifact:
+            # compiled by the compile stage
+            exec_path = self.artifact.path
+            self._cache_stats = self.artifact.cache
+        elif key and self.binary_cache.get(key, exec_path):
+            self._cache_stats = {'hits': 1, 'misses': 0}
+        else:
+            self._compiling = True
+            result = yield self._compile_command(tmp_path, script, exec_path)
+            self._compiling = False
+            if not result.success:
+                raise CompileError(result.stderr)
+            if key:
+                self._cache_stats = {'hits': 0, 'misses': 1}
+                self.binary_cache.put(key, exec_path)
         yield shlex.split(self.run_cl.format(
             exe=shlex.quote(exec_path),
             workdir=shlex.quote(str(tmp_path))
         ))
 
-    def execute_script(self, script, stdin=None, timeout=None):
+    def compile(self, script: str, artifact_path: str, timeout: float | None = None) -> CompileArtifact:
+        """
+        The compile stage: compile `script` to `artifact_path`, which is run later by an executor with the artifact.
+        Raise CompileError if the script can't be compiled.
+        """
+        key = self.binary_key(script)
+        if key and self.binary_cache.get(key, artifact_path):
+            return CompileArtifact(path=artifact_path, cache={'hits': 1, 'misses': 0})
+        with self._workspace() as tmp_path:
+            exec_path = f"{tmp_path}/run"
+            result = self.execute(
+                self._compile_command(tmp_path, script, exec_path), cwd=tmp_path,
+                timeout=timeout + 1 if timeout else None
+            )
+            if not result.success:
+                raise CompileError(result.stderr)
+            if key:
+                self.binary_cache.put(key, exec_path)
+            shutil.move(exec_path, artifact_path)
+        return CompileArtifact(path=artifact_path, cache={'hits': 0, 'misses': 1} if key else None)
+
+    def execute_cases(self, script, stdins, timeout=None, stop=None, expected_outputs=None):
+        self._cache_stats = None
         try:
-            return super().execute_script(script, stdin, timeout)
+            results = super().execute_cases(script, stdins, timeout, stop, expected_outputs)
+            for result in results:
+                result.cache = self._cache_stats
+            return results
         except CompileError as e:
-            return ProcessExecuteResult(stdout='', stderr=str(e), exit_code=COMPILE_ERROR_EXIT_CODE, cost=0)
+            return [ProcessExecuteResult(stdout='', stderr=str(e), exit_code=COMPILE_ERROR_EXIT_CODE, cost=0)]
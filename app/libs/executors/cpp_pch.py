@@ -0,0 +1,126 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import shlex
+import subprocess
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST = 'manifest.json'
+
+_INCLUDE_RE = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]')
+
+
+def parse_header_sets(value: str) -> list[list[str]]:
+    """Parse `a,b;c`: precompiled headers are separated by `;`, and the headers in each by `,`"""
+    return [
+        [h.strip() for h in header_set.split(',') if h.strip()]
+        for header_set in value.split(';') if header_set.strip()
+    ]
+
+
+def profile_dir(root: str, compiler_cl: str) -> Path:
+    """The directory of the precompiled headers of a compiler flag profile (i.e. the compile command)"""
+    return Path(root) / hashlib.sha256(compiler_cl.encode()).hexdigest()[:16]
+
+
+def insert_before_source(args: list[str], source: str, extra: list[str]) -> list[str]:
+    """Insert `extra` arguments right before the source file, which also works when the compiler is wrapped (e.g. in a sandbox)"""
+    idx = args.index(source) if source in args else len(args)
+    return args[:idx] + extra + args[idx:]
+
+
+def compile_args(compiler_cl: str, source: str, exe: str, workdir: str) -> list[str]:
+    return shlex.split(compiler_cl.format(
+        source=shlex.quote(source),
+        exe=shlex.quote(exe),
+        workdir=shlex.quote(workdir)
+    ))
+
+
+def build_pch(root: str, compiler_cl: str, header_sets: list[list[str]], timeout: float | None = None) -> dict:
+    """
+    Precompile every header set with the flags of `compiler_cl`, and save the manifest used by `load_pch`.
+    A header set failing to compile is skipped.
+    """
+    directory = profile_dir(root, compiler_cl)
+    directory.mkdir(parents=True, exist_ok=True)
+    manifest = {'compiler_cl': compiler_cl, 'sets': []}
+    for i, headers in enumerate(header_sets):
+        header = directory / f'pch{i}.h'
+        header.write_text(''.join(f'#include <{h}>\n' for h in headers))
+        gch = directory / f'pch{i}.h.gch'
+        tmp_gch = directory / f'.pch{i}.h.gch.{os.getpid()}.tmp'
+        args = insert_before_source(
+            compile_args(compiler_cl, str(header), str(tmp_gch), str(directory)),
+            str(header), ['-x', 'c++-header']
+        )
+        completed = subprocess.run(args, cwd=directory, capture_output=True, timeout=timeout)
+        if completed.returncode != 0 or not tmp_gch.exists():
+            logger.error(f'Failed to precompile {headers}: {completed.stderr.decode(errors="replace")}')
+            tmp_gch.unlink(missing_ok=True)
+            continue
+        os.replace(tmp_gch, gch)
+        manifest['sets'].append({'headers': headers, 'header': str(header)})
+    tmp_manifest = directory / f'.{MANIFEST}.{os.getpid()}.tmp'
+    tmp_manifest.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_manifest, directory / MANIFEST)
+    return manifest
+
+
+@functools.cache
+def load_pch(root: str | None, compiler_cl: str) -> list[tuple[frozenset[str], str]]:
+    """The (headers, header to `-include`) of the precompiled headers for `compiler_cl`, largest first"""
+    if not root:
+        return []
+    path = profile_dir(root, compiler_cl) / MANIFEST
+    try:
+        manifest = json.loads(path.read_text())
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError):
+        logger.exception(f'Failed to load precompiled headers from {path}')
+        return []
+    sets = [(frozenset(s['headers']), s['header']) for s in manifest['sets']]
+    return sorted(sets, key=lambda s: len(s[0]), reverse=True)
+
+
+def leading_includes(script: str) -> set[str]:
+    """The headers included before any other code (comments and blank lines aside)"""
+    includes = set()
+    in_comment = False
+    for line in script.splitlines():
+        stripped = line.strip()
+        if in_comment:
+            in_comment = '*/' not in stripped
+            continue
+        if not stripped or stripped.startswith('//'):
+            continue
+        if stripped.startswith('/*'):
+            in_comment = '*/' not in stripped
+            continue
+        m = _INCLUDE_RE.match(line)
+        if not m:
+            break
+        includes.add(m.group(1))
+    return includes
+
+
+def select_pch(script: str, pch_sets: list[tuple[frozenset[str], str]]) -> str | None:
+    """
+    The largest precompiled header whose headers are all included by the script before any other code,
+    so including it first doesn't change the meaning of the script.
+    """
+    if not pch_sets:
+        return None
+    includes = leading_includes(script)
+    for headers, header in pch_sets:
+        if headers <= includes:
+            return header
+    return None
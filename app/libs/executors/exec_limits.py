@@ -0,0 +1,47 @@
+"""
+Move into a cgroup slot and set the limits of a command, then exec it.
+
+Usage: python -I -S exec_limits.py <cgroup.procs> <timeout> <cpu_time> <memory> <command> [arg ...]
+
+The slot and the limits (see ProcessLimits) are `-` when they are not set.
+It replaces `preexec_fn`, which runs python code between fork and exec,
+and is not safe when the worker has other threads (e.g. the slots of AsyncWorker or the lease renewer).
+The memory used by this script is not charged to the slot, as it moves into the slot after the interpreter starts.
+
+Only the modules built in the interpreter are imported (not json or signal), as it runs before every command.
+"""
+import _signal
+import os
+import resource
+import sys
+
+
+def main():
+    procs, timeout, cpu_time, memory = sys.argv[1:5]
+    args = sys.argv[5:]
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    if cpu_time != '-':
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (int(cpu_time), hard))
+    if memory != '-':
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (int(memory), hard))
+    if procs != '-':
+        fd = os.open(procs, os.O_WRONLY | os.O_CREAT)
+        try:
+            os.write(fd, b'0')
+        finally:
+            os.close(fd)
+    if timeout != '-':
+        # the last one, so the time of the setup above is not counted
+        _signal.setitimer(_signal.ITIMER_REAL, float(timeout))
+    try:
+        os.execvp(args[0], args)
+    except OSError as e:
+        # like a shell, as the command is not found by Popen anymore
+        os.write(2, f'{args[0]}: {e.strerror}\n'.encode())
+        os._exit(126 if isinstance(e, PermissionError) else 127)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,20 @@
+import codecs
+import math
+import os
+import resource
+import select
+import selectors
 import subprocess
+import sys
 from dataclasses import dataclass, field
 import tempfile
 import time
 from contextlib import contextmanager
-from typing import Any, Generator, Protocol
+from typing import Any, Callable, Generator, Protocol
 
-from ..utils import nothrow_killpg
+from ..cgroup import CgroupSlot
+from ..workspace import Workspace
+from ..utils import nothrow_killpg, set_running_pgid
 
 
 class ExecuteResult(Protocol):
@@ -20,6 +29,15 @@ class ProcessExecuteResult:
     exit_code: int
     cost: float # in seconds
     success: bool = field(init=False)
+    # hits/misses of the caches used to run the script, e.g. {'hits': 2, 'misses': 1}
+    cache: dict[str, int] | None = None
+    # whether the output matches the expected output, when it is compared by the executor instead of the worker
+    matched: bool | None = None
+    # the cpu time (in seconds) and memory peak (in bytes) of the command, measured by the parent:
+    # from the cgroup slot (which includes all its processes), or else from wait4 (max resident set size)
+    user_time: float | None = None
+    sys_time: float | None = None
+    memory_peak: int | None = None
 
     def __post_init__(self):
         self.success = self.exit_code == 0
@@ -29,8 +47,194 @@ class CompileError(Exception):
     pass
 
 
+@dataclass
+class ProcessLimits:
+    """The limits set on a command right before exec (see exec_limits.py), which are kept by the exec'ed program"""
+    # in seconds. The command is killed by SIGALRM from an interval timer, as interval timers are kept across exec
+    timeout: float | None = None
+    # RLIMIT_CPU in seconds
+    cpu_time: int | None = None
+    # RLIMIT_AS in bytes
+    memory: int | None = None
+
+
+EXEC_LIMITS_SCRIPT = os.path.join(os.path.dirname(__file__), 'exec_limits.py')
+
+
+def limited_command(command_args: list[str], cgroup_slot: CgroupSlot | None = None,
+        limits: ProcessLimits | None = None) -> list[str]:
+    """
+    The command run by exec_limits.py, which moves into `cgroup_slot` and sets `limits` before it execs `command_args`,
+    instead of a `preexec_fn`, which is not safe in a worker with threads
+    """
+    limits = limits or ProcessLimits()
+
+    def arg(value):
+        return str(value) if value else '-'
+
+    return [
+        sys.executable, '-I', '-S', EXEC_LIMITS_SCRIPT,
+        arg(cgroup_slot and cgroup_slot.procs), arg(limits.timeout),
+        arg(limits.cpu_time and math.ceil(limits.cpu_time)), arg(limits.memory),
+        *command_args
+    ]
+
+
+class OutputMismatch(Exception):
+    """The output of a running command diverges from the expected output"""
+    def __init__(self, stdout: bytes, stderr: bytes):
+        super().__init__('output mismatch')
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class OutputMatcher:
+    """
+    Compare the output of a command with the expected output as it arrives,
+    with the normalization of the final comparison (`stdout.strip() == expected_output.strip()`).
+    `feed` returns False as soon as the output can't match anymore, i.e. it diverges or exceeds the expected output.
+    """
+    def __init__(self, expected_output: str):
+        self.expected = expected_output.strip()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._started = False
+        self._pos = 0
+
+    def _match(self, text: str) -> bool:
+        for c in text:
+            if not self._started:
+                if c.isspace():
+                    continue
+                self._started = True
+            if self._pos < len(self.expected):
+                if c != self.expected[self._pos]:
+                    return False
+                self._pos += 1
+            elif not c.isspace():
+                return False
+        return True
+
+    def feed(self, data: bytes) -> bool:
+        return self._match(self._decoder.decode(data))
+
+
+class OutputLimitExceeded(Exception):
+    """The stdout of a running command exceeds the output limit"""
+    def __init__(self, stdout: bytes, stderr: bytes):
+        super().__init__('output limit exceeded')
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+_PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+_READ_SIZE = 32768
+# the time a process can still take to exit by itself after its output diverges from the expected output
+MISMATCH_GRACE_TIME = 0.1
+# the default max size in bytes of the stdout of a command, over which it is killed
+DEFAULT_OUTPUT_LIMIT = 64 * 1024 * 1024
+# the max size in bytes of the stderr kept, the rest is discarded
+DEFAULT_ERROR_LIMIT = 1024 * 1024
+
+
+def _wait4(process: subprocess.Popen, timeout: float | None = None) -> resource.struct_rusage | None:
+    """
+    `process.wait`, but the process is reaped with wait4 to get its resource usage.
+    Return None if the resource usage is not available (no pidfd).
+    """
+    if process.returncode is not None:
+        return None
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        process.wait(timeout)
+        return None
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(pidfd, selectors.EVENT_READ)
+            if not selector.select(timeout):
+                raise subprocess.TimeoutExpired(process.args, timeout)
+    finally:
+        os.close(pidfd)
+    _, status, rusage = os.wait4(process.pid, 0)
+    # let Popen know the process is reaped
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+def _communicate(process: subprocess.Popen, input: bytes | None, timeout: float | None,
+        on_stdout: Callable[[bytes], bool] | None = None,
+        output_limit: int | None = None, error_limit: int | None = None
+        ) -> tuple[bytearray, bytearray, resource.struct_rusage | None]:
+    """
+    `process.communicate` with bounded buffers, which also returns the resource usage of the process (see `_wait4`).
+    OutputLimitExceeded is raised as soon as stdout exceeds `output_limit` bytes,
+    and stderr is read till the end but only the first `error_limit` bytes are kept.
+    `on_stdout` is called for every chunk of stdout.
+    Once it returns False, the process gets MISMATCH_GRACE_TIME to exit by itself (e.g. it has printed everything),
+    otherwise OutputMismatch is raised.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    mismatch = False
+    stdout = bytearray()
+    stderr = bytearray()
+
+    def _expired():
+        if mismatch:
+            return OutputMismatch(stdout, stderr)
+        return subprocess.TimeoutExpired(process.args, timeout, stdout, stderr)
+
+    with selectors.DefaultSelector() as selector:
+        if process.stdin:
+            if input:
+                selector.register(process.stdin, selectors.EVENT_WRITE)
+            else:
+                process.stdin.close()
+        selector.register(process.stdout, selectors.EVENT_READ)
+        selector.register(process.stderr, selectors.EVENT_READ)
+        offset = 0
+        while selector.get_map():
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise _expired()
+            for key, _ in selector.select(remaining):
+                if key.fileobj is process.stdin:
+                    try:
+                        offset += os.write(key.fd, input[offset:offset + _PIPE_BUF])
+                    except BrokenPipeError:
+                        offset = len(input)
+                    if offset >= len(input):
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                    continue
+                data = os.read(key.fd, _READ_SIZE)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                if key.fileobj is process.stderr:
+                    if error_limit is None:
+                        stderr += data
+                    elif len(stderr) < error_limit:
+                        stderr += data[:error_limit - len(stderr)]
+                    continue
+                if output_limit is not None and len(stdout) + len(data) > output_limit:
+                    stdout += data[:output_limit - len(stdout)]
+                    raise OutputLimitExceeded(stdout, stderr)
+                stdout += data
+                if on_stdout is not None and not mismatch and not on_stdout(data):
+                    mismatch = True
+                    grace_deadline = time.monotonic() + MISMATCH_GRACE_TIME
+                    deadline = min(deadline, grace_deadline) if deadline is not None else grace_deadline
+    try:
+        rusage = _wait4(process, max(deadline - time.monotonic(), 0) if deadline is not None else None)
+    except subprocess.TimeoutExpired:
+        raise _expired()
+    return stdout, stderr, rusage
+
+
 def _run_as_pg(args: list[str],
-        input=None, capture_output=False, timeout=None, check=False, **kwargs):
+        input=None, capture_output=False, timeout=None, check=False, on_stdout=None,
+        output_limit=None, error_limit=None, **kwargs):
     # copied from subprocess.run
     # For most cases, this is enough to make sure all subprocesses are
     # killed when the parent process is killed.
@@ -51,56 +255,127 @@ def _run_as_pg(args: list[str],
         kwargs['stdout'] = PIPE
         kwargs['stderr'] = PIPE
 
+    rusage = None
     with Popen(args, **kwargs) as process:
+        # so the worker can kill it when it hangs
+        set_running_pgid(process.pid)
         try:
-            stdout, stderr = process.communicate(input, timeout=timeout)
-        except TimeoutExpired as exc:
+            if capture_output:
+                stdout, stderr, rusage = _communicate(process, input, timeout, on_stdout, output_limit, error_limit)
+            else:
+                stdout, stderr = process.communicate(input, timeout=timeout)
+        except (TimeoutExpired, OutputMismatch, OutputLimitExceeded) as e:
             # as we set start_new_session=True, pid is the process group id
             nothrow_killpg(pgid=process.pid)
-            process.wait()
+            e.rusage = _wait4(process)
             raise
         except:  # Including KeyboardInterrupt, communicate handled that.
             nothrow_killpg(pgid=process.pid)
             # We don't call process.wait() as .__exit__ does that for us.
             raise
+        finally:
+            set_running_pgid(None)
         # in case some orphaned child process is still running
         nothrow_killpg(pgid=process.pid)
         retcode = process.poll()
         if check and retcode:
             raise CalledProcessError(retcode, process.args,
                                      output=stdout, stderr=stderr)
-    return CompletedProcess(process.args, retcode, stdout, stderr)
+    completed = CompletedProcess(process.args, retcode, stdout, stderr)
+    completed.rusage = rusage
+    return completed
 
 
 TIMEOUT_EXIT_CODE = -101
 COMPILE_ERROR_EXIT_CODE = -102
+MEMORY_LIMIT_EXIT_CODE = -103
+WRONG_ANSWER_EXIT_CODE = -104
+OUTPUT_LIMIT_EXIT_CODE = -105
 
 
 class ProcessExecutor:
-    def execute(self, command_args: list[str], cwd=None, stdin: str | None = None, timeout: float | None = None) -> ProcessExecuteResult:
+    # when set, commands are moved into the cgroup slot right before exec,
+    # which limits their cpu/memory instead of a systemd-run scope
+    cgroup_slot: CgroupSlot | None = None
+
+    # the max size in bytes of the stdout of a command, over which it is killed (OUTPUT_LIMIT_EXIT_CODE)
+    output_limit: int | None = DEFAULT_OUTPUT_LIMIT
+    # the max size in bytes of the stderr of a command kept in the result
+    error_limit: int | None = DEFAULT_ERROR_LIMIT
+
+    def execute(self, command_args: list[str], cwd=None, stdin: str | None = None, timeout: float | None = None,
+            cgroup_slot: CgroupSlot | None = None, env: dict[str, str] | None = None,
+            expected_output: str | None = None, limits: ProcessLimits | None = None) -> ProcessExecuteResult:
+        """
+        With `expected_output`, the command is killed as soon as its output can't match it (WRONG_ANSWER_EXIT_CODE).
+        The command is also killed once its stdout exceeds `output_limit` (OUTPUT_LIMIT_EXIT_CODE).
+        The command is moved into `cgroup_slot` and `limits` are set on it right before exec.
+        """
         time_start = time.perf_counter()
+        matched = None
+        rusage = None
+        slot_start = cgroup_slot.stats() if cgroup_slot else None
+        slot_usage = {}
+
+        if cgroup_slot or limits:
+            command_args = limited_command(command_args, cgroup_slot, limits)
         try:
             std_input = stdin.encode() if stdin else None
-            result = _run_as_pg(command_args, cwd=cwd, shell=False, check=False, capture_output=True, timeout=timeout, input=std_input)
-            stdout = result.stdout.decode()
-            stderr = result.stderr.decode()
+            matcher = OutputMatcher(expected_output) if expected_output is not None else None
+            result = _run_as_pg(command_args, cwd=cwd, shell=False, check=False, capture_output=True, timeout=timeout, input=std_input,
+                                on_stdout=matcher.feed if matcher else None,
+                                output_limit=self.output_limit, error_limit=self.error_limit,
+                                env=env)
+            stdout, stderr, rusage = result.stdout, result.stderr, result.rusage
             exit_code = result.returncode
         except subprocess.TimeoutExpired as e:
-            stdout = e.stdout.decode()
-            stderr = e.stderr.decode()
+            stdout, stderr, rusage = e.stdout, e.stderr, e.rusage
             exit_code = TIMEOUT_EXIT_CODE
+        except OutputMismatch as e:
+            stdout, stderr, rusage = e.stdout, e.stderr, e.rusage
+            exit_code = WRONG_ANSWER_EXIT_CODE
+            matched = False
+        except OutputLimitExceeded as e:
+            stdout, stderr, rusage = e.stdout, e.stderr, e.rusage
+            exit_code = OUTPUT_LIMIT_EXIT_CODE
+        finally:
+            if cgroup_slot:
+                slot_usage = cgroup_slot.usage(slot_start)
+                # processes escaped from the process group are still in the slot
+                cgroup_slot.kill()
 
         time_end = time.perf_counter()
 
+        # the captured output is only decoded once, here
         return ProcessExecuteResult(
-            stdout=stdout,
-            stderr=stderr,
+            stdout=stdout.decode(errors='replace') if stdout else '',
+            stderr=stderr.decode(errors='replace') if stderr else '',
             exit_code=exit_code,
-            cost=time_end - time_start
+            cost=time_end - time_start,
+            matched=matched,
+            user_time=slot_usage.get('user_time', rusage.ru_utime if rusage else None),
+            sys_time=slot_usage.get('sys_time', rusage.ru_stime if rusage else None),
+            memory_peak=slot_usage.get('memory_peak', rusage.ru_maxrss * 1024 if rusage else None),
         )
 
 
 class ScriptExecutor(ProcessExecutor):
+    # when set, the script is prepared and run in the workspace (e.g. on a RAM-backed mount),
+    # instead of a new temporary directory
+    workspace: Workspace | None = None
+
+    @contextmanager
+    def _workspace(self) -> Generator[str, None, None]:
+        """The working directory of a run, emptied after the run"""
+        if self.workspace is None:
+            with tempfile.TemporaryDirectory() as tmp_path:
+                yield tmp_path
+            return
+        try:
+            yield str(self.workspace.path)
+        finally:
+            self.workspace.reset()
+
     def setup_command(self, tmp_path: str, script: str) -> Generator[list[str], ProcessExecuteResult, None]:
         """
         Prepare the command to execute the script
@@ -110,18 +385,69 @@ class ScriptExecutor(ProcessExecutor):
     def process_result(self, result: ProcessExecuteResult) -> ProcessExecuteResult:
         return result
 
-    def execute_script(self, script: str, stdin: str | None = None, timeout: float | None = None) -> ProcessExecuteResult:
+    def configure_slot(self):
+        """Set the limits of the submission on `cgroup_slot`"""
+        self.cgroup_slot.configure(self.cpu_core, self.memory_limit)
+
+    def confine(self, step: int) -> bool:
+        """Whether the `step`-th command of `setup_command` runs in `cgroup_slot`"""
+        return True
+
+    def compare_output(self, step: int) -> bool:
+        """Whether the stdout of the `step`-th command of `setup_command` is compared with the expected output"""
+        return True
+
+    def command_env(self, step: int) -> dict[str, str] | None:
+        """The environment of the `step`-th command of `setup_command`, None to inherit the environment of the worker"""
+        return None
+
+    def command_limits(self, step: int) -> ProcessLimits | None:
+        """The limits set on the `step`-th command of `setup_command` right before exec"""
+        return None
+
+    def execute_script(self, script: str, stdin: str | None = None, timeout: float | None = None,
+            expected_output: str | None = None) -> ProcessExecuteResult:
+        return self.execute_cases(script, [stdin], timeout, expected_outputs=[expected_output])[0]
+
+    def execute_cases(self, script: str, stdins: list[str | None], timeout: float | None = None,
+            stop: Callable[[int, ProcessExecuteResult], bool] | None = None,
+            expected_outputs: list[str | None] | None = None) -> list[ProcessExecuteResult]:
+        """
+        Prepare the script once (e.g. compile it), and run the last command of `setup_command` with every stdin.
+        The remaining cases are skipped once `stop` returns True for the index and the result of a case.
+        With `expected_outputs`, a case is killed as soon as its output can't match (see `execute`).
+        """
+        expected_outputs = expected_outputs or [None] * len(stdins)
         # add 1 second to timeout as the overhead of the pre/post processing
         timeout = timeout + 1 if timeout else None
 
-        with tempfile.TemporaryDirectory() as tmp_path:
+        if self.cgroup_slot:
+            self.configure_slot()
+        with self._workspace() as tmp_path:
             gen_command = self.setup_command(tmp_path, script)
             command = next(gen_command)
+            step = 0
             while True:
                 try:
-                    result = self.execute(command, cwd=tmp_path, stdin=stdin, timeout=timeout)
+                    result = self.execute(command, cwd=tmp_path, stdin=stdins[0], timeout=timeout,
+                                          cgroup_slot=self.cgroup_slot if self.confine(step) else None,
+                                          env=self.command_env(step), limits=self.command_limits(step),
+                                          expected_output=expected_outputs[0] if self.compare_output(step) else None)
                     command = gen_command.send(result)
+                    step += 1
                 except StopIteration:
                     break
-            # return the last result
-            return self.process_result(result)
+            # the last command runs the script
+            results = [self.process_result(result)]
+            for stdin, expected_output in zip(stdins[1:], expected_outputs[1:]):
+                if stop and stop(len(results) - 1, results[-1]):
+                    break
+                if self.cgroup_slot:
+                    # reset the usage of the previous case
+                    self.configure_slot()
+                result = self.execute(command, cwd=tmp_path, stdin=stdin, timeout=timeout,
+                                      cgroup_slot=self.cgroup_slot if self.confine(step) else None,
+                                      env=self.command_env(step), limits=self.command_limits(step),
+                                      expected_output=expected_output if self.compare_output(step) else None)
+                results.append(self.process_result(result))
+            return results
@@ -1,20 +1,118 @@
 
+import copy
+import hashlib
 import json
+import re
 import tempfile
 import io
 import shlex
 import subprocess, shutil, sys, textwrap
+import time
 from pathlib import Path
-from .executor import ScriptExecutor, ProcessExecuteResult, TIMEOUT_EXIT_CODE
+from typing import Callable
+from .executor import ScriptExecutor, ProcessExecuteResult, TIMEOUT_EXIT_CODE, MEMORY_LIMIT_EXIT_CODE
+from ..cgroup import CgroupSlot
+from .lean_repl import LeanRepl, LeanReplPool, LeanReplError, MemoryLimitExceeded
+from .lean_imports import AUTO_IMPORTS, LeanImportIndex, make_header, parse_imports
 from contextlib import contextmanager
 # Add necessary extenstional libraries
 PRE_TEMPLATE = f"""
 import Mathlib
 """.strip()
 
+# Commands sent to a pooled REPL don't contain the header.
+# Pad them with empty lines, so the reported positions are the same as when the header is in the file.
+HEADER_PADDING = '\n' * (PRE_TEMPLATE.count('\n') + 1)
+
+# errors caused by a missing import rather than a wrong proof.
+# Other errors (e.g. a syntax error or a missing instance) are also reported by a wrong proof, which is not checked again.
+_MISSING_IMPORT_ERRORS = ('unknown identifier', 'unknown constant', 'unknown namespace')
+
+
+# the top level commands a submission can be split at
+_COMMAND_START_RE = re.compile(
+    r'^(?:/--|@\[|(?:theorem|lemma|def|example|abbrev|instance|structure|class|inductive|axiom|opaque'
+    r'|noncomputable|private|protected|open|namespace|section|end|mutual|variable|universe|set_option|attribute)\b)'
+)
+# the declarations of a `mutual ... end` block can't be checked one by one
+_MUTUAL_RE = re.compile(r'^mutual\b')
+_END_RE = re.compile(r'^end\b')
+
+
+def _split_commands(script: str) -> list[str]:
+    """
+    Split a script into chunks of top level commands, which can be checked one after another
+    against the environment of the previous chunk. Joining the chunks gives back the script.
+    A chunk only starts at a command keyword at column 0 after an empty line (outside of comments and `mutual` blocks),
+    so docstrings, attributes and `... in` stay with the declaration they belong to.
+    """
+    chunks = []
+    start = 0
+    offset = 0
+    comment_depth = 0
+    in_mutual = False
+    prev_blank = False
+    prev_line = ''
+    for line in script.splitlines(keepends=True):
+        if (offset > start and comment_depth == 0 and not in_mutual and prev_blank
+                and not prev_line.rstrip().endswith(' in') and _COMMAND_START_RE.match(line)):
+            chunks.append(script[start:offset])
+            start = offset
+        if comment_depth == 0:
+            if _MUTUAL_RE.match(line):
+                in_mutual = True
+            elif in_mutual and _END_RE.match(line):
+                # the next chunk starts after the block
+                in_mutual = False
+        comment_depth = max(comment_depth + line.count('/-') - line.count('-/'), 0)
+        offset += len(line)
+        prev_blank = not line.strip()
+        if not prev_blank:
+            prev_line = line
+    chunks.append(script[start:])
+    return chunks
+
+
+def _has_errors(response: dict) -> bool:
+    return any(m.get('severity') == 'error' for m in response.get('messages', []))
+
+
+def _merge_responses(responses: list[dict]) -> dict:
+    """Merge the responses of the chunks of a script, as if the script is checked in one command"""
+    # cached responses are shared by the scripts with the same prefix
+    responses = copy.deepcopy(responses)
+    data = responses[-1]
+    for key in ('messages', 'sorries'):
+        items = [item for response in responses for item in response.get(key, [])]
+        if items:
+            data[key] = items
+    return data
+
+
+def _normalize_response(data: dict) -> dict:
+    """
+    Make a REPL response independent of the REPL session it comes from,
+    i.e. the same as a fresh REPL checking a single file would return.
+    """
+    if 'env' in data:
+        data['env'] = 0
+    for i, sorry in enumerate(data.get('sorries', [])):
+        if 'proofState' in sorry:
+            sorry['proofState'] = i
+    return data
+
+
+def _missing_import(result: ProcessExecuteResult) -> bool:
+    return result.stdout == 'fail' and any(e in result.stderr for e in _MISSING_IMPORT_ERRORS)
+
+
 class LeanExecutor(ScriptExecutor):
-    def __init__(self, run_cl: str, timeout: int = None, memory_limit: int = None, cpu_core: int = None):
-        # TODO: timeout and memory_limit have no effect currently
+    def __init__(self, run_cl: str, timeout: int = None, memory_limit: int = None, cpu_core: int = None,
+            repl_pool_factory: Callable[[str], LeanReplPool] | None = None, repl_cl: list[str] | None = None,
+            repl_env: dict[str, str] | None = None, repl_cwd: str | None = None, header_pickle: str | None = None,
+            imports: str | None = None, import_index: LeanImportIndex | None = None, env_cache_size: int = 0,
+            cgroup_slot: CgroupSlot | None = None):
+        # timeout and memory_limit are only enforced when the submission is checked in a REPL session
         self.timeout = timeout
         self.memory_limit = (
             memory_limit + 128 * 1024 * 1024  # extra 128MB for python overhead
@@ -25,11 +123,32 @@ class LeanExecutor(ScriptExecutor):
         # It is used as the startup command of lean
         self.run_cl = run_cl
         self.cpu_core = cpu_core
-    
+        # when set, submissions are checked by warm REPL processes with the header already loaded.
+        # It returns the pool for a header, so there is a pool per distinct import set.
+        self.repl_pool_factory = repl_pool_factory
+        # without a pool, a new REPL session is started with `repl_cl` for every submission,
+        # which loads the header from the pickled environment `header_pickle` if it is given.
+        # If neither is set, every submission is checked by `run_cl` as a file.
+        self.repl_cl = repl_cl
+        self.repl_env = repl_env
+        self.repl_cwd = repl_cwd
+        # `header_pickle` is the environment of PRE_TEMPLATE, it is not used for other headers
+        self.header_pickle = header_pickle
+        # the modules to import instead of PRE_TEMPLATE: a module list, or AUTO_IMPORTS to infer them with `import_index`.
+        # In the AUTO_IMPORTS mode, a submission failing because of a missing import is checked again with PRE_TEMPLATE.
+        self.imports = imports
+        self.import_index = import_index
+        self.header = PRE_TEMPLATE
+        # max number of environments of script prefixes cached in each REPL.
+        # Submissions sharing leading definitions and lemmas only elaborate the part after the shared prefix.
+        self.env_cache_size = env_cache_size
+        # only used when a submission is checked as a file, as REPLs are shared by submissions
+        self.cgroup_slot = cgroup_slot
+
     def setup_command(self, tmp_path: str, script: str):
         source_path = f"{tmp_path}/code.lean"
         with open(source_path, mode='w') as f:
-            f.write(PRE_TEMPLATE)
+            f.write(self.header)
             f.write("\n")
             f.write(script)
             f.flush()
@@ -42,6 +161,11 @@ class LeanExecutor(ScriptExecutor):
             workdir=shlex.quote(str(tmp_path))
         ))      
 
+        if self.cgroup_slot:
+            # the limits are set on the slot, and the command enters it before exec
+            yield lean_cmd
+            return
+
         quota = int(round(self.cpu_core * 100))
         systemd_prefix = [
             "systemd-run", "--user", "--scope", "--quiet",
@@ -51,6 +175,186 @@ class LeanExecutor(ScriptExecutor):
         cmd = systemd_prefix + lean_cmd
         yield cmd
 
+    def configure_slot(self):
+        # checking a file is dominated by the memory of the imports,
+        # so memory_limit is only enforced for the commands in a REPL session
+        self.cgroup_slot.configure(self.cpu_core, None)
+
+    @property
+    def _use_repl_session(self) -> bool:
+        return self.repl_pool_factory is not None or self.repl_cl is not None
+
+    def _header_for(self, scripts: list[str]) -> str:
+        if not self.imports:
+            return PRE_TEMPLATE
+        if self.imports != AUTO_IMPORTS:
+            return make_header(parse_imports(self.imports))
+        if self.import_index is None:
+            return PRE_TEMPLATE
+        modules = [m for script in scripts for m in self.import_index.infer(script)]
+        return make_header(modules)
+
+    def execute_script(self, script, stdin=None, timeout=None, expected_output=None):
+        # the result is decided by the messages of lean, not compared with the expected output
+        return self.execute_batch([script])[0]
+
+    def execute_batch(self, scripts: list[str]) -> list[ProcessExecuteResult]:
+        """
+        Check independent scripts one by one in the same REPL session,
+        each as a command against the header environment, and return the processed result of every script.
+        """
+        header = self._header_for(scripts)
+        results = self._check_scripts(scripts, header)
+        if self.imports == AUTO_IMPORTS and header != PRE_TEMPLATE:
+            # the inferred imports may be incomplete, e.g. an instance or a notation from another module
+            retry = [i for i, result in enumerate(results) if _missing_import(result)]
+            if retry:
+                for i, result in zip(retry, self._check_scripts([scripts[i] for i in retry], PRE_TEMPLATE)):
+                    result.cost += results[i].cost
+                    results[i] = result
+        return results
+
+    def _check_scripts(self, scripts: list[str], header: str) -> list[ProcessExecuteResult]:
+        self.header = header
+        if not self._use_repl_session:
+            return [super(LeanExecutor, self).execute_script(script) for script in scripts]
+
+        results = []
+        repl = None
+        try:
+            for script in scripts:
+                if repl is None:
+                    repl, startup_cost = self._open_session()
+                result, broken = self._execute_in_repl(repl, script)
+                # the script which waits for the session to start pays for it
+                result.cost += startup_cost
+                startup_cost = 0
+                results.append(self.process_result(result))
+                if broken:
+                    # a hanged or crashed REPL is killed, and the rest scripts go to a new session
+                    self._close_session(repl, broken=True)
+                    repl = None
+        finally:
+            if repl is not None:
+                self._close_session(repl)
+        return results
+
+    def _open_session(self) -> tuple[LeanRepl, float]:
+        """Get a REPL with the header loaded, and the time spent on starting it"""
+        if self.repl_pool_factory is not None:
+            # warm processes are started in advance, so it is not part of the cost.
+            return self.repl_pool_factory(self.header).acquire(), 0
+        time_start = time.perf_counter()
+        repl = LeanRepl(self.repl_cl, cwd=self.repl_cwd, env=self.repl_env, persistent=False)
+        try:
+            repl.load_header(self.header, self.header_pickle if self.header == PRE_TEMPLATE else None)
+            repl.wait_header()
+        except Exception:
+            repl.close()
+            raise
+        return repl, time.perf_counter() - time_start
+
+    def _close_session(self, repl: LeanRepl, broken: bool = False):
+        if self.repl_pool_factory is not None:
+            self.repl_pool_factory(self.header).release(repl, broken)
+        else:
+            repl.close()
+
+    def _execute_in_repl(self, repl: LeanRepl, script: str) -> tuple[ProcessExecuteResult, bool]:
+        """Check the script against the header environment of `repl`. Return the result and whether `repl` is broken."""
+        broken = True
+        cache = None
+        time_start = time.perf_counter()
+        try:
+            if self.env_cache_size > 0:
+                response, cache = self._send_with_cache(repl, script)
+            else:
+                response = repl.send(
+                    {'cmd': HEADER_PADDING + script, 'env': repl.base_env},
+                    timeout=self.timeout,
+                    memory_limit=self.memory_limit
+                )
+            broken = False
+            stdout, stderr, exit_code = json.dumps(_normalize_response(response), ensure_ascii=False), '', 0
+        except TimeoutError:
+            stdout, stderr, exit_code = '', 'Suicide from timeout.', TIMEOUT_EXIT_CODE
+        except MemoryLimitExceeded:
+            stdout, stderr, exit_code = '', 'Memory limit exceeded.', MEMORY_LIMIT_EXIT_CODE
+        except LeanReplError as e:
+            stdout, stderr, exit_code = '', str(e), 1
+        result = ProcessExecuteResult(
+            stdout=stdout,
+            stderr=stderr,
+            exit_code=exit_code,
+            cost=time.perf_counter() - time_start,
+            cache=cache
+        )
+        return result, broken
+
+    def _send_with_cache(self, repl: LeanRepl, script: str) -> tuple[dict, dict[str, int]]:
+        """
+        Check the script chunk by chunk. The environments after the leading chunks are cached in `repl`
+        by the hash of the prefix, with the responses of the chunks, so a script with a cached prefix
+        only elaborates the rest.
+        """
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        chunks = _split_commands(script)
+        cache = {'hits': 0, 'misses': 0}
+        # a script is one use of the REPL, however many chunks it has
+        repl.uses += 1
+        responses = []
+        env = repl.base_env
+        padding = HEADER_PADDING
+        key = hashlib.sha256()
+        for i, chunk in enumerate(chunks):
+            is_prefix = i < len(chunks) - 1
+            if is_prefix:
+                key.update(chunk.encode())
+                key.update(b'\0')
+                cached = repl.env_cache.get(key.hexdigest())
+                if cached is not None:
+                    repl.env_cache.move_to_end(key.hexdigest())
+                    env, response = cached
+                    cache['hits'] += 1
+                    responses.append(response)
+                    padding += '\n' * chunk.count('\n')
+                    continue
+                cache['misses'] += 1
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise TimeoutError('REPL response timed out')
+            # keep the positions in the messages the same as in the whole script
+            repl.write({'cmd': padding + chunk, 'env': env})
+            response = repl.read(timeout, self.memory_limit)
+            responses.append(response)
+            padding += '\n' * chunk.count('\n')
+            if not is_prefix:
+                break
+            if 'env' not in response:
+                # the REPL failed to run the chunk (e.g. `{"message": "unknown environment"}`),
+                # so the rest of the script can't be checked, and the partial responses are not a result
+                raise LeanReplError(f'Failed to check the script: {json.dumps(response, ensure_ascii=False)}')
+            if _has_errors(response):
+                # the script may be split where it can't be (e.g. in a block the split doesn't know about),
+                # so a failure is only reported for the whole script, which is checked in one command
+                return self._send_whole(repl, script, deadline), cache
+            env = response['env']
+            repl.env_cache[key.hexdigest()] = (env, response)
+            while len(repl.env_cache) > self.env_cache_size:
+                repl.env_cache.popitem(last=False)
+        return _merge_responses(responses), cache
+
+    def _send_whole(self, repl: LeanRepl, script: str, deadline: float | None) -> dict:
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise TimeoutError('REPL response timed out')
+        repl.write({'cmd': HEADER_PADDING + script, 'env': repl.base_env})
+        return repl.read(timeout, self.memory_limit)
+
     def process_result(self, result):
         try:
             if result.stderr and result.stderr.strip():
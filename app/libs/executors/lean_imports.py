@@ -0,0 +1,144 @@
+import functools
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+# the `imports` option that infers the imports from the identifiers in a submission
+AUTO_IMPORTS = 'auto'
+
+# bump when the format of the index changes, so bootstrap rebuilds it
+INDEX_VERSION = 1
+
+_MODULE_RE = re.compile(r"^[^\W\d][\w']*(\.[^\W\d][\w']*)*$")
+_DECL_RE = re.compile(
+    r"^(?:@\[[^\]]*\]\s*)?((?:(?:private|protected|noncomputable|nonrec|partial|unsafe)\s+)*)"
+    r"(?:theorem|lemma|def|abbrev|instance|structure|class|inductive|opaque|axiom)\s+([^\s:({\[⦃]+)"
+)
+_NAMESPACE_RE = re.compile(r"^namespace\s+(\S+)")
+_SECTION_RE = re.compile(r"^(?:noncomputable\s+)?section\b")
+_END_RE = re.compile(r"^end\b")
+_TACTIC_RE = re.compile(r'^(?:syntax|elab|macro)\b[^"]*"([^\W\d][\w?!]*)".*:\s*tactic\b')
+_NOTATION_RE = re.compile(r'^(?:notation|prefix|infix[lr]?|postfix|syntax|macro)\b[^"]*"\s*([^"\s]+)\s*"')
+_IDENT_RE = re.compile(r"[^\W\d][\w.'!?]*")
+_OPEN_RE = re.compile(r"^\s*(?:open|namespace)\s+(?:scoped\s+)?([^\n(]+)", re.MULTILINE)
+
+
+def parse_imports(imports: str) -> list[str]:
+    """Parse a comma/whitespace separated module list"""
+    modules = [m for m in re.split(r'[\s,]+', imports) if m]
+    for m in modules:
+        if not _MODULE_RE.match(m):
+            raise ValueError(f'Invalid lean module name: {m}')
+    return modules
+
+
+def make_header(modules: list[str]) -> str:
+    """
+    Every module has its own `import`, but all of them are put in one line, so the header has as many lines as `import Mathlib`,
+    and the positions of the messages don't depend on the import set.
+    """
+    return ' '.join(f'import {m}' for m in dict.fromkeys(modules or ['Init']))
+
+
+def _module_name(root: Path, path: Path) -> str:
+    return '.'.join(path.relative_to(root).with_suffix('').parts)
+
+
+def _scan_module(path: Path, module: int, index: dict):
+    scopes: list[str | None] = []
+    for line in path.read_text(encoding='utf-8', errors='replace').splitlines():
+        stripped = line.strip()
+        if m := _NAMESPACE_RE.match(stripped):
+            scopes.append(m.group(1))
+        elif _SECTION_RE.match(stripped):
+            scopes.append(None)
+        elif _END_RE.match(stripped) and scopes and line == stripped:
+            scopes.pop()
+        elif m := _DECL_RE.match(stripped):
+            if 'private' in m.group(1):
+                continue
+            name = m.group(2)
+            if name.startswith('_root_.'):
+                name = name[len('_root_.'):]
+            else:
+                name = '.'.join([ns for ns in scopes if ns] + [name])
+            index['decls'].setdefault(name, module)
+        if stripped.startswith(('local ', 'scoped ')):
+            # not visible without `open`
+            continue
+        if m := _TACTIC_RE.match(stripped):
+            index['tactics'].setdefault(m.group(1), module)
+        elif (m := _NOTATION_RE.match(stripped)) and not m.group(1).isascii():
+            index['notations'].setdefault(m.group(1), module)
+
+
+def build_import_index(source_root: str, package: str = 'Mathlib') -> dict:
+    """
+    Scan the sources of `package` for the modules declaring every (public) declaration,
+    tactic and unicode notation, and return the index consumed by `LeanImportIndex`.
+    """
+    root = Path(source_root)
+    index = {'version': INDEX_VERSION, 'modules': [], 'decls': {}, 'tactics': {}, 'notations': {}}
+    for path in sorted((root / package).rglob('*.lean')):
+        index['modules'].append(_module_name(root, path))
+        _scan_module(path, len(index['modules']) - 1, index)
+    return index
+
+
+class LeanImportIndex:
+    """Infer the modules a submission needs from the identifiers, tactics and notations it uses"""
+    def __init__(self, index: dict):
+        self.modules: list[str] = index['modules']
+        self.decls: dict[str, int] = index['decls']
+        self.tactics: dict[str, int] = index['tactics']
+        self.notations: dict[str, int] = index['notations']
+
+    def _lookup(self, token: str, namespaces: list[str]) -> int | None:
+        parts = token.rstrip('.').split('.')
+        # `Nat.le_of_lt_succ.mp` is `Nat.le_of_lt_succ` followed by a projection
+        for k in range(len(parts), 0, -1):
+            name = '.'.join(parts[:k])
+            for ns in namespaces:
+                module = self.decls.get(f'{ns}.{name}' if ns else name)
+                if module is not None:
+                    return module
+        return None
+
+    def infer(self, script: str) -> list[str]:
+        namespaces = ['']
+        for m in _OPEN_RE.finditer(script):
+            namespaces.extend(ns for ns in m.group(1).split() if ns != 'in')
+        found = set()
+        for token in set(_IDENT_RE.findall(script)):
+            module = self._lookup(token, namespaces)
+            if module is None:
+                module = self.tactics.get(token)
+            if module is not None:
+                found.add(module)
+        for notation, module in self.notations.items():
+            if notation in script:
+                found.add(module)
+        return sorted(self.modules[i] for i in found)
+
+
+@functools.cache
+def load_import_index(path: str | None) -> LeanImportIndex | None:
+    """Load the index built by bootstrap. Return None if it is not available."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') != INDEX_VERSION:
+            logger.warning(f'Lean import index {path} is outdated. Ignored.')
+            return None
+        return LeanImportIndex(index)
+    except (OSError, ValueError, KeyError):
+        logger.exception(f'Failed to load lean import index {path}')
+        return None
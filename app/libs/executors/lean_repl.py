@@ -0,0 +1,282 @@
+import functools
+from collections import OrderedDict
+import json
+import logging
+import os
+import selectors
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+
+import psutil
+
+from ..utils import nothrow_killpg, add_persistent_pgid, remove_persistent_pgid
+
+
+logger = logging.getLogger(__name__)
+
+
+# the REPL separates commands and responses with a blank line
+_MESSAGE_SEPARATOR = b'\n\n'
+# how often the memory usage is checked while waiting for a response
+_POLL_INTERVAL = 0.5
+# the environment variables set by `lake env` that the REPL binary needs
+REPL_ENV_KEYS = ('LEAN_PATH', 'LEAN_SRC_PATH', 'LEAN_SYSROOT', 'LD_LIBRARY_PATH', 'DYLD_LIBRARY_PATH', 'PATH')
+
+
+class LeanReplError(Exception):
+    pass
+
+
+class MemoryLimitExceeded(Exception):
+    pass
+
+
+class LeanRepl:
+    """
+    A long-lived Lean REPL process talking JSON over stdin/stdout.
+    The process runs in its own process group, so it can be killed with all its children.
+    A `persistent` process is not considered as hanged by the worker manager however long it lives.
+    """
+    def __init__(self, command_args: list[str], cwd=None, env=None, persistent: bool = True):
+        # stderr is only read when the process dies, so a file is used to avoid blocking on a full pipe
+        self._stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            command_args, cwd=cwd, env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self._stderr,
+            start_new_session=True
+        )
+        self.persistent = persistent
+        if persistent:
+            add_persistent_pgid(self.process.pid)
+        self._buffer = b''
+        self.base_env: int | None = None
+        self.uses = 0
+        # prefix hash -> (env, response), see LeanExecutor._send_with_cache
+        self.env_cache: OrderedDict[str, tuple[int, dict]] = OrderedDict()
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def rss(self) -> int:
+        """The resident memory of the REPL and its children in bytes"""
+        try:
+            proc = psutil.Process(self.process.pid)
+            return sum(p.memory_info().rss for p in [proc, *proc.children(recursive=True)])
+        except psutil.Error:
+            return 0
+
+    def write(self, command: dict):
+        try:
+            self.process.stdin.write(json.dumps(command, ensure_ascii=False).encode() + _MESSAGE_SEPARATOR)
+            self.process.stdin.flush()
+        except OSError as e:
+            raise LeanReplError(f'Failed to send command to REPL: {e}. {self._read_stderr()}')
+
+    def read(self, timeout: float | None = None, memory_limit: int | None = None) -> dict:
+        """
+        Read the next response.
+        Raise TimeoutError if no response in `timeout` seconds,
+        and MemoryLimitExceeded if the REPL grows more than `memory_limit` bytes while waiting.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        base_rss = self.rss() if memory_limit else 0
+        fd = self.process.stdout.fileno()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while _MESSAGE_SEPARATOR not in self._buffer:
+                wait = _POLL_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        raise TimeoutError('REPL response timed out')
+                if selector.select(wait):
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        raise LeanReplError(f'REPL exited unexpectedly. {self._read_stderr()}')
+                    self._buffer += chunk
+                elif memory_limit and self.rss() - base_rss > memory_limit:
+                    raise MemoryLimitExceeded('REPL memory limit exceeded')
+
+        response, self._buffer = self._buffer.split(_MESSAGE_SEPARATOR, 1)
+        return json.loads(response)
+
+    def send(self, command: dict, timeout: float | None = None, memory_limit: int | None = None) -> dict:
+        self.uses += 1
+        self.write(command)
+        return self.read(timeout, memory_limit)
+
+    def load_header(self, header: str, pickle_path: str | None = None):
+        """
+        Start loading the environment all commands are run against, without waiting for it.
+        The pickled environment in `pickle_path` is used instead of elaborating `header` if it is given.
+        """
+        if pickle_path:
+            self.write({'unpickleEnvFrom': pickle_path})
+        else:
+            self.write({'cmd': header})
+
+    def wait_header(self, timeout: float | None = None):
+        """Wait for `load_header` to finish and set `base_env`"""
+        try:
+            response = self.read(timeout)
+        except TimeoutError as e:
+            raise LeanReplError(f'Failed to load REPL header: {e}')
+        errors = [m for m in response.get('messages', []) if m.get('severity') == 'error']
+        if errors or 'env' not in response:
+            raise LeanReplError(f'Failed to load REPL header: {json.dumps(response, ensure_ascii=False)}')
+        self.base_env = response['env']
+
+    def _read_stderr(self) -> str:
+        try:
+            self._stderr.seek(0)
+            return self._stderr.read().decode(errors='replace').strip()
+        except Exception:
+            return ''
+
+    def close(self):
+        nothrow_killpg(pgid=self.process.pid)
+        if self.persistent:
+            remove_persistent_pgid(self.process.pid)
+        for f in (self.process.stdin, self.process.stdout, self._stderr):
+            try:
+                f.close()
+            except OSError:
+                pass
+        self.process.wait()
+
+
+class LeanReplPool:
+    """
+    A pool of REPL processes that have already loaded `header`.
+    Every submission is run as a command against the environment of the header,
+    so the (expensive) imports are only processed once per process.
+
+    A process is recycled (when released) after `max_uses` commands or when it uses more than `max_memory` bytes,
+    and is killed when a command hangs or fails.
+    """
+    def __init__(self, command_args: list[str], header: str, size: int = 1,
+            max_uses: int | None = None, max_memory: int | None = None,
+            start_timeout: float | None = None, pickle_path: str | None = None, cwd=None, env=None):
+        self.command_args = command_args
+        self.header = header
+        # a file with the environment of `header` pickled by the REPL, which is much faster to load than the header
+        self.pickle_path = pickle_path
+        self.size = max(size, 1)
+        self.max_uses = max_uses
+        self.max_memory = max_memory
+        self.start_timeout = start_timeout
+        self.cwd = cwd
+        self.env = env
+        self._idle: list[LeanRepl] = []
+        # the pool is shared by the threads of an async worker
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def _spawn(self) -> LeanRepl:
+        try:
+            repl = LeanRepl(self.command_args, cwd=self.cwd, env=self.env)
+        except OSError as e:
+            raise LeanReplError(f'Failed to start REPL: {e}')
+        # don't wait for the header here, so it is loaded while the worker is doing something else
+        try:
+            repl.load_header(self.header, self.pickle_path)
+        except LeanReplError:
+            repl.close()
+            raise
+        return repl
+
+    def _wait_ready(self, repl: LeanRepl) -> LeanRepl:
+        if repl.base_env is not None:
+            return repl
+        try:
+            repl.wait_header(self.start_timeout)
+        except LeanReplError:
+            repl.close()
+            if not self.pickle_path:
+                raise
+            # the pickled environment may be stale or broken. Elaborate the header instead.
+            logger.exception(f'Failed to load pickled header {self.pickle_path}. Falling back to elaborating the header.')
+            self.pickle_path = None
+            repl = self._spawn()
+            return self._wait_ready(repl)
+        return repl
+
+    def acquire(self) -> LeanRepl:
+        """Get a REPL that is ready to run commands against `base_env`"""
+        with self._lock:
+            while len(self._idle) < self.size:
+                self._idle.append(self._spawn())
+            repl = self._idle.pop(0)
+        if not repl.alive:
+            repl.close()
+            repl = self._spawn()
+        return self._wait_ready(repl)
+
+    def release(self, repl: LeanRepl, broken: bool = False):
+        """Return a REPL to the pool. A broken or exhausted one is replaced with a new process."""
+        if self.closed:
+            repl.close()
+            return
+        if (broken or not repl.alive
+                or (self.max_uses and repl.uses >= self.max_uses)
+                or (self.max_memory and repl.rss() > self.max_memory)):
+            repl.close()
+            try:
+                repl = self._spawn()
+            except LeanReplError:
+                # will retry in the next acquire
+                logger.exception('Failed to respawn REPL')
+                return
+        with self._lock:
+            self._idle.append(repl)
+
+    def close(self):
+        self.closed = True
+        with self._lock:
+            for repl in self._idle:
+                repl.close()
+            self._idle.clear()
+
+
+_pools: OrderedDict[tuple, LeanReplPool] = OrderedDict()
+_pools_lock = threading.Lock()
+
+
+def get_repl_pool(command_args: list[str], header: str, max_pools: int | None = None, **kwargs) -> LeanReplPool:
+    """
+    Get the pool of the current process for the command/header pair, creating it on the first use.
+    When there are more than `max_pools` pools (i.e. distinct headers), the least recently used one is closed.
+    """
+    key = (tuple(command_args), header)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = LeanReplPool(command_args, header, **kwargs)
+        _pools.move_to_end(key)
+        while max_pools and len(_pools) > max_pools:
+            _, pool = _pools.popitem(last=False)
+            pool.close()
+        return _pools[key]
+
+
+@functools.cache
+def repl_command(runtime_path: str | None, fallback_cl: str) -> tuple[list[str], dict[str, str] | None, str | None]:
+    """
+    Get the (args, env, cwd) to start a REPL.
+    The REPL binary resolved by bootstrap (saved in `runtime_path`) is executed directly if it is available,
+    which avoids starting a login shell and resolving the lake workspace for every REPL.
+    Otherwise `fallback_cl` is used.
+    """
+    if runtime_path and os.path.exists(runtime_path):
+        try:
+            with open(runtime_path) as f:
+                runtime = json.load(f)
+            if os.access(runtime['repl'], os.X_OK):
+                return [runtime['repl']], {**os.environ, **runtime['env']}, runtime['cwd']
+            logger.warning(f'REPL binary {runtime["repl"]} is not executable. Falling back to {fallback_cl}')
+        except (OSError, ValueError, KeyError):
+            logger.exception(f'Failed to load REPL runtime from {runtime_path}. Falling back to {fallback_cl}')
+    return shlex.split(fallback_cl), None, None
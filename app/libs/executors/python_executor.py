@@ -1,83 +1,180 @@
 from contextlib import contextmanager
+import json
+import dataclasses
+import logging
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import signal
 import tempfile
-import io
+import threading
 import shlex
+import time
+from typing import Any
 
-from .executor import ScriptExecutor, ProcessExecuteResult, TIMEOUT_EXIT_CODE
+from .executor import (
+    ScriptExecutor, ProcessExecuteResult, ProcessLimits, TIMEOUT_EXIT_CODE, OUTPUT_LIMIT_EXIT_CODE, DEFAULT_ERROR_LIMIT
+)
+from ..cgroup import CgroupSlot
+from ..workspace import Workspace
+from ..utils import nothrow_killpg, add_persistent_pgid, remove_persistent_pgid, set_running_pgid
 
 
-SCRIPT_ENDING_MARK = "@@E"
-DURATION_MARK = "@@D"
+logger = logging.getLogger(__name__)
 
 
-PRE_TEMPLATE = f"""
-def _exec_prepare():
-    import signal
-    import resource
-    import os
-    import time
+HARNESS_MARK = "@@H"
+# printed to stdout when a submission is killed by the timeout, which used to be printed by the submission itself
+TIMEOUT_MESSAGE = 'Suicide from timeout.'
 
-    # preventing multi-threading for numpy
-    os.environ['OPENBLAS_NUM_THREADS'] = '1'
 
-    def _exec_set_alarm_timeout(timeout):
-        signal.signal(signal.SIGALRM, _exec_time_exceeded)
-        signal.alarm(timeout)
+ZYGOTE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python_zygote.py')
+HARNESS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python_harness.py')
+with open(HARNESS_SCRIPT) as f:
+    HARNESS_SOURCE = f.read()
+# max time to wait for the zygote to fork a child, which includes the preloading for the first child
+_ZYGOTE_START_TIMEOUT = 60
+
+
+class ZygoteError(Exception):
+    pass
 
-    # checking time limit exceed
-    def _exec_time_exceeded(*_):
-        print('Suicide from timeout.', flush=True)
-        try:
-            os.killpg(0, signal.SIGKILL)  # sometime this can still fail
-        except Exception:
-            pass
-        try:
-            os.kill(0, signal.SIGKILL)  # sometime this can still fail
-        except Exception:
-            pass
-        os._exit({TIMEOUT_EXIT_CODE})  # may not run here.
 
-    def _exec_set_max_runtime(seconds):
-        # setting up the resource limit
-        soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
-        resource.setrlimit(resource.RLIMIT_CPU, (seconds, hard))
-        # Just use its default behavior to terminate the process.
-        # signal.signal(signal.SIGXCPU, _exec_time_exceeded)
+def _memory_file():
+    """An anonymous file in memory (memfd) for the stdio of a child, or a temporary file when memfd is not available"""
+    try:
+        return open(os.memfd_create('code-judge', os.MFD_CLOEXEC), 'w+b')
+    except (AttributeError, OSError):
+        return tempfile.TemporaryFile()
 
-    def _exec_limit_memory(maxsize):
-        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
-        resource.setrlimit(resource.RLIMIT_AS, (maxsize, hard))
 
-    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
-    if {{timeout}}:
-        _exec_set_alarm_timeout({{timeout}})
-        _exec_set_max_runtime({{timeout}})
+class PythonZygote:
+    """
+    A warm interpreter (see python_zygote.py) with `modules` imported,
+    which forks a child to run every submission, instead of starting a new interpreter.
+    """
+    def __init__(self, command_args: list[str], modules: list[str]):
+        self._sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self.process = subprocess.Popen(
+                [*command_args, ZYGOTE_SCRIPT, str(child_sock.fileno()), *modules],
+                pass_fds=[child_sock.fileno()], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                start_new_session=True
+            )
+        except OSError as e:
+            self._sock.close()
+            raise ZygoteError(f'Failed to start zygote: {e}')
+        finally:
+            child_sock.close()
+        add_persistent_pgid(self.process.pid)
 
-    if {{memory_limit}}:
-        _exec_limit_memory({{memory_limit}})
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
 
+    def _recv(self, timeout: float | None) -> dict:
+        self._sock.settimeout(timeout)
+        message = self._sock.recv(4096)
+        if not message:
+            raise ZygoteError('Zygote exited unexpectedly')
+        return json.loads(message)
 
-    return time.perf_counter()
+    def run(self, source_path: str, cwd: str, stdin: str | None = None, timeout: float | None = None,
+            cgroup_slot: CgroupSlot | None = None, output_limit: int | None = None,
+            error_limit: int | None = DEFAULT_ERROR_LIMIT, limits: ProcessLimits | None = None) -> ProcessExecuteResult:
+        """
+        Run the source file in a forked child with `limits`. Raise ZygoteError if the zygote is broken.
+        The files written by the child (including its stdout) are limited to `output_limit` bytes,
+        and the result is OUTPUT_LIMIT_EXIT_CODE when its stdout exceeds it.
+        """
+        with _memory_file() as stdin_file, _memory_file() as stdout_file, _memory_file() as stderr_file:
+            if stdin:
+                stdin_file.write(stdin.encode())
+                stdin_file.seek(0)
+            time_start = time.perf_counter()
+            slot_start = cgroup_slot.stats() if cgroup_slot else None
+            slot_usage = {}
+            try:
+                request = {'source': source_path, 'cwd': cwd}
+                if cgroup_slot:
+                    request['cgroup'] = cgroup_slot.procs
+                if output_limit is not None:
+                    # one more byte to tell the output over the limit
+                    request['max_file_size'] = output_limit + 1
+                if limits:
+                    request['limits'] = dataclasses.asdict(limits)
+                socket.send_fds(
+                    self._sock, [json.dumps(request).encode()],
+                    [stdin_file.fileno(), stdout_file.fileno(), stderr_file.fileno()]
+                )
+                pid = self._recv(_ZYGOTE_START_TIMEOUT)['pid']
+            except (OSError, ValueError) as e:
+                raise ZygoteError(f'Failed to fork from zygote: {e}')
+            # the child is in a new session, so the worker can kill it when it hangs
+            set_running_pgid(pid)
+            try:
+                reply = self._recv(timeout)
+                exit_code = reply['exit_code']
+            except TimeoutError:
+                nothrow_killpg(pgid=pid)
+                try:
+                    reply = self._recv(_ZYGOTE_START_TIMEOUT)
+                except (OSError, ValueError) as e:
+                    raise ZygoteError(f'Failed to wait for the child of zygote: {e}')
+                exit_code = TIMEOUT_EXIT_CODE
+            except (OSError, ValueError) as e:
+                nothrow_killpg(pgid=pid)
+                raise ZygoteError(f'Failed to wait for the child of zygote: {e}')
+            finally:
+                set_running_pgid(None)
+                if cgroup_slot:
+                    slot_usage = cgroup_slot.usage(slot_start)
+                    cgroup_slot.kill()
+            cost = time.perf_counter() - time_start
+            if output_limit is not None and os.fstat(stdout_file.fileno()).st_size > output_limit:
+                exit_code = OUTPUT_LIMIT_EXIT_CODE
+            stdout_file.seek(0)
+            stderr_file.seek(0)
+            return ProcessExecuteResult(
+                stdout=stdout_file.read(output_limit if output_limit is not None else -1).decode(errors='replace'),
+                stderr=stderr_file.read(error_limit if error_limit is not None else -1).decode(errors='replace'),
+                exit_code=exit_code,
+                cost=cost,
+                # the resource usage of the slot, or else of the child from wait4 in the zygote
+                user_time=slot_usage.get('user_time', reply.get('user_time')),
+                sys_time=slot_usage.get('sys_time', reply.get('sys_time')),
+                memory_peak=slot_usage.get('memory_peak', reply.get('max_rss')),
+            )
 
-_exec_time_start = _exec_prepare()
+    def close(self):
+        nothrow_killpg(pgid=self.process.pid)
+        remove_persistent_pgid(self.process.pid)
+        self._sock.close()
+        self.process.wait()
 
-""".strip()
 
-POST_TEMPLATE = f"""
+# the zygotes of every thread, as a zygote runs one child at a time
+_local = threading.local()
 
-def _exec_end():
-    import time
-    _exec_time_end = time.perf_counter()
-    _exec_duration = _exec_time_end - _exec_time_start
-    print("{SCRIPT_ENDING_MARK}")
-    print(f"{DURATION_MARK}{{_exec_duration}}", flush=True)
 
-_exec_end()
+def get_zygote(command_args: list[str], modules: list[str]) -> PythonZygote:
+    """Get the zygote of the current thread for the command/modules pair, (re)starting it when needed."""
+    zygotes: dict[tuple, PythonZygote] = _local.__dict__.setdefault('zygotes', {})
+    key = (tuple(command_args), tuple(modules))
+    zygote = zygotes.get(key)
+    if zygote is None or not zygote.alive:
+        if zygote is not None:
+            zygote.close()
+        zygote = zygotes[key] = PythonZygote(command_args, modules)
+    return zygote
 
-""".strip()
 
 class PythonExecutor(ScriptExecutor):
-    def __init__(self, run_cl: str, timeout: int = None, memory_limit: int = None, cpu_core: int = None):
+    def __init__(self, run_cl: str, timeout: int = None, memory_limit: int = None, cpu_core: int = None,
+            zygote: PythonZygote | None = None, cgroup_slot: CgroupSlot | None = None,
+            output_limit: int | None = None, workspace: Workspace | None = None):
         self.timeout = timeout
         self.memory_limit = (
             memory_limit + 128 * 1024 * 1024  # extra 128MB for python overhead
@@ -86,22 +183,113 @@ class PythonExecutor(ScriptExecutor):
         )
         self.run_cl = run_cl
         self.cpu_core = cpu_core
+        # when set, the submission is run in a child forked from the zygote instead of with `run_cl`
+        self.zygote = zygote
+        self.cgroup_slot = cgroup_slot
+        if output_limit is not None:
+            self.output_limit = output_limit
+        self.workspace = workspace
 
-    def setup_command(self, tmp_path: str, script: str):
+    def _write_source(self, tmp_path: str, script: str) -> str:
+        # the script is run as it is, the limits are set by the parent (see command_limits)
         source_path = f"{tmp_path}/source.py"
         with open(source_path, mode='w') as f:
-            f.write(PRE_TEMPLATE.format(timeout=self.timeout, memory_limit=self.memory_limit))
-            f.write("\n")
             f.write(script)
-            f.write("\n")
-            f.write(POST_TEMPLATE)
-            f.flush()
+        return source_path
+
+    def command_limits(self, step):
+        return ProcessLimits(timeout=self.timeout, cpu_time=self.timeout, memory=self.memory_limit)
+
+    def command_env(self, step):
+        # preventing multi-threading for numpy
+        return {**os.environ, 'OPENBLAS_NUM_THREADS': '1'}
+
+    def execute_cases(self, script, stdins, timeout=None, stop=None, expected_outputs=None):
+        if self.zygote is None:
+            return super().execute_cases(script, stdins, timeout, stop, expected_outputs)
+        # the output of a forked child is only compared after it exits
+        # add 1 second to timeout as the overhead of the pre/post processing
+        run_timeout = timeout + 1 if timeout else None
+        results = []
+        with self._workspace() as tmp_path:
+            source_path = self._write_source(tmp_path, script)
+            for stdin in stdins:
+                if results and stop and stop(len(results) - 1, results[-1]):
+                    break
+                if self.cgroup_slot:
+                    self.configure_slot()
+                try:
+                    result = self.zygote.run(
+                        source_path, tmp_path, stdin, run_timeout, self.cgroup_slot, self.output_limit, self.error_limit,
+                        self.command_limits(0)
+                    )
+                except ZygoteError:
+                    logger.exception('Zygote failed. Falling back to a new interpreter.')
+                    self.zygote.close()
+                    self.zygote = None
+                    return results + super().execute_cases(
+                        script, stdins[len(results):], timeout, stop,
+                        expected_outputs and expected_outputs[len(results):]
+                    )
+                results.append(self.process_result(result))
+        return results
+
+    def execute_harness(self, script: str, entry_point: str, cases: list[tuple[Any, Any]],
+            timeout: float | None = None, stop_on_failure: bool = False) -> list[ProcessExecuteResult]:
+        """
+        Call `entry_point` of the script with the arguments (a list or a dict) of every case in one interpreter,
+        and compare the return value with the expected value (None to skip) of the case. See python_harness.py.
+        `timeout` is per case, while the limits of the executor apply to the whole run.
+        Return the result of every case run, with the return value as json in stdout.
+        """
+        harness_script = '\n'.join([
+            HARNESS_SOURCE,
+            f'_exec_run_harness({entry_point!r}, {timeout!r}, {stop_on_failure!r}, {HARNESS_MARK!r}, {script!r})',
+        ])
+        # only the result lines with the nonce of the run are taken, as the submission can print the mark too
+        mark = HARNESS_MARK + secrets.token_hex(16)
+        stdin = json.dumps({
+            'nonce': mark[len(HARNESS_MARK):],
+            'cases': [{'args': args, 'expected': expected} for args, expected in cases],
+        })
+        result = self.execute_script(harness_script, stdin, self.timeout)
+        results = []
+        stopped = False
+        for line in result.stdout.splitlines():
+            if mark not in line:
+                continue
+            # the output of the submission may not end with a new line
+            case = json.loads(line[line.index(mark) + len(mark):])
+            stopped = stop_on_failure and not case['passed']
+            results.append(ProcessExecuteResult(
+                stdout=case.get('output', ''),
+                stderr=case.get('error', ''),
+                exit_code=TIMEOUT_EXIT_CODE if case.get('timeout') else 0 if 'output' in case else 1,
+                cost=case['cost'],
+                matched=case['passed'] if 'output' in case else None,
+            ))
+        if len(results) < len(cases) and not stopped:
+            # the interpreter failed, e.g. a syntax error, or killed by the limits
+            output = '\n'.join(line.split(mark)[0] for line in result.stdout.splitlines() if not line.startswith(mark))
+            results.append(ProcessExecuteResult(
+                stdout=output, stderr=result.stderr, exit_code=result.exit_code or 1,
+                cost=max(result.cost - sum(r.cost for r in results), 0)
+            ))
+        return results
+
+    def setup_command(self, tmp_path: str, script: str):
+        source_path = self._write_source(tmp_path, script)
 
         python_cmd =  shlex.split(self.run_cl.format(
             source=shlex.quote(source_path),
             workdir=shlex.quote(str(tmp_path))
         ))
 
+        if self.cgroup_slot:
+            # the limits are set on the slot, and the command enters it before exec
+            yield python_cmd
+            return
+
         quota = int(round(self.cpu_core * 100))
         systemd_prefix = [
             "systemd-run", "--user", "--scope", "--quiet",
@@ -112,10 +300,10 @@ class PythonExecutor(ScriptExecutor):
         yield cmd
 
     def process_result(self, result):
-        if SCRIPT_ENDING_MARK in result.stdout:
-            result.stdout, meta_info = result.stdout.split(SCRIPT_ENDING_MARK, 2)
-            for line in io.StringIO(meta_info):
-                if line.startswith(DURATION_MARK):
-                    result.cost = float(line[len(DURATION_MARK):])
-                    break
+        if result.exit_code == -signal.SIGALRM:
+            # killed by the timer of command_limits
+            result.exit_code = TIMEOUT_EXIT_CODE
+            result.success = False
+        if result.exit_code == TIMEOUT_EXIT_CODE:
+            result.stdout += f'{TIMEOUT_MESSAGE}\n'
         return result
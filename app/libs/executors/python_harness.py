@@ -0,0 +1,205 @@
+"""
+The function-call harness run with the source of a python submission with an entry point.
+
+The run is read from stdin as json: {"nonce": "...", "cases": [{"args": [...] or {...}, "expected": <json value> or null}]}.
+The source of the submission is executed in a child process forked before the run is read,
+so the submission has no way to the nonce or the expected values: not in its memory, and not in the stdin of the parent.
+The parent sends the arguments of every case to the child, which calls the entry point (e.g. `solve` or `Solution.twoSum`,
+whose class is instantiated per case) in the same interpreter, with a per-case timeout, and returns the value as json.
+The parent compares it with the expected value and prints the result of every case as a json line after the mark and the nonce,
+so the lines printed by the submission itself are not taken as results.
+
+Only the standard library can be used here, as it is run in the submission.
+Everything is defined in `_exec_run_harness`, so the names of the submission are not shadowed.
+"""
+
+
+def _exec_run_harness(entry_point, timeout, stop_on_failure, mark, source):
+    import json
+    import linecache
+    import math
+    import os
+    import signal
+    import sys
+    import time
+    import traceback
+
+    class _Timeout(BaseException):
+        pass
+
+    def prctl(option, value):
+        try:
+            import ctypes
+            ctypes.CDLL(None, use_errno=True).prctl(option, value, 0, 0, 0)
+        except (ImportError, OSError, AttributeError):
+            pass
+
+    def serve_cases(args_read, results_write, run_left):
+        """Run in the child: load the source, and call the entry point with the arguments of every case sent by the parent"""
+        run_deadline = time.monotonic() + run_left if run_left else None
+
+        def on_alarm(*_):
+            if run_deadline is not None and time.monotonic() >= run_deadline - 0.01:
+                # killed by the timer of the whole run, as without the harness
+                signal.signal(signal.SIGALRM, signal.SIG_DFL)
+                os.kill(os.getpid(), signal.SIGALRM)
+            raise _Timeout()
+
+        def set_timer(seconds):
+            # the timer of a case (or 0 between the cases) never goes past the end of the whole run
+            if run_deadline is not None:
+                left = max(run_deadline - time.monotonic(), 1e-6)
+                seconds = min(seconds, left) if seconds else left
+            signal.setitimer(signal.ITIMER_REAL, seconds)
+
+        def to_json(value):
+            def default(o):
+                if isinstance(o, (set, frozenset)):
+                    return sorted(o, key=repr)
+                return repr(o)
+            return json.dumps(value, default=default, ensure_ascii=False, sort_keys=True)
+
+        def resolve():
+            names = entry_point.split('.')
+            target = globals()[names[0]]
+            if isinstance(target, type) and len(names) > 1:
+                # a fresh instance per case, like LeetCode
+                target = target()
+            for name in names[1:]:
+                target = getattr(target, name)
+            return target
+
+        def print_exception(e):
+            # hide the frames of the harness
+            tb = e.__traceback__
+            while tb is not None and tb.tb_frame.f_code.co_name in ('_exec_run_harness', 'serve_cases', 'resolve'):
+                tb = tb.tb_next
+            return ''.join(traceback.format_exception(type(e), e, tb))
+
+        signal.signal(signal.SIGALRM, on_alarm)
+        set_timer(0)
+        # the source is shown in the tracebacks with its own line numbers. The file doesn't exist,
+        # otherwise the lines of a syntax error are read from it (i.e. the harness)
+        filename = os.path.join(os.path.dirname(globals().get('__file__', '')), 'solution.py')
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+        try:
+            exec(compile(source, filename, 'exec'), globals())
+        except Exception as e:
+            print(print_exception(e), end='', file=sys.stderr)
+            return 1
+
+        with os.fdopen(args_read) as args_file, os.fdopen(results_write, 'w') as results_file:
+            for line in args_file:
+                args = json.loads(line)
+                try:
+                    set_timer(timeout or 0)
+                    try:
+                        value = resolve()(**args) if isinstance(args, dict) else resolve()(*args)
+                    finally:
+                        set_timer(0)
+                    result = {'output': to_json(value)}
+                except _Timeout:
+                    result = {'timeout': True}
+                except Exception as e:
+                    result = {'error': print_exception(e)}
+                # the output of the case is before its result
+                sys.stdout.flush()
+                sys.stderr.flush()
+                results_file.write(json.dumps(result) + '\n')
+                results_file.flush()
+        return 0
+
+    # the memory and the stdin of the parent (/proc/<pid>/mem and /proc/<pid>/fd/0) can't be opened by the child
+    prctl(4, 0)  # PR_SET_DUMPABLE
+
+    # the interval timer of the whole run (see ProcessLimits), which is not inherited by the child
+    run_left, _ = signal.getitimer(signal.ITIMER_REAL)
+
+    args_read, args_write = os.pipe()
+    results_read, results_write = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        os.close(args_write)
+        os.close(results_read)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        # the child is not killed by the timer of the parent
+        prctl(1, signal.SIGKILL)  # PR_SET_PDEATHSIG
+        # only the parent has to be protected
+        prctl(4, 1)
+        exit_code = 1
+        try:
+            exit_code = serve_cases(args_read, results_write, run_left)
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+        except BaseException as e:
+            traceback.print_exception(type(e), e, e.__traceback__)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+    os.close(args_read)
+    os.close(results_write)
+
+    # read only after the child is forked
+    run = json.loads(sys.stdin.read())
+    mark = mark + run['nonce']
+    cases = run['cases']
+
+    def equal(a, b):
+        if isinstance(a, bool) or isinstance(b, bool):
+            return a is b
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+            return math.isclose(a, b, rel_tol=1e-6, abs_tol=1e-9)
+        if isinstance(a, list) and isinstance(b, list):
+            return len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+        if isinstance(a, dict) and isinstance(b, dict):
+            return a.keys() == b.keys() and all(equal(a[k], b[k]) for k in a)
+        return a == b
+
+    def send(data):
+        # the arguments may be larger than the buffer of the pipe
+        while data:
+            data = data[os.write(args_write, data):]
+
+    def check(output, expected):
+        try:
+            return expected is None or equal(json.loads(output), expected)
+        except ValueError:
+            return False
+
+    stopped = False
+    with os.fdopen(results_read) as results_file:
+        for case in cases:
+            start = time.perf_counter()
+            try:
+                send((json.dumps(case['args']) + '\n').encode())
+            except BrokenPipeError:
+                break
+            line = results_file.readline()
+            if not line:
+                # the child is gone, e.g. the source failed to load or the submission exited
+                break
+            value = json.loads(line)
+            if 'output' in value:
+                result = {'output': str(value['output']), 'passed': check(value['output'], case.get('expected'))}
+            elif value.get('timeout'):
+                result = {'timeout': True, 'passed': False}
+            else:
+                result = {'error': str(value.get('error', '')), 'passed': False}
+            result['cost'] = time.perf_counter() - start
+            print(mark + json.dumps(result), flush=True)
+            if stop_on_failure and not result['passed']:
+                stopped = True
+                break
+    os.close(args_write)
+    # the child exits when the arguments are closed
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status) and not stopped:
+        # e.g. killed by the timer of the whole run, as without the harness
+        signal.signal(os.WTERMSIG(status), signal.SIG_DFL)
+        os.kill(os.getpid(), os.WTERMSIG(status))
+    sys.exit(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1)
@@ -0,0 +1,124 @@
+"""
+A warm python interpreter which forks a child per submission.
+
+Usage: python python_zygote.py <socket fd> [module ...]
+
+The modules are imported once in the zygote, so the children don't pay for the interpreter startup and the imports.
+For every request (a json message with 3 fds: stdin, stdout, stderr) received from the socket,
+a child is forked in a new session (and cgroup if given) and runs the source file as `__main__`.
+The zygote replies with the pid of the child, and then its exit code when it exits.
+
+Only the standard library can be used here, as it is not run in the app.
+"""
+import importlib
+import json
+import math
+import os
+import resource
+import runpy
+import signal
+import socket
+import sys
+import traceback
+
+
+# same as the environment of the python executor. It must be set before numpy is imported.
+os.environ['OPENBLAS_NUM_THREADS'] = '1'
+
+_MAX_MESSAGE_SIZE = 65536
+
+
+def _run_child(request: dict, fds: list[int], sock: socket.socket):
+    # the child is killed with its process group when it hangs
+    os.setsid()
+    sock.close()
+    for target, fd in enumerate(fds):
+        if fd != target:
+            os.dup2(fd, target)
+            os.close(fd)
+    exit_code = 0
+    try:
+        if 'cgroup' in request:
+            # move into the cgroup slot with the limits of the submission
+            with open(request['cgroup'], 'w') as f:
+                f.write('0')
+        if 'limits' in request:
+            # the same as exec_limits.py
+            limits = request['limits']
+            resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+            if limits['cpu_time']:
+                _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+                resource.setrlimit(resource.RLIMIT_CPU, (int(math.ceil(limits['cpu_time'])), hard))
+            if limits['memory']:
+                _, hard = resource.getrlimit(resource.RLIMIT_AS)
+                resource.setrlimit(resource.RLIMIT_AS, (limits['memory'], hard))
+            if limits['timeout']:
+                signal.setitimer(signal.ITIMER_REAL, limits['timeout'])
+        if 'max_file_size' in request:
+            # the output files are written directly, so they are limited with SIGXFSZ instead of by the reader
+            resource.setrlimit(resource.RLIMIT_FSIZE, (request['max_file_size'], request['max_file_size']))
+        os.chdir(request['cwd'])
+        sys.argv = [request['source']]
+        sys.path[0] = request['cwd']
+        runpy.run_path(request['source'], run_name='__main__')
+    except SystemExit as e:
+        if isinstance(e.code, int) or e.code is None:
+            exit_code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException as e:
+        # hide the frames of the zygote, like the traceback printed by the interpreter
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename != request['source']:
+            tb = tb.tb_next
+        traceback.print_exception(type(e), e, tb or e.__traceback__)
+        exit_code = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(exit_code)
+
+
+def serve(sock: socket.socket):
+    while True:
+        try:
+            message, fds, _, _ = socket.recv_fds(sock, _MAX_MESSAGE_SIZE, 3)
+        except (ConnectionError, OSError):
+            return
+        if not message:
+            # the worker is gone
+            return
+        request = json.loads(message)
+        pid = os.fork()
+        if pid == 0:
+            _run_child(request, fds, sock)
+        for fd in fds:
+            os.close(fd)
+        sock.send(json.dumps({'pid': pid}).encode())
+        _, status, rusage = os.wait4(pid, 0)
+        sock.send(json.dumps({
+            'pid': pid,
+            'exit_code': os.waitstatus_to_exitcode(status),
+            'user_time': rusage.ru_utime,
+            'sys_time': rusage.ru_stime,
+            'max_rss': rusage.ru_maxrss * 1024,
+        }).encode())
+
+
+def main():
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    # don't import from the directory of this file
+    sys.path[0] = ''
+    for module in sys.argv[2:]:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            print(f'Failed to preload {module}', file=sys.stderr)
+            traceback.print_exc()
+    serve(sock)
+
+
+if __name__ == '__main__':
+    main()
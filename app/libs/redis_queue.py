@@ -1,6 +1,7 @@
+import asyncio
 import logging
 from typing import Awaitable
-from time import time
+from time import sleep, time
 
 import redis
 import socket
@@ -107,8 +108,11 @@ class RedisQueue:
         def push(self, queue_name, key_score_dict: dict[str, float]):
             return self.rq.redis.zadd(queue_name, key_score_dict)
 
-        def pop(self, queue_name)-> tuple[bytes, float] | Awaitable[tuple[bytes, float]] | None | Awaitable[None]:
-            return self.rq.redis.zpopmin(queue_name)
+        def pop(self, queue_name, count=None)-> list[tuple[bytes, float]] | Awaitable[list[tuple[bytes, float]]]:
+            return self.rq.redis.zpopmin(queue_name, count)
+
+        def remove(self, queue_name, *keys):
+            return self.rq.redis.zrem(queue_name, *keys)
 
         def pop_multi(self, *queue_names):
             if not queue_names:
@@ -150,7 +154,535 @@ class RedisQueue:
         def len(self, queue_name):
             return self.rq.redis.zcard(queue_name)
 
-    def __init__(self, redis_uri, *, socket_timeout: int = None, is_async: bool = False):
+    class IndexedQueueOp:
+        """
+        A priority queue of compact ids (e.g. work ids) in a sorted set, whose payloads are kept in the hash `payloads_name`,
+        so the cost of the queue operations doesn't depend on the size of the payloads.
+        A payload is removed with its id when it is popped, so nothing is left if the popper dies,
+        and is put back with its id by `requeue`. An id whose payload is gone (e.g. discarded) is dropped when it is popped.
+        """
+        # KEYS: queue, payloads, *unindexed queues; ARGV: count
+        # The unindexed queues (whose members are the payloads) are tried first, and one member is popped from them.
+        # Returns the popped payloads, scores and ids (empty for the unindexed members), flattened.
+        POP_SCRIPT = """
+            for i = 3, #KEYS do
+                local items = redis.call('ZPOPMIN', KEYS[i])
+                if #items > 0 then
+                    return {items[1], items[2], ''}
+                end
+            end
+            local popped = {}
+            repeat
+                local items = redis.call('ZPOPMIN', KEYS[1], ARGV[1])
+                for i = 1, #items, 2 do
+                    local payload = redis.call('HGET', KEYS[2], items[i])
+                    if payload then
+                        redis.call('HDEL', KEYS[2], items[i])
+                        table.insert(popped, payload)
+                        table.insert(popped, items[i + 1])
+                        table.insert(popped, items[i])
+                    end
+                end
+            until #popped > 0 or #items == 0
+            return popped
+        """
+
+        # KEYS: payloads; ARGV: id
+        # Returns the payload of an id popped with BZPOPMIN, which is removed with it.
+        TAKE_SCRIPT = """
+            local payload = redis.call('HGET', KEYS[1], ARGV[1])
+            if payload then
+                redis.call('HDEL', KEYS[1], ARGV[1])
+            end
+            return payload
+        """
+
+        def __init__(self, rq: 'RedisQueue'):
+            self.rq = rq
+            self._pop_script = rq.redis.register_script(self.POP_SCRIPT)
+            self._take_script = rq.redis.register_script(self.TAKE_SCRIPT)
+
+        @staticmethod
+        def _items(result) -> list[tuple[bytes, float, bytes | None]]:
+            return [(result[i], float(result[i + 1]), result[i + 2] or None) for i in range(0, len(result), 3)]
+
+        def push(self, queue_name, key_score_dict: dict[str, float], payloads: dict[str, str]):
+            """Add the ids of `key_score_dict` with their scores, and their `payloads` by id"""
+            pp = self.rq.redis.pipeline(transaction=False)
+            # the payloads are stored before their ids can be popped
+            pp.hset(self.rq.payloads_name(queue_name), mapping=payloads)
+            pp.zadd(queue_name, key_score_dict)
+            return pp.execute()
+
+        def peak(self, queue_name) -> tuple[bytes, float] | Awaitable[tuple[bytes, float]] | None | Awaitable[None]:
+            """The (id, score) of the next item"""
+            return self.rq.pqueue.peak(queue_name)
+
+        def len(self, queue_name):
+            return self.rq.redis.zcard(queue_name)
+
+        def _pop_sync(self, queue_name, count, timeout, unindexed_queue_names):
+            keys = [queue_name, self.rq.payloads_name(queue_name), *unindexed_queue_names]
+            start = time()
+            while True:
+                items = self._items(self._pop_script(keys=keys, args=[count]))
+                if items:
+                    return items
+                effective_timeout = self.rq._get_proper_timeout(start, timeout)
+                if effective_timeout <= 0:
+                    return []
+                # a script can't block, so an empty queue is waited on without it,
+                # and the payload of the popped id is taken in another round trip
+                popped = self.rq.redis.bzpopmin([*unindexed_queue_names, queue_name], timeout=effective_timeout)
+                if not popped:
+                    continue
+                popped_queue_name, member, score = popped
+                if popped_queue_name not in (queue_name, queue_name.encode()):
+                    return [(member, score, None)]
+                payload = self._take_script(keys=[keys[1]], args=[member])
+                if payload is not None:
+                    return [(payload, score, member)]
+
+        async def _pop_async(self, queue_name, count, timeout, unindexed_queue_names):
+            keys = [queue_name, self.rq.payloads_name(queue_name), *unindexed_queue_names]
+            start = time()
+            while True:
+                items = self._items(await self._pop_script(keys=keys, args=[count]))
+                if items:
+                    return items
+                effective_timeout = self.rq._get_proper_timeout(start, timeout)
+                if effective_timeout <= 0:
+                    return []
+                popped = await self.rq.redis.bzpopmin([*unindexed_queue_names, queue_name], timeout=effective_timeout)
+                if not popped:
+                    continue
+                popped_queue_name, member, score = popped
+                if popped_queue_name not in (queue_name, queue_name.encode()):
+                    return [(member, score, None)]
+                payload = await self._take_script(keys=[keys[1]], args=[member])
+                if payload is not None:
+                    return [(payload, score, member)]
+
+        def pop(self, queue_name, *, count=1, timeout=0, unindexed_queue_names=()):
+            """
+            Pop up to `count` items of `queue_name` with their payloads in one round trip,
+            or one member of the first non-empty priority queue of `unindexed_queue_names`, waiting up to `timeout` seconds.
+            Returns the [(payload, score, id)], where the ids of the unindexed members are None.
+            """
+            if self.rq.is_async:
+                return self._pop_async(queue_name, count, timeout, unindexed_queue_names)
+            else:
+                return self._pop_sync(queue_name, count, timeout, unindexed_queue_names)
+
+        def release(self, queue_name, *ids, pipeline=None):
+            """
+            Release the popped `ids`, e.g. when their results are pushed (see LeaseOp.release).
+            Nothing is left to remove, as the payloads are removed by the pop.
+            """
+            return None
+
+        def requeue(self, queue_name, items: list[tuple[bytes, float, bytes]]):
+            """Put the popped (payload, score, id) `items` back with their payloads"""
+            pp = self.rq.redis.pipeline(transaction=False)
+            # the payloads are stored before their ids can be popped
+            pp.hset(self.rq.payloads_name(queue_name), mapping={item_id: payload for payload, _, item_id in items})
+            pp.zadd(queue_name, {item_id: score for _, score, item_id in items})
+            return pp.execute()
+
+        def discard(self, queue_name, *ids):
+            """Remove the items of `ids` with their payloads, whether they are popped or not"""
+            pp = self.rq.redis.pipeline(transaction=False)
+            pp.zrem(queue_name, *ids)
+            pp.hdel(self.rq.payloads_name(queue_name), *ids)
+            return pp.execute()
+
+    class LeaseOp:
+        """
+        Leased pops from an indexed queue (see IndexedQueueOp): a popped id is moved atomically to an in-flight sorted set of its owner,
+        scored by the deadline of its lease, until it is released with its payload. Expired leases are put back by `requeue`.
+        The original scores are kept in the hash `<inflight>:scores`, and the owners with leases in the set `registry`.
+        The keys of a lease must be in the same redis cluster slot as the queue (e.g. with a hash tag).
+        """
+        # an empty queue is polled with these intervals, as a leased pop can't block
+        MIN_POLL_INTERVAL = 0.01
+        MAX_POLL_INTERVAL = 0.2
+
+        # KEYS: queue, payloads, inflight, scores, registry, *unleased queues; ARGV: owner, count, lease time
+        # The unleased queues (whose members are the payloads) are tried first, and one member is popped from them without a lease.
+        # Returns the popped payloads, scores and ids (empty for the unleased members), flattened.
+        POP_SCRIPT = """
+            for i = 6, #KEYS do
+                local items = redis.call('ZPOPMIN', KEYS[i])
+                if #items > 0 then
+                    return {items[1], items[2], ''}
+                end
+            end
+            local now = redis.call('TIME')
+            local deadline = tonumber(now[1]) + tonumber(now[2]) / 1000000 + tonumber(ARGV[3])
+            local popped = {}
+            repeat
+                local items = redis.call('ZPOPMIN', KEYS[1], ARGV[2])
+                for i = 1, #items, 2 do
+                    local payload = redis.call('HGET', KEYS[2], items[i])
+                    if payload then
+                        redis.call('ZADD', KEYS[3], deadline, items[i])
+                        redis.call('HSET', KEYS[4], items[i], items[i + 1])
+                        table.insert(popped, payload)
+                        table.insert(popped, items[i + 1])
+                        table.insert(popped, items[i])
+                    end
+                end
+            until #popped > 0 or #items == 0
+            if #popped > 0 then
+                redis.call('SADD', KEYS[5], ARGV[1])
+            end
+            return popped
+        """
+
+        # KEYS: inflight; ARGV: lease time, member
+        RENEW_SCRIPT = """
+            local now = redis.call('TIME')
+            return redis.call('ZADD', KEYS[1], 'XX', 'CH', tonumber(now[1]) + tonumber(now[2]) / 1000000 + tonumber(ARGV[1]), ARGV[2])
+        """
+
+        # KEYS: inflight, scores, new inflight, new scores, registry; ARGV: new owner, lease time, member
+        # Returns 1 if the lease is moved, or 0 if it is gone.
+        TRANSFER_SCRIPT = """
+            local score = redis.call('HGET', KEYS[2], ARGV[3])
+            if not score or redis.call('ZREM', KEYS[1], ARGV[3]) == 0 then
+                return 0
+            end
+            redis.call('HDEL', KEYS[2], ARGV[3])
+            local now = redis.call('TIME')
+            redis.call('ZADD', KEYS[3], tonumber(now[1]) + tonumber(now[2]) / 1000000 + tonumber(ARGV[2]), ARGV[3])
+            redis.call('HSET', KEYS[4], ARGV[3], score)
+            redis.call('SADD', KEYS[5], ARGV[1])
+            return 1
+        """
+
+        # KEYS: queue, payloads, inflight, scores, registry; ARGV: owner, mode ('expired', 'all' or 'members'), *members
+        # Returns the number of members put back to the queue.
+        REQUEUE_SCRIPT = """
+            local members
+            if ARGV[2] == 'expired' then
+                local now = redis.call('TIME')
+                members = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', tonumber(now[1]) + tonumber(now[2]) / 1000000)
+            elseif ARGV[2] == 'all' then
+                members = redis.call('ZRANGE', KEYS[3], 0, -1)
+            else
+                members = {unpack(ARGV, 3)}
+            end
+            local requeued = 0
+            for _, member in ipairs(members) do
+                local score = redis.call('HGET', KEYS[4], member)
+                if score and redis.call('ZREM', KEYS[3], member) == 1 then
+                    redis.call('ZADD', KEYS[1], score, member)
+                    requeued = requeued + 1
+                end
+                redis.call('HDEL', KEYS[4], member)
+            end
+            if redis.call('ZCARD', KEYS[3]) == 0 then
+                redis.call('SREM', KEYS[5], ARGV[1])
+            end
+            return requeued
+        """
+
+        def __init__(self, rq: 'RedisQueue'):
+            self.rq = rq
+            self._pop_script = rq.redis.register_script(self.POP_SCRIPT)
+            self._renew_script = rq.redis.register_script(self.RENEW_SCRIPT)
+            self._requeue_script = rq.redis.register_script(self.REQUEUE_SCRIPT)
+            self._transfer_script = rq.redis.register_script(self.TRANSFER_SCRIPT)
+
+        def _keys(self, queue_name, inflight_name, registry_name):
+            return [queue_name, self.rq.payloads_name(queue_name), inflight_name, f'{inflight_name}:scores', registry_name]
+
+        def pop(self, queue_name, inflight_name, registry_name, owner, *, count=1, lease_time=60, unleased_queue_names=()):
+            """
+            Pop up to `count` items of `queue_name` with their payloads, leased to `owner` for `lease_time` seconds,
+            or one member of the first non-empty `unleased_queue_names` without a lease.
+            Returns the [(payload, score, id)], where the ids of the unleased members are None.
+            """
+            keys = self._keys(queue_name, inflight_name, registry_name) + list(unleased_queue_names)
+            result = self._pop_script(keys=keys, args=[owner, count, lease_time])
+            if self.rq.is_async:
+                async def _result():
+                    return RedisQueue.IndexedQueueOp._items(await result)
+                return _result()
+            return RedisQueue.IndexedQueueOp._items(result)
+
+        def _block_pop_sync(self, *args, timeout=0, **kwargs):
+            start = time()
+            interval = self.MIN_POLL_INTERVAL
+            while True:
+                result = self.pop(*args, **kwargs)
+                if result or time() - start >= timeout:
+                    return result
+                sleep(interval)
+                interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+
+        async def _block_pop_async(self, *args, timeout=0, **kwargs):
+            start = time()
+            interval = self.MIN_POLL_INTERVAL
+            while True:
+                result = await self.pop(*args, **kwargs)
+                if result or time() - start >= timeout:
+                    return result
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+
+        def block_pop(self, queue_name, inflight_name, registry_name, owner, *, timeout, **kwargs):
+            """`pop`, waiting up to `timeout` seconds for a member"""
+            if self.rq.is_async:
+                return self._block_pop_async(queue_name, inflight_name, registry_name, owner, timeout=timeout, **kwargs)
+            else:
+                return self._block_pop_sync(queue_name, inflight_name, registry_name, owner, timeout=timeout, **kwargs)
+
+        def renew(self, inflight_name, member, lease_time):
+            """Extend the lease of `member` to `lease_time` seconds from now"""
+            return self._renew_script(keys=[inflight_name], args=[lease_time, member])
+
+        def transfer(self, inflight_name, new_inflight_name, registry_name, new_owner, member, lease_time):
+            """
+            Move the lease of `member` to `new_owner` for `lease_time` seconds from now, keeping its original score.
+            Returns 0 if the lease is gone, e.g. it was released or put back.
+            """
+            return self._transfer_script(
+                keys=[inflight_name, f'{inflight_name}:scores', new_inflight_name, f'{new_inflight_name}:scores', registry_name],
+                args=[new_owner, lease_time, member]
+            )
+
+        def release(self, queue_name, inflight_name, *members, pipeline=None):
+            """
+            Remove the leases of `members` with their payloads, e.g. when their results are pushed.
+            The commands are added to `pipeline` if given.
+            """
+            pp = pipeline if pipeline is not None else self.rq.redis.pipeline(transaction=False)
+            pp.zrem(inflight_name, *members)
+            pp.hdel(f'{inflight_name}:scores', *members)
+            pp.hdel(self.rq.payloads_name(queue_name), *members)
+            if pipeline is None:
+                return pp.execute()
+
+        def requeue(self, queue_name, inflight_name, registry_name, owner, *members, expired_only=True):
+            """
+            Put the leased `members` (or else all expired leases, or all leases with `expired_only=False`) of `owner`
+            back to `queue_name` with their original scores. Returns the number of members put back.
+            """
+            mode = 'members' if members else 'expired' if expired_only else 'all'
+            return self._requeue_script(
+                keys=self._keys(queue_name, inflight_name, registry_name), args=[owner, mode, *members]
+            )
+
+        def owners(self, registry_name):
+            return self.rq.redis.smembers(registry_name)
+
+    class StreamQueueOp:
+        """
+        Queue operations using a stream with a consumer group in Redis, with the same `push`/`peak`/`len` as IndexedQueueOp.
+        An entry read by a consumer is pending until it is released (acknowledged and deleted),
+        and the entries pending for too long (e.g. their consumer died) are claimed by other consumers.
+        Entries are delivered in the order they are added: the scores are only kept for `peak`.
+        """
+        GROUP = 'workers'
+
+        def __init__(self, rq: 'RedisQueue'):
+            self.rq = rq
+
+        @staticmethod
+        def _entries(entries) -> list[tuple[bytes, float, bytes]]:
+            # deleted entries have no fields
+            return [
+                (fields[b'payload'], float(fields[b'score']), entry_id)
+                for entry_id, fields in entries if fields
+            ]
+
+        def _create_group_sync(self, queue_name):
+            try:
+                self.rq.redis.xgroup_create(queue_name, self.GROUP, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+        async def _create_group_async(self, queue_name):
+            try:
+                await self.rq.redis.xgroup_create(queue_name, self.GROUP, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+        def create_group(self, queue_name) -> None | Awaitable[None]:
+            """Create the consumer group of the stream, which gets the entries added before"""
+            if self.rq.is_async:
+                return self._create_group_async(queue_name)
+            else:
+                return self._create_group_sync(queue_name)
+
+        def push(self, queue_name, key_score_dict: dict[str, float], payloads: dict[str, str]):
+            """Add an entry with the payload and score of every id of `key_score_dict`, like IndexedQueueOp"""
+            pp = self.rq.redis.pipeline(transaction=False)
+            for key, score in key_score_dict.items():
+                pp.xadd(queue_name, {'payload': payloads[key], 'score': score})
+            return pp.execute()
+
+        def _group_info(self, groups) -> dict | None:
+            return next((g for g in groups if g['name'] in (self.GROUP, self.GROUP.encode())), None)
+
+        def _peak_sync(self, queue_name):
+            try:
+                group = self._group_info(self.rq.redis.xinfo_groups(queue_name))
+            except redis.ResponseError:
+                return None  # no stream yet
+            last_id = group['last-delivered-id'] if group else b'0-0'
+            entries = self._entries(self.rq.redis.xrange(queue_name, min=b'(' + last_id, count=1))
+            return entries[0][:2] if entries else None
+
+        async def _peak_async(self, queue_name):
+            try:
+                group = self._group_info(await self.rq.redis.xinfo_groups(queue_name))
+            except redis.ResponseError:
+                return None  # no stream yet
+            last_id = group['last-delivered-id'] if group else b'0-0'
+            entries = self._entries(await self.rq.redis.xrange(queue_name, min=b'(' + last_id, count=1))
+            return entries[0][:2] if entries else None
+
+        def peak(self, queue_name) -> tuple[bytes, float] | Awaitable[tuple[bytes, float]] | None | Awaitable[None]:
+            """The (payload, score) of the next entry to be delivered"""
+            if self.rq.is_async:
+                return self._peak_async(queue_name)
+            else:
+                return self._peak_sync(queue_name)
+
+        def _len(self, length, groups):
+            group = self._group_info(groups)
+            return length - (group['pending'] if group else 0)
+
+        def _len_sync(self, queue_name):
+            pp = self.rq.redis.pipeline(transaction=False)
+            pp.xlen(queue_name)
+            pp.xinfo_groups(queue_name)
+            try:
+                return self._len(*pp.execute())
+            except redis.ResponseError:
+                return 0  # no stream yet
+
+        async def _len_async(self, queue_name):
+            pp = self.rq.redis.pipeline(transaction=False)
+            pp.xlen(queue_name)
+            pp.xinfo_groups(queue_name)
+            try:
+                return self._len(*await pp.execute())
+            except redis.ResponseError:
+                return 0  # no stream yet
+
+        def len(self, queue_name) -> int | Awaitable[int]:
+            """The number of entries not delivered yet (as released entries are deleted)"""
+            if self.rq.is_async:
+                return self._len_async(queue_name)
+            else:
+                return self._len_sync(queue_name)
+
+        def _pop_pipeline(self, queue_name, consumer, count, unleased_queue_names):
+            pp = self.rq.redis.pipeline(transaction=False)
+            for name in unleased_queue_names:
+                pp.zpopmin(name)
+            pp.xreadgroup(self.GROUP, consumer, {queue_name: '>'}, count=count)
+            return pp
+
+        def _pop_result(self, results) -> list[tuple[bytes, float, bytes | None]]:
+            *unleased, entries = results
+            items = [(member, score, None) for popped in unleased for member, score in popped]
+            return items + (self._entries(entries[0][1]) if entries else [])
+
+        def _pop_block(self, unleased_queue_names, effective_timeout) -> int:
+            # the unleased queues can't be waited on with the stream, so they are polled
+            if unleased_queue_names:
+                effective_timeout = min(effective_timeout, RedisQueue.LeaseOp.MAX_POLL_INTERVAL)
+            return max(int(effective_timeout * 1000), 1)
+
+        def _pop_sync(self, queue_name, consumer, count, timeout, unleased_queue_names):
+            start = time()
+            while True:
+                items = self._pop_result(self._pop_pipeline(queue_name, consumer, count, unleased_queue_names).execute())
+                if items:
+                    return items
+                effective_timeout = self.rq._get_proper_timeout(start, timeout)
+                if effective_timeout <= 0:
+                    return []
+                entries = self.rq.redis.xreadgroup(
+                    self.GROUP, consumer, {queue_name: '>'}, count=count,
+                    block=self._pop_block(unleased_queue_names, effective_timeout)
+                )
+                if entries:
+                    return self._entries(entries[0][1])
+
+        async def _pop_async(self, queue_name, consumer, count, timeout, unleased_queue_names):
+            start = time()
+            while True:
+                items = self._pop_result(await self._pop_pipeline(queue_name, consumer, count, unleased_queue_names).execute())
+                if items:
+                    return items
+                effective_timeout = self.rq._get_proper_timeout(start, timeout)
+                if effective_timeout <= 0:
+                    return []
+                entries = await self.rq.redis.xreadgroup(
+                    self.GROUP, consumer, {queue_name: '>'}, count=count,
+                    block=self._pop_block(unleased_queue_names, effective_timeout)
+                )
+                if entries:
+                    return self._entries(entries[0][1])
+
+        def pop(self, queue_name, consumer, *, count=1, timeout=0, unleased_queue_names=()):
+            """
+            Read up to `count` new entries of `queue_name` for `consumer`, after one member of every priority queue
+            of `unleased_queue_names` if any, waiting up to `timeout` seconds.
+            Returns the [(payload, score, entry id)], where the entry ids of the unleased members are None.
+            """
+            if self.rq.is_async:
+                return self._pop_async(queue_name, consumer, count, timeout, unleased_queue_names)
+            else:
+                return self._pop_sync(queue_name, consumer, count, timeout, unleased_queue_names)
+
+        def _claim_sync(self, queue_name, consumer, min_idle, count):
+            _, entries, *_ = self.rq.redis.xautoclaim(
+                queue_name, self.GROUP, consumer, int(min_idle * 1000), start_id='0-0', count=count
+            )
+            return self._entries(entries)
+
+        async def _claim_async(self, queue_name, consumer, min_idle, count):
+            _, entries, *_ = await self.rq.redis.xautoclaim(
+                queue_name, self.GROUP, consumer, int(min_idle * 1000), start_id='0-0', count=count
+            )
+            return self._entries(entries)
+
+        def claim(self, queue_name, consumer, min_idle, count=1):
+            """Take up to `count` entries pending for more than `min_idle` seconds from their consumers, like `pop`"""
+            if self.rq.is_async:
+                return self._claim_async(queue_name, consumer, min_idle, count)
+            else:
+                return self._claim_sync(queue_name, consumer, min_idle, count)
+
+        def renew(self, queue_name, consumer, *entry_ids):
+            """Reset the idle time of the pending entries of `consumer`, so they are not claimed by other consumers"""
+            return self.rq.redis.xclaim(queue_name, self.GROUP, consumer, 0, list(entry_ids), justid=True)
+
+        def release(self, queue_name, *entry_ids, pipeline=None):
+            """Acknowledge and delete the entries, e.g. when their results are pushed. The commands are added to `pipeline` if given."""
+            pp = pipeline if pipeline is not None else self.rq.redis.pipeline(transaction=False)
+            pp.xack(queue_name, self.GROUP, *entry_ids)
+            pp.xdel(queue_name, *entry_ids)
+            if pipeline is None:
+                return pp.execute()
+
+        def requeue(self, queue_name, items: list[tuple[bytes, float, bytes]]):
+            """Add the pending (payload, score, entry id) `items` again as new entries for other consumers"""
+            pp = self.rq.redis.pipeline(transaction=True)
+            for payload, score, _ in items:
+                pp.xadd(queue_name, {'payload': payload, 'score': score})
+            self.release(queue_name, *[entry_id for _, _, entry_id in items], pipeline=pp)
+            return pp.execute()
+
+    def __init__(self, redis_uri, *, socket_timeout: int = None, is_async: bool = False, work_queue_backend: str = 'zset'):
         self.redis_uri = redis_uri
         self.is_async = is_async
         self.socket_timeout = socket_timeout
@@ -159,6 +691,18 @@ class RedisQueue:
         self.redis: redis.Redis | redis.asyncio.Redis = self._init_redis(socket_timeout)
         self.queue = self.QueueOp(self)
         self.pqueue = self.PriorityQueueOp(self)
+        self.lease = self.LeaseOp(self)
+        self.iqueue = self.IndexedQueueOp(self)
+        self.squeue = self.StreamQueueOp(self)
+        # the operations of the work queue: 'zset' (indexed queue) or 'stream'
+        if work_queue_backend not in ('zset', 'stream'):
+            raise ValueError(f'Unknown work queue backend {work_queue_backend}')
+        self.wqueue = self.squeue if work_queue_backend == 'stream' else self.iqueue
+
+    @staticmethod
+    def payloads_name(queue_name) -> str:
+        """The hash of the payloads of an indexed queue, in the redis cluster slot of the queue"""
+        return f'{{{queue_name}}}:payloads'
 
     def _init_redis(self, socket_timeout) -> redis.Redis | redis.asyncio.Redis:
         if '+cluster://' in self.redis_uri:
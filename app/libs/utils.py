@@ -1,5 +1,7 @@
 import os
 import signal
+import threading
+import time
 
 
 def chunkify(iterable, size):
@@ -14,3 +16,45 @@ def nothrow_killpg(pid: int = None, pgid:int = None, sig: int = signal.SIGKILL):
         os.killpg(pgid, sig)
     except OSError:
         pass  # ignore errors, process may have already exited
+
+
+# process groups of long-lived helper processes (e.g. REPL pools) owned by this process.
+# They must not be treated as hanged submissions by the worker manager.
+_persistent_pgids: set[int] = set()
+_persistent_listener = None
+
+
+def set_persistent_listener(listener):
+    """`listener` is called with the current set of persistent pgids whenever it changes"""
+    global _persistent_listener
+    _persistent_listener = listener
+    listener(set(_persistent_pgids))
+
+
+def add_persistent_pgid(pgid: int):
+    _persistent_pgids.add(pgid)
+    if _persistent_listener:
+        _persistent_listener(set(_persistent_pgids))
+
+
+def remove_persistent_pgid(pgid: int):
+    _persistent_pgids.discard(pgid)
+    if _persistent_listener:
+        _persistent_listener(set(_persistent_pgids))
+
+
+# the process group (and its start time) of the command run by every thread, see `running_pgids`
+_running_pgids: dict[int, tuple[int, float]] = {}
+
+
+def set_running_pgid(pgid: int | None):
+    """Record the process group of the command run by the current thread (None when it is done)"""
+    if pgid is None:
+        _running_pgids.pop(threading.get_ident(), None)
+    else:
+        _running_pgids[threading.get_ident()] = (pgid, time.monotonic())
+
+
+def running_pgids() -> dict[int, tuple[int, float]]:
+    """The (pgid, time.monotonic() when it started) of the command run by every thread, by thread id"""
+    return dict(_running_pgids)
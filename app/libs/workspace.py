@@ -0,0 +1,113 @@
+import logging
+import os
+import shutil
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+# a RAM-backed mount with less free space is not used, as a full workspace fails the submissions
+MIN_FREE_SPACE = 256 * 1024 * 1024
+
+
+class WorkspaceError(Exception):
+    pass
+
+
+def _make_writable(func, path, _):
+    # a submission may have made its files read-only
+    os.chmod(os.path.dirname(path), 0o700)
+    os.chmod(path, 0o700)
+    func(path)
+
+
+class Workspace:
+    """
+    A working directory created once and reused for one run at a time, instead of a temporary directory per run.
+    It is emptied by `reset` between runs.
+    """
+    def __init__(self, path: Path, noexec: bool = False):
+        self.path = Path(path)
+        # binaries can't be executed from a noexec mount (e.g. /dev/shm in docker)
+        self.noexec = noexec
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            raise WorkspaceError(f'Failed to create workspace {path}: {e}')
+
+    def reset(self):
+        """Remove everything in the workspace"""
+        os.chmod(self.path, 0o700)
+        for entry in os.scandir(self.path):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, onerror=_make_writable)
+            else:
+                os.unlink(entry.path)
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class WorkspacePool:
+    """The workspaces `<root>/<name>-<i>` of a worker, created once at startup"""
+    def __init__(self, root: str, name: str, size: int):
+        self.root = Path(root)
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            stat = os.statvfs(self.root)
+        except OSError as e:
+            raise WorkspaceError(f'Failed to create workspace root {root}: {e}')
+        if stat.f_bavail * stat.f_frsize < MIN_FREE_SPACE:
+            raise WorkspaceError(f'Not enough free space in {root}')
+        noexec = bool(stat.f_flag & os.ST_NOEXEC)
+        self.name = name
+        self.workspaces = [Workspace(self.root / f'{name}-{i}', noexec) for i in range(size)]
+        self._idle = list(self.workspaces)
+
+    def acquire(self) -> Workspace | None:
+        """Get a free workspace, or None if all workspaces are in use"""
+        return self._idle.pop() if self._idle else None
+
+    def release(self, workspace: Workspace):
+        try:
+            workspace.reset()
+        except OSError:
+            logger.exception(f'Failed to reset workspace {workspace.path}')
+            # recreate it
+            workspace.remove()
+            try:
+                workspace.path.mkdir(parents=True, exist_ok=True)
+            except OSError:
+                logger.exception(f'Failed to recreate workspace {workspace.path}')
+                return
+        self._idle.append(workspace)
+
+    def close(self):
+        for workspace in self.workspaces:
+            workspace.remove()
+
+
+def remove_workspaces(root: str, name: str):
+    """Remove the workspaces left by a dead worker"""
+    for path in Path(root).glob(f'{name}-*'):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def remove_stale_workspaces(root: str, prefix: str = 'worker-'):
+    """Remove the workspaces `<prefix><pid>-<i>` left by the workers of previous runs, whose process is gone"""
+    root = Path(root)
+    if not root.is_dir():
+        return
+    for path in root.glob(f'{prefix}*'):
+        pid = path.name[len(prefix):].split('-')[0]
+        if not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            continue  # the process exists
+        shutil.rmtree(path, ignore_errors=True)
@@ -1,13 +1,19 @@
 
 from enum import Enum
+import json
 from typing import Literal
 import uuid
 from time import time
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 
 import app.config as app_config
 
+class TestCase(BaseModel):
+    input: str | None = None
+    expected_output: str | None = None
+
+
 class Submission(BaseModel):
     sub_id: str | None = None
     type: Literal['python', 'cpp', 'math', 'lean']
@@ -15,6 +21,13 @@ class Submission(BaseModel):
     solution: str
     input: str | None = None
     expected_output: str | None = None
+    # run the prepared (e.g. compiled) solution against every test case instead of input/expected_output
+    test_cases: list[TestCase] | None = Field(None, min_length=1)
+    # skip the remaining test cases after the first failed one
+    stop_on_failure: bool = False
+    # python only: call this function (e.g. `solve` or `Solution.twoSum`) for every test case in one interpreter,
+    # with the json arguments in `input` (a list or an object), and compare the return value with the json `expected_output`
+    entry_point: str | None = None
 
     #Resource fields
     timeout: int | None = app_config.MAX_EXECUTION_TIME
@@ -24,6 +37,25 @@ class Submission(BaseModel):
     def model_post_init(self, __context):
         self.sub_id = self.sub_id or str(uuid.uuid4())
 
+    @model_validator(mode='after')
+    def _check_test_cases(self):
+        if self.test_cases is not None and self.type not in ('python', 'cpp'):
+            raise ValueError(f'test_cases is not supported by {self.type} submissions')
+        if self.entry_point is not None and (self.type != 'python' or not self.test_cases):
+            raise ValueError('entry_point is only supported by python submissions with test_cases')
+        if self.entry_point is not None:
+            for case in self.test_cases:
+                # raises ValueError for invalid json
+                json.loads(case.input or '[]')
+                if case.expected_output:
+                    json.loads(case.expected_output)
+        return self
+
+    @property
+    def total_timeout(self) -> int:
+        """the max time to run all test cases one by one"""
+        return self.timeout * len(self.test_cases or [None])
+
 
 class ResultReason(Enum):
     UNSPECIFIED = ''
@@ -31,6 +63,42 @@ class ResultReason(Enum):
     WORKER_TIMEOUT = 'worker_timeout'
     QUEUE_TIMEOUT = 'queue_timeout'
     INVALID_INPUT = 'invalid_input'
+    WRONG_ANSWER = 'wrong_answer'  # killed as soon as the output diverged from expected_output
+    OUTPUT_LIMIT_EXCEEDED = 'output_limit_exceeded'  # killed as the stdout exceeded MAX_OUTPUT_SIZE
+
+
+class ResourceUsage(BaseModel):
+    """The resources used to run a submission, measured by the worker. None if it is not available."""
+    wall_time: float                  # in seconds
+    user_time: float | None = None    # cpu time in user mode, in seconds
+    sys_time: float | None = None     # cpu time in kernel mode, in seconds
+    memory_peak: int | None = None    # in bytes
+
+    @classmethod
+    def total(cls, usages: list['ResourceUsage | None']) -> 'ResourceUsage | None':
+        """The usage of runs one after another: the sum of the times and the max of the memory peaks"""
+        usages = [u for u in usages if u is not None]
+        if not usages:
+            return None
+
+        def _total(name, func):
+            values = [getattr(u, name) for u in usages]
+            return None if None in values else func(values)
+
+        return cls(
+            wall_time=sum(u.wall_time for u in usages),
+            user_time=_total('user_time', sum),
+            sys_time=_total('sys_time', sum),
+            memory_peak=_total('memory_peak', max),
+        )
+
+
+class TestCaseResult(BaseModel):
+    success: bool
+    run_success: bool
+    cost: float
+    reason: ResultReason = ResultReason.UNSPECIFIED
+    usage: ResourceUsage | None = None
 
 
 class SubmissionResult(BaseModel):
@@ -41,6 +109,12 @@ class SubmissionResult(BaseModel):
     stdout: str | None = None
     stderr: str | None = None
     reason: ResultReason = ResultReason.UNSPECIFIED
+    cache: dict[str, int] | None = None   # cache hits/misses, only set by executors with a cache
+    # the result of every test case run, in order. Only set for submissions with test_cases.
+    # stdout/stderr are the ones of the first failed case (or the last case)
+    test_results: list[TestCaseResult] | None = None
+    # the total of test_results for submissions with test_cases
+    usage: ResourceUsage | None = None
 
 
 class BatchSubmission(BaseModel):
@@ -51,10 +125,25 @@ class BatchSubmission(BaseModel):
     def model_post_init(self, __context):
         self.sub_id = self.sub_id or str(uuid.uuid4())
 
+    @property
+    def timeout(self) -> int:
+        """the max time to run all submissions one by one"""
+        return sum(sub.timeout for sub in self.submissions)
+
+    @property
+    def total_timeout(self) -> int:
+        return sum(sub.total_timeout for sub in self.submissions)
+
 
 class BatchSubmissionResult(BaseModel):
     sub_id: str
     results: list[SubmissionResult]
+    # the total of results
+    usage: ResourceUsage | None = None
+
+    def model_post_init(self, __context):
+        if self.usage is None:
+            self.usage = ResourceUsage.total([r.usage for r in self.results])
 
 
 class JudgeResult(BaseModel):
@@ -63,6 +152,8 @@ class JudgeResult(BaseModel):
     run_success: bool
     cost: float
     reason: ResultReason = ResultReason.UNSPECIFIED
+    test_results: list[TestCaseResult] | None = None
+    usage: ResourceUsage | None = None
 
     @classmethod
     def from_submission_result(cls, result: SubmissionResult):
@@ -71,27 +162,43 @@ class JudgeResult(BaseModel):
             success=result.success,
             run_success=result.run_success,
             cost=result.cost,
-            reason=result.reason
+            reason=result.reason,
+            test_results=result.test_results,
+            usage=result.usage
         )
 
 
 class BatchJudgeResult(BaseModel):
     sub_id: str
     results: list[JudgeResult]
+    usage: ResourceUsage | None = None
 
     @classmethod
     def from_submission_result(cls, result: BatchSubmissionResult):
         return cls(
             sub_id=result.sub_id,
-            results=[JudgeResult.from_submission_result(r) for r in result.results]
+            results=[JudgeResult.from_submission_result(r) for r in result.results],
+            usage=result.usage
         )
 
 
+class CompileArtifact(BaseModel):
+    """A binary compiled by the compile stage, and the binary cache hits/misses of the compilation"""
+    path: str
+    cache: dict[str, int] | None = None
+
+
 class WorkPayload(BaseModel):
     work_id: str | None = None
     timestamp: float | None = None
     long_running: bool = False
     submission: Submission | BatchSubmission = Field(..., discriminator='type')
+    # set by the compile stage of the node, see CPP_COMPILE_WORKERS
+    artifact: CompileArtifact | None = None
+    # the work item this one is a part of, when the test cases of a submission are spread over the workers of a node
+    parent_id: str | None = None
+    # the lease of a work item handed off to the compile stage of the node, taken over with it, see `Worker._take_over_lease`
+    lease: list[str] | None = None
 
     def model_post_init(self, __context):
         self.work_id = self.work_id or str(uuid.uuid4())
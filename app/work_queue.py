@@ -7,4 +7,5 @@ def connect_queue(is_async: bool = False) -> RedisQueue:
         redis_uri=app_config.REDIS_URI,
         socket_timeout=app_config.REDIS_SOCKET_TIMEOUT,
         is_async=is_async,
+        work_queue_backend=app_config.REDIS_WORK_QUEUE_BACKEND,
     )
@@ -11,7 +11,17 @@ import logging
 
 import yaml
 
+import app.config as app_config
+from app.libs.executors.lean_executor import PRE_TEMPLATE as LEAN_PRE_TEMPLATE
+from app.libs.executors.lean_repl import LeanRepl, REPL_ENV_KEYS, repl_command
+from app.libs.executors.cpp_pch import MANIFEST as CPP_PCH_MANIFEST, build_pch, parse_header_sets, profile_dir as cpp_pch_profile_dir
+from app.libs.executors.lean_imports import INDEX_VERSION as LEAN_IMPORT_INDEX_VERSION, build_import_index
+
 LOG_PREFIX = "[bootstrap]"
+LEAN_PICKLE_STATE_KEY = "lean:header_pickle"
+LEAN_RUNTIME_STATE_KEY = "lean:repl_runtime"
+LEAN_IMPORT_INDEX_STATE_KEY = "lean:import_index"
+CPP_PCH_STATE_KEY = "cpp:pch"
 
 
 def read_yaml(path: Path) -> Dict[str, Any]:
@@ -67,6 +77,150 @@ def run_step(step: Dict[str, Any], env: Dict[str, str], workdir: Path) -> None:
         raise ValueError(f"unknow: {stype}")
 
 
+def resolve_lean_repl_runtime(state: Dict[str, Any], state_file: Path) -> None:
+    # Resolve the REPL binary and its environment once, so workers can execute it without a login shell and lake.
+    runtime_path = app_config.LEAN_REPL_RUNTIME_PATH
+    if not runtime_path:
+        return
+    runtime_path = Path(runtime_path)
+
+    sig = hash_dict({
+        "workdir": app_config.LEAN_WORKDIR,
+        "lake": app_config.LEAN_COMPILER_PATH,
+        "setup": state.get("lean", {}).get("applied_sig"),
+    })
+    if state.get(LEAN_RUNTIME_STATE_KEY, {}).get("applied_sig") == sig and runtime_path.exists():
+        logging.info(f"{LOG_PREFIX} lean REPL runtime is up to date, skipping.")
+        return
+
+    logging.info(f"{LOG_PREFIX} resolving lean REPL runtime to {runtime_path} …")
+    runtime_path.parent.mkdir(parents=True, exist_ok=True)
+    runtime_path.unlink(missing_ok=True)
+    bash = os.environ.get("SHELL", "/bin/bash")
+    completed = subprocess.run(
+        [bash, "-lc", f"{app_config.LEAN_COMPILER_PATH} env env -0"],
+        cwd=app_config.LEAN_WORKDIR, capture_output=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"failed to resolve lake env (exit={completed.returncode}): {completed.stderr.decode()}")
+    lake_env = dict(
+        item.split("=", 1) for item in completed.stdout.decode().split("\0") if "=" in item
+    )
+    repl = Path(app_config.LEAN_WORKDIR) / ".lake" / "build" / "bin" / "repl"
+    if not os.access(repl, os.X_OK):
+        raise RuntimeError(f"REPL binary {repl} is not found")
+    runtime = {
+        "repl": str(repl),
+        "cwd": app_config.LEAN_WORKDIR,
+        "env": {k: lake_env[k] for k in REPL_ENV_KEYS if k in lake_env},
+    }
+    tmp_path = runtime_path.with_name(f"{runtime_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(runtime, indent=2, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp_path, runtime_path)
+
+    state[LEAN_RUNTIME_STATE_KEY] = {"applied_sig": sig}
+    save_state(state_file, state)
+
+
+def build_lean_header_pickle(state: Dict[str, Any], state_file: Path) -> None:
+    # Pickle the environment of the lean header, so REPLs can load it instead of elaborating `import Mathlib`.
+    pickle_path = app_config.LEAN_HEADER_PICKLE_PATH
+    if not pickle_path:
+        return
+    pickle_path = Path(pickle_path)
+
+    args, env, cwd = repl_command(app_config.LEAN_REPL_RUNTIME_PATH, app_config.LEAN_REPL_COMMAND)
+    # Fingerprint: the header, the REPL and how the REPL (and its dependencies) are built
+    sig = hash_dict({
+        "header": LEAN_PRE_TEMPLATE,
+        "command": args,
+        "setup": state.get("lean", {}).get("applied_sig"),
+    })
+    if state.get(LEAN_PICKLE_STATE_KEY, {}).get("applied_sig") == sig and pickle_path.exists():
+        logging.info(f"{LOG_PREFIX} lean header pickle is up to date, skipping.")
+        return
+
+    logging.info(f"{LOG_PREFIX} pickling lean header to {pickle_path} …")
+    pickle_path.parent.mkdir(parents=True, exist_ok=True)
+    # never leave a stale pickle behind if the build fails
+    pickle_path.unlink(missing_ok=True)
+    tmp_path = pickle_path.with_name(f"{pickle_path.name}.{os.getpid()}.tmp")
+    repl = LeanRepl(args, cwd=cwd, env=env, persistent=False)
+    try:
+        repl.load_header(LEAN_PRE_TEMPLATE)
+        repl.wait_header(app_config.LEAN_REPL_START_TIMEOUT)
+        response = repl.send({"pickleTo": str(tmp_path), "env": repl.base_env}, timeout=app_config.LEAN_REPL_START_TIMEOUT)
+    finally:
+        repl.close()
+    if not tmp_path.exists():
+        raise RuntimeError(f"failed to pickle lean header: {response}")
+    os.replace(tmp_path, pickle_path)
+
+    state[LEAN_PICKLE_STATE_KEY] = {"applied_sig": sig}
+    save_state(state_file, state)
+
+
+def build_lean_import_index(state: Dict[str, Any], state_file: Path) -> None:
+    # Index the module of every declaration in the lean dependencies, so workers can infer the imports of a submission.
+    index_path = app_config.LEAN_IMPORT_INDEX_PATH
+    source = app_config.LEAN_IMPORT_INDEX_SOURCE
+    if not index_path or not source:
+        return
+    index_path = Path(index_path)
+    if not Path(source).is_dir():
+        logging.warning(f"{LOG_PREFIX} lean import index source {source} is not found, skipping.")
+        return
+
+    sig = hash_dict({
+        "source": source,
+        "version": LEAN_IMPORT_INDEX_VERSION,
+        "setup": state.get("lean", {}).get("applied_sig"),
+    })
+    if state.get(LEAN_IMPORT_INDEX_STATE_KEY, {}).get("applied_sig") == sig and index_path.exists():
+        logging.info(f"{LOG_PREFIX} lean import index is up to date, skipping.")
+        return
+
+    logging.info(f"{LOG_PREFIX} building lean import index to {index_path} …")
+    index = build_import_index(source)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(index, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp_path, index_path)
+
+    state[LEAN_IMPORT_INDEX_STATE_KEY] = {"applied_sig": sig}
+    save_state(state_file, state)
+
+
+def build_cpp_pch(state: Dict[str, Any], state_file: Path) -> None:
+    # Precompile the common headers with the flags of the compile command, so submissions including them compile faster.
+    pch_path = app_config.CPP_PCH_PATH
+    header_sets = parse_header_sets(app_config.CPP_PCH_HEADERS)
+    if not pch_path or not header_sets:
+        return
+
+    completed = subprocess.run([app_config.CPP_COMPILER_PATH, "--version"], capture_output=True)
+    # Fingerprint: the headers, the flags and the compiler (a PCH is only valid for the compiler that built it)
+    sig = hash_dict({
+        "headers": header_sets,
+        "command": app_config.CPP_COMPILE_COMMAND,
+        "compiler": completed.stdout.decode(errors="replace"),
+        "setup": state.get("cpp", {}).get("applied_sig"),
+    })
+    manifest_path = cpp_pch_profile_dir(pch_path, app_config.CPP_COMPILE_COMMAND) / CPP_PCH_MANIFEST
+    if state.get(CPP_PCH_STATE_KEY, {}).get("applied_sig") == sig and manifest_path.exists():
+        logging.info(f"{LOG_PREFIX} c++ precompiled headers are up to date, skipping.")
+        return
+
+    logging.info(f"{LOG_PREFIX} precompiling c++ headers {header_sets} to {pch_path} …")
+    manifest = build_pch(pch_path, app_config.CPP_COMPILE_COMMAND, header_sets)
+    if len(manifest["sets"]) != len(header_sets):
+        # retried on the next start
+        return
+
+    state[CPP_PCH_STATE_KEY] = {"applied_sig": sig}
+    save_state(state_file, state)
+
+
 def bootstrap_workers_from_yaml(yaml_path: str, state_file: str = ".state/state.json") -> None:
     # yaml_path is the path to the YAML configuration file and used to initialize workers.
     # state_file is the path to the state file and used to avoid repeated initialization.
@@ -105,3 +259,27 @@ def bootstrap_workers_from_yaml(yaml_path: str, state_file: str = ".state/state.
         # update state
         state[name] = {"applied_sig": sig}
         save_state(state_file, state)
+
+    if "cpp" in tools:
+        try:
+            build_cpp_pch(state, state_file)
+        except Exception:
+            # workers still work without it, they just parse the headers per submission
+            logging.exception(f"{LOG_PREFIX} failed to precompile c++ headers.")
+
+    if "lean" in tools:
+        try:
+            resolve_lean_repl_runtime(state, state_file)
+        except Exception:
+            # workers still work without it, they just start the REPL with lake
+            logging.exception(f"{LOG_PREFIX} failed to resolve lean REPL runtime, REPLs will be started with lake.")
+        try:
+            build_lean_header_pickle(state, state_file)
+        except Exception:
+            # workers still work without it, they just elaborate the header instead
+            logging.exception(f"{LOG_PREFIX} failed to pickle lean header, REPLs will elaborate it on start.")
+        try:
+            build_lean_import_index(state, state_file)
+        except Exception:
+            # only needed by the `auto` imports mode, which falls back to PRE_TEMPLATE without it
+            logging.exception(f"{LOG_PREFIX} failed to build lean import index.")
@@ -1,7 +1,12 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
 from multiprocessing import Process
 import logging
 import threading
-from time import sleep, time
+from time import monotonic, sleep, time
+import shutil
 from pathlib import Path
 import json
 from dataclasses import asdict
@@ -10,23 +15,61 @@ import uuid
 import json
 from multiprocessing import Manager
 
+import os
+
 import psutil
 from pydantic import ValidationError
 
-from app.libs.executors.executor import ProcessExecuteResult
-from app.model import Submission, SubmissionResult, WorkPayload, ResultReason
-from app.libs.executors.python_executor import PythonExecutor, ScriptExecutor
-from app.libs.executors.cpp_executor import CppExecutor
-from app.libs.executors.lean_executor import LeanExecutor
-from app.libs.executors.executor import TIMEOUT_EXIT_CODE
+from app.libs.executors.executor import COMPILE_ERROR_EXIT_CODE, CompileError, ProcessExecuteResult
+from app.model import (
+    Submission, SubmissionResult, BatchSubmission, BatchSubmissionResult, WorkPayload, ResultReason, TestCaseResult,
+    ResourceUsage, CompileArtifact
+)
+from app.libs.executors.python_executor import PythonExecutor, ScriptExecutor, ZygoteError, get_zygote
+from app.libs.executors.cpp_executor import CppExecutor, get_resource_limit_object
+from app.libs.executors.binary_cache import get_binary_cache
+from app.libs.executors.cpp_pch import load_pch
+from app.libs.executors.lean_executor import LeanExecutor, PRE_TEMPLATE as LEAN_PRE_TEMPLATE
+from app.libs.executors.lean_repl import get_repl_pool, repl_command
+from app.libs.executors.lean_imports import AUTO_IMPORTS, load_import_index
+from app.libs.executors.executor import OUTPUT_LIMIT_EXIT_CODE, TIMEOUT_EXIT_CODE, WRONG_ANSWER_EXIT_CODE
 import app.config as app_config
 from app.work_queue import connect_queue
 
-from app.libs.utils import nothrow_killpg
+from app.libs.cgroup import CgroupError, CgroupSlot, CgroupSlotPool, prepare_cgroup_root, remove_slots
+from app.libs.workspace import Workspace, WorkspaceError, WorkspacePool, remove_stale_workspaces, remove_workspaces
+from app.libs.utils import nothrow_killpg, running_pgids, set_persistent_listener
 
 
 logger = logging.getLogger(__name__)
 
+# the cgroup slots of the current worker, see Worker.run
+_cgroup_slots: CgroupSlotPool | None = None
+
+
+@contextmanager
+def _cgroup_slot():
+    slot = _cgroup_slots.acquire() if _cgroup_slots else None
+    try:
+        yield slot
+    finally:
+        if slot:
+            _cgroup_slots.release(slot)
+
+
+# the workspaces of the current worker, see Worker.run
+_workspaces: WorkspacePool | None = None
+
+
+@contextmanager
+def _workspace():
+    workspace = _workspaces.acquire() if _workspaces else None
+    try:
+        yield workspace
+    finally:
+        if workspace:
+            _workspaces.release(workspace)
+
 
 def save_error_case(sub: Submission, result: ProcessExecuteResult | None = None, exception: Exception | None = None):
     if not app_config.ERROR_CASE_SAVE_PATH:
@@ -50,13 +93,33 @@ def save_error_case(sub: Submission, result: ProcessExecuteResult | None = None,
         logger.exception(f'Failed to save error case for submission {sub.sub_id}')
 
 
-def executor_factory(type: str, timeout: int, memory_limit: int, cpu_core: int) -> ScriptExecutor:
+def executor_factory(type: str, timeout: int, memory_limit: int, cpu_core: int, options: dict[str, str] | None = None,
+        cgroup_slot: CgroupSlot | None = None, artifact: CompileArtifact | None = None,
+        workspace: Workspace | None = None) -> ScriptExecutor:
     if type == 'python':
+        zygote = None
+        if app_config.PYTHON_ZYGOTE:
+            zygote_cl = [app_config.PYTHON_EXECUTOR_PATH]
+            if not cgroup_slot:
+                # children share the cpu quota of the zygote, so there is a zygote per cpu_core
+                quota = int(round(cpu_core * 100))
+                zygote_cl = ["systemd-run", "--user", "--scope", "--quiet", "-p", f"CPUQuota={quota}%"] + zygote_cl
+            try:
+                zygote = get_zygote(
+                    zygote_cl,
+                    [m.strip() for m in app_config.PYTHON_ZYGOTE_PRELOAD.split(',') if m.strip()]
+                )
+            except ZygoteError:
+                logger.exception('Failed to start python zygote')
         return PythonExecutor(
             run_cl=app_config.PYTHON_EXECUTE_COMMAND,
             timeout=timeout,
             memory_limit=memory_limit * 1024 * 1024,
-            cpu_core=cpu_core
+            cpu_core=cpu_core,
+            zygote=zygote,
+            cgroup_slot=cgroup_slot,
+            output_limit=app_config.MAX_OUTPUT_SIZE * 1024 * 1024,
+            workspace=workspace
         )
     elif type == 'cpp':
         return CppExecutor(
@@ -64,45 +127,174 @@ def executor_factory(type: str, timeout: int, memory_limit: int, cpu_core: int)
             run_cl=app_config.CPP_EXECUTE_COMMAND,
             timeout=timeout,
             memory_limit=memory_limit * 1024 * 1024,
-            cpu_core=cpu_core
+            cpu_core=cpu_core,
+            cgroup_slot=cgroup_slot,
+            binary_cache=get_binary_cache(
+                app_config.CPP_BINARY_CACHE_PATH,
+                app_config.CPP_BINARY_CACHE_SIZE * 1024 * 1024,
+                app_config.CPP_BINARY_CACHE_SHARED_PATH or None
+            ) if app_config.CPP_BINARY_CACHE_SIZE > 0 else None,
+            options=options,
+            pch=load_pch(app_config.CPP_PCH_PATH, app_config.CPP_COMPILE_COMMAND) if app_config.CPP_PCH_HEADERS else None,
+            resource_limit_object=get_resource_limit_object(
+                app_config.CPP_RUNTIME_PATH, app_config.CPP_COMPILE_COMMAND
+            ) if app_config.CPP_RUNTIME_PATH else None,
+            artifact=artifact,
+            output_limit=app_config.MAX_OUTPUT_SIZE * 1024 * 1024,
+            # the binary is run from the workspace
+            workspace=workspace if workspace and not workspace.noexec else None
         )
     elif type == 'lean':
+        repl_cl, repl_env, repl_cwd = repl_command(app_config.LEAN_REPL_RUNTIME_PATH, app_config.LEAN_REPL_COMMAND)
+        header_pickle = app_config.LEAN_HEADER_PICKLE_PATH
+        header_pickle = header_pickle if header_pickle and os.path.exists(header_pickle) else None
+        repl_pool_factory = None
+        if app_config.LEAN_REPL_POOL_SIZE > 0:
+            def repl_pool_factory(header: str):
+                return get_repl_pool(
+                    repl_cl,
+                    header,
+                    max_pools=app_config.LEAN_REPL_MAX_HEADERS,
+                    pickle_path=header_pickle if header == LEAN_PRE_TEMPLATE else None,
+                    env=repl_env,
+                    cwd=repl_cwd,
+                    size=app_config.LEAN_REPL_POOL_SIZE,
+                    max_uses=app_config.LEAN_REPL_MAX_USES,
+                    max_memory=app_config.LEAN_REPL_MAX_MEMORY * 1024 * 1024,
+                    start_timeout=app_config.LEAN_REPL_START_TIMEOUT,
+                )
+        imports = (options or {}).get('imports', app_config.LEAN_DEFAULT_IMPORTS)
         return LeanExecutor(
             run_cl=app_config.LEAN_COMPILER_COMMAND,
             timeout=timeout,
             memory_limit=memory_limit * 1024 * 1024,
-            cpu_core=cpu_core
+            cpu_core=cpu_core,
+            repl_pool_factory=repl_pool_factory,
+            # a one-off REPL session is only faster than checking a file when the header is pickled
+            # or the REPL binary is executed directly
+            repl_cl=repl_cl if header_pickle or repl_env is not None else None,
+            repl_env=repl_env,
+            repl_cwd=repl_cwd,
+            header_pickle=header_pickle,
+            imports=imports,
+            import_index=load_import_index(app_config.LEAN_IMPORT_INDEX_PATH) if imports == AUTO_IMPORTS else None,
+            env_cache_size=app_config.LEAN_ENV_CACHE_SIZE,
+            cgroup_slot=cgroup_slot,
         )
     else:
         raise ValueError(f'Unsupported type: {type}')
 
 
-def judge(sub: Submission):
-    try:
-        executor = executor_factory(type=sub.type, timeout=sub.timeout, memory_limit=sub.memory_limit, cpu_core=sub.cpu_core)
-        result = executor.execute_script(sub.solution, sub.input)
-
-        success = result.success
-        run_success = result.success
-        if sub.type == 'lean' and not sub.expected_output:
-            # default expected output for lean
-            sub.expected_output = 'pass' 
-        if sub.expected_output is not None:
-            success = success and result.stdout.strip() == sub.expected_output.strip()
-        if not success:
-            save_error_case(sub, result)
-        sub_result = SubmissionResult(
-            sub_id=sub.sub_id, success=success, cost=result.cost,
-            run_success=run_success,
-            # only save stdout and stderr if expected_output is None
-            stdout=result.stdout[:app_config.MAX_STDOUT_ERROR_LENGTH]
-                if result.stdout is not None else None,
-            stderr=result.stderr[:app_config.MAX_STDOUT_ERROR_LENGTH]
-                if result.stderr is not None else None,
-            reason=ResultReason.WORKER_TIMEOUT
-                if result.exit_code == TIMEOUT_EXIT_CODE
-                else ResultReason.UNSPECIFIED
+def _to_submission_result(sub: Submission, result: ProcessExecuteResult) -> SubmissionResult:
+    success = result.success
+    run_success = result.success
+    if sub.type == 'lean' and not sub.expected_output:
+        # default expected output for lean
+        sub.expected_output = 'pass' 
+    if result.matched is not None:
+        success = success and result.matched
+    elif sub.expected_output is not None:
+        success = success and result.stdout.strip() == sub.expected_output.strip()
+    if not success:
+        save_error_case(sub, result)
+    return SubmissionResult(
+        sub_id=sub.sub_id, success=success, cost=result.cost,
+        run_success=run_success,
+        # only save stdout and stderr if expected_output is None
+        stdout=result.stdout[:app_config.MAX_STDOUT_ERROR_LENGTH]
+            if result.stdout is not None else None,
+        stderr=result.stderr[:app_config.MAX_STDOUT_ERROR_LENGTH]
+            if result.stderr is not None else None,
+        reason=ResultReason.WORKER_TIMEOUT
+            if result.exit_code == TIMEOUT_EXIT_CODE
+            else ResultReason.WRONG_ANSWER
+            if result.exit_code == WRONG_ANSWER_EXIT_CODE
+            else ResultReason.OUTPUT_LIMIT_EXCEEDED
+            if result.exit_code == OUTPUT_LIMIT_EXIT_CODE
+            else ResultReason.UNSPECIFIED,
+        cache=result.cache,
+        usage=ResourceUsage(
+            wall_time=result.cost, user_time=result.user_time, sys_time=result.sys_time,
+            memory_peak=result.memory_peak
+        )
+    )
+
+
+def _to_test_cases_result(sub: Submission, results: list[ProcessExecuteResult]) -> SubmissionResult:
+    case_results = [
+        _to_submission_result(
+            sub.model_copy(update={'input': case.input, 'expected_output': case.expected_output, 'test_cases': None}),
+            result
         )
+        for case, result in zip(sub.test_cases, results)
+    ]
+    # the remaining cases are skipped after a failure (or a compile error)
+    success = len(case_results) == len(sub.test_cases) and all(r.success for r in case_results)
+    reported = next((r for r in case_results if not r.success), case_results[-1])
+    return SubmissionResult(
+        sub_id=sub.sub_id, success=success, cost=sum(r.cost for r in case_results),
+        run_success=all(r.run_success for r in case_results),
+        stdout=reported.stdout,
+        stderr=reported.stderr,
+        reason=reported.reason,
+        cache=reported.cache,
+        test_results=[
+            TestCaseResult(success=r.success, run_success=r.run_success, cost=r.cost, reason=r.reason, usage=r.usage)
+            for r in case_results
+        ],
+        usage=ResourceUsage.total([r.usage for r in case_results])
+    )
+
+
+def _execute_test_cases(executor: ScriptExecutor, sub: Submission) -> list[ProcessExecuteResult]:
+    if sub.entry_point:
+        return executor.execute_harness(
+            sub.solution, sub.entry_point,
+            [
+                (json.loads(case.input or '[]'), json.loads(case.expected_output) if case.expected_output else None)
+                for case in sub.test_cases
+            ],
+            timeout=sub.timeout, stop_on_failure=sub.stop_on_failure
+        )
+
+    def stop(idx: int, result: ProcessExecuteResult) -> bool:
+        expected_output = sub.test_cases[idx].expected_output
+        return not result.success or (expected_output is not None and result.stdout.strip() != expected_output.strip())
+
+    return executor.execute_cases(
+        sub.solution, [case.input for case in sub.test_cases], stop=stop if sub.stop_on_failure else None,
+        expected_outputs=[case.expected_output for case in sub.test_cases] if app_config.STREAMING_OUTPUT_CHECK else None
+    )
+
+
+def _max_process_time(sub: Submission | BatchSubmission) -> float:
+    """How long a command judging `sub` can run before it is considered hanged"""
+    if isinstance(sub, BatchSubmission) or sub.entry_point:
+        # the harness runs all test cases in one command
+        return sub.total_timeout + 5
+    return sub.timeout + 5
+
+
+def judge(sub: Submission, artifact: CompileArtifact | None = None):
+    try:
+        with _cgroup_slot() as slot, _workspace() as workspace:
+            executor = executor_factory(
+                # the harness runs all test cases in one process
+                type=sub.type, timeout=sub.total_timeout if sub.entry_point else sub.timeout,
+                memory_limit=sub.memory_limit, cpu_core=sub.cpu_core,
+                options=sub.options, cgroup_slot=slot, artifact=artifact, workspace=workspace
+            )
+            if sub.test_cases:
+                results = _execute_test_cases(executor, sub)
+            else:
+                result = executor.execute_script(
+                    sub.solution, sub.input,
+                    expected_output=sub.expected_output if app_config.STREAMING_OUTPUT_CHECK else None
+                )
+        if sub.test_cases:
+            sub_result = _to_test_cases_result(sub, results)
+        else:
+            sub_result = _to_submission_result(sub, result)
     except Exception as e:
         logger.exception(f'Worker failed to judge submission {sub.sub_id}')
         save_error_case(sub, None, e)
@@ -112,13 +304,281 @@ def judge(sub: Submission):
     return sub_result
 
 
+def _lost_part_result(part: Submission) -> SubmissionResult:
+    """The result of a fanned-out part whose worker didn't push its result in time: every test case timed out"""
+    return SubmissionResult(
+        sub_id=part.sub_id, run_success=False, success=False, cost=part.total_timeout, reason=ResultReason.WORKER_TIMEOUT,
+        test_results=[
+            TestCaseResult(success=False, run_success=False, cost=part.timeout, reason=ResultReason.WORKER_TIMEOUT)
+            for _ in part.test_cases
+        ]
+    )
+
+
+def _merge_test_cases_results(sub: Submission, parts: list[SubmissionResult | None]) -> SubmissionResult:
+    """Merge the results of the parts of a fanned-out submission, in the order of the test cases"""
+    if any(part is None or part.test_results is None for part in parts):
+        # a part is lost, or failed with an internal error
+        return SubmissionResult(
+            sub_id=sub.sub_id, run_success=False, success=False,
+            cost=sum(part.cost for part in parts if part is not None), reason=ResultReason.INTERNAL_ERROR
+        )
+    test_results = []
+    for part in parts:
+        test_results.extend(part.test_results)
+    if sub.stop_on_failure:
+        failed = next((i for i, r in enumerate(test_results) if not r.success), None)
+        if failed is not None:
+            test_results = test_results[:failed + 1]
+    reported = next((part for part in parts if not part.success), parts[-1])
+    return SubmissionResult(
+        sub_id=sub.sub_id,
+        success=len(test_results) == len(sub.test_cases) and all(r.success for r in test_results),
+        run_success=all(r.run_success for r in test_results),
+        cost=sum(r.cost for r in test_results),
+        stdout=reported.stdout,
+        stderr=reported.stderr,
+        reason=reported.reason,
+        cache=parts[0].cache,
+        test_results=test_results,
+        usage=ResourceUsage.total([r.usage for r in test_results])
+    )
+
+
+def judge_batch(batch_sub: BatchSubmission):
+    """
+    Judge a batch of lean submissions with the same resource limits in one REPL session.
+    """
+    try:
+        sub = batch_sub.submissions[0]
+        if any(
+            (s.type, s.timeout, s.memory_limit, s.cpu_core, s.options)
+                != ('lean', sub.timeout, sub.memory_limit, sub.cpu_core, sub.options)
+            for s in batch_sub.submissions
+        ):
+            raise ValueError('Only lean submissions with the same resource limits and options can be judged in a batch')
+        with _cgroup_slot() as slot:
+            executor = executor_factory(
+                type=sub.type, timeout=sub.timeout, memory_limit=sub.memory_limit, cpu_core=sub.cpu_core,
+                options=sub.options, cgroup_slot=slot
+            )
+            results = executor.execute_batch([s.solution for s in batch_sub.submissions])
+        sub_results = [_to_submission_result(s, r) for s, r in zip(batch_sub.submissions, results)]
+    except Exception:
+        logger.exception(f'Worker failed to judge batch submission {batch_sub.sub_id}')
+        sub_results = [
+            SubmissionResult(
+                sub_id=s.sub_id, run_success=False, success=False, cost=0, reason=ResultReason.INTERNAL_ERROR
+            ) for s in batch_sub.submissions
+        ]
+    return BatchSubmissionResult(sub_id=batch_sub.sub_id, results=sub_results)
+
+
+def _node_queue_name(kind: str, node_id: str) -> str:
+    # the hash tag keeps the queue in the redis cluster slot of the work queue, so they can be popped together
+    return f'{{{app_config.REDIS_WORK_QUEUE_NAME}}}:{kind}:{node_id}'
+
+
+def _inflight_name(worker_id: str) -> str:
+    """The in-flight set of the work items leased to a worker, see RELIABLE_QUEUE"""
+    return _node_queue_name('inflight', worker_id)
+
+
+def _lease_owners_name() -> str:
+    """The set of the workers with leased work items"""
+    return f'{{{app_config.REDIS_WORK_QUEUE_NAME}}}:inflight-workers'
+
+
+# the lease taken with a work item, which covers a submission with the max timeout
+_LEASE_TIME = app_config.MAX_PROCESS_TIME + app_config.WORK_LEASE_GRACE
+
+# the entries of a stream work queue are always leased (pending) until they are released
+_STREAM_QUEUE = app_config.REDIS_WORK_QUEUE_BACKEND == 'stream'
+_LEASED_QUEUE = bool(app_config.RELIABLE_QUEUE) and not _STREAM_QUEUE
+
+
+def _lease_ops(redis_queue):
+    """The operations releasing the work items held by a worker, see `Worker._hold_items`"""
+    return redis_queue.lease if _LEASED_QUEUE else redis_queue.wqueue
+
+
+def _carried_lease(lease: tuple) -> list[str]:
+    """The lease of a work item as carried by its payload to the compile stage of the node, see `WorkPayload.lease`"""
+    return [field.decode() if isinstance(field, bytes) else field for field in lease]
+
+
+def _push_result(redis_queue, result_queue_name: str, result: SubmissionResult | BatchSubmissionResult, long_running: bool,
+                 worker_key: str | None = None, lease: tuple | None = None):
+    """
+    Push the result with its expiry in one round trip, where the registration `worker_key` of the worker is refreshed
+    and the `lease` of the work item is released with its payload, see `Worker._hold_items`.
+    """
+    pp = redis_queue.redis.pipeline(transaction=False)
+    pp.rpush(result_queue_name, result.model_dump_json())
+    pp.expire(
+        result_queue_name,
+        app_config.REDIS_RESULT_EXPIRE
+            if not long_running
+            else app_config.REDIS_RESULT_LONG_BATCH_EXPIRE
+    )
+    if worker_key:
+        pp.set(worker_key, 1, ex=app_config.REDIS_WORKER_REGISTER_EXPIRE)
+    if lease:
+        _lease_ops(redis_queue).release(*lease, pipeline=pp)
+    pp.execute()
+
+
+async def _push_result_async(redis_queue, result_queue_name: str, result: SubmissionResult | BatchSubmissionResult, long_running: bool,
+                             lease: tuple | None = None):
+    pp = redis_queue.redis.pipeline(transaction=False)
+    pp.rpush(result_queue_name, result.model_dump_json())
+    pp.expire(
+        result_queue_name,
+        app_config.REDIS_RESULT_EXPIRE
+            if not long_running
+            else app_config.REDIS_RESULT_LONG_BATCH_EXPIRE
+    )
+    if lease:
+        _lease_ops(redis_queue).release(*lease, pipeline=pp)
+    await pp.execute()
+
+
+def _idle_key(worker_id: str) -> str:
+    return f'{worker_id}:idle'
+
+
 class Worker(Process):
-    def __init__(self, shared_dict: dict):
+    # the number of work items judged at the same time
+    concurrency = 1
+
+    def __init__(self, shared_dict: dict, cgroup_root: Path | None = None, node_id: str | None = None):
         super().__init__()
         # local woker use shared_dict to set the timeout, which is used by WorkerManager then
         self.shared = shared_dict  
         self.worker_id = str(uuid.uuid4())
-        
+        # the slots of the worker are created in it at startup
+        self.cgroup_root = cgroup_root
+        # the compile workers of the same node share the queues with the node id
+        self.node_id = node_id
+        self.compile_stage = bool(node_id) and app_config.CPP_COMPILE_WORKERS > 0
+        # the moving average of the judge times, which sizes the prefetch
+        self._judge_time: float | None = None
+        # the leases of the work items held by the worker by payload json, see `_hold_items`
+        self._leased: dict[bytes, tuple] = {}
+        self._inflight_name = _inflight_name(self.worker_id)
+        # when the stream entries of dead workers were last claimed
+        self._last_claim = 0
+        self._renew_thread: threading.Thread | None = None
+
+    @property
+    def _fans_out(self) -> bool:
+        """Whether the test cases of a c++ submission are spread over the idle workers of the node"""
+        return bool(self.node_id) and app_config.CPP_FANOUT_MIN_CASES > 0 and self.concurrency == 1
+
+    def _set_idle(self, idle: bool):
+        """Let the other workers of the node know whether this one is waiting for work items, for the fan-out"""
+        if self._fans_out:
+            self.shared[_idle_key(self.worker_id)] = idle
+
+    def _idle_workers(self) -> int:
+        """The number of the other workers of the node waiting for work items"""
+        own_key = _idle_key(self.worker_id)
+        return sum(1 for key, idle in self.shared.items() if key != own_key and key.endswith(':idle') and idle is True)
+
+    def _hand_off(self, redis_queue, payload: WorkPayload, payload_json: bytes | None = None) -> bool:
+        """
+        Hand a c++ submission to the compile workers of the node, so the worker can take other work meanwhile.
+        The lease of the work item goes with it (see `_take_over_lease`). Return False if the worker should judge it itself.
+        """
+        sub = payload.submission
+        if not self.compile_stage or sub.type != 'cpp' or payload.artifact is not None:
+            return False
+        executor = executor_factory(
+            type=sub.type, timeout=sub.timeout, memory_limit=sub.memory_limit, cpu_core=sub.cpu_core,
+            options=sub.options
+        )
+        key = executor.binary_key(sub.solution)
+        if key and executor.binary_cache.has(key):
+            # nothing to compile
+            return False
+        compile_queue = _node_queue_name('compile', self.node_id)
+        if redis_queue.pqueue.len(compile_queue) >= app_config.CPP_COMPILE_QUEUE_SIZE:
+            return False
+        if (_LEASED_QUEUE or _STREAM_QUEUE) and (lease := self._leased.pop(payload_json, None)):
+            payload = payload.model_copy(update={'lease': _carried_lease(lease)})
+        redis_queue.pqueue.push(compile_queue, {payload.model_dump_json(): payload.timestamp})
+        return True
+
+    def _fan_out(self, redis_queue, payload: WorkPayload) -> SubmissionResult | None:
+        """
+        Spread the test cases of a c++ submission over the idle workers of the node:
+        the binary is compiled once to the artifact directory of the node, and the test cases are split into parts,
+        which are queued in the ready queue of the node. Return None if the submission is not fanned out.
+        """
+        sub = payload.submission
+        if not self._fans_out or sub.type != 'cpp' or payload.parent_id is not None \
+                or len(sub.test_cases or []) < app_config.CPP_FANOUT_MIN_CASES:
+            return None
+        # this worker and the idle ones of the node
+        workers = self._idle_workers() + 1
+        if workers <= 1:
+            return None
+        artifact = payload.artifact
+        if artifact is None:
+            artifact_dir = Path(app_config.CPP_ARTIFACT_PATH) / self.node_id
+            artifact_dir.mkdir(parents=True, exist_ok=True)
+            try:
+                with _workspace() as workspace:
+                    executor = executor_factory(
+                        type=sub.type, timeout=sub.timeout, memory_limit=sub.memory_limit, cpu_core=sub.cpu_core,
+                        options=sub.options, workspace=workspace
+                    )
+                    artifact = executor.compile(sub.solution, str(artifact_dir / payload.work_id), sub.timeout)
+            except CompileError as e:
+                return _to_test_cases_result(
+                    sub, [ProcessExecuteResult(stdout='', stderr=str(e), exit_code=COMPILE_ERROR_EXIT_CODE, cost=0)]
+                )
+        try:
+            chunk_size = -(-len(sub.test_cases) // workers)
+            parts = [
+                WorkPayload(
+                    work_id=f'{payload.work_id}:{i}',
+                    timestamp=payload.timestamp,
+                    long_running=payload.long_running,
+                    submission=sub.model_copy(update={'test_cases': sub.test_cases[i:i + chunk_size]}),
+                    artifact=artifact,
+                    parent_id=payload.work_id,
+                )
+                for i in range(0, len(sub.test_cases), chunk_size)
+            ]
+            ready_queue = _node_queue_name('ready', self.node_id)
+            part_jsons = [part.model_dump_json() for part in parts[1:]]
+            if part_jsons:
+                redis_queue.pqueue.push(ready_queue, {part_json: payload.timestamp for part_json in part_jsons})
+            results = [judge(parts[0].submission, artifact)]
+            for part, part_json in zip(parts[1:], part_jsons):
+                skip = sub.stop_on_failure and not results[-1].success
+                if redis_queue.pqueue.remove(ready_queue, part_json):
+                    # not taken by other workers, so it is judged here
+                    if not skip:
+                        results.append(judge(part.submission, artifact))
+                    continue
+                if skip:
+                    # the result of a part taken by another worker is not needed (and expires)
+                    continue
+                # wait for the worker running it, which uses the artifact
+                result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{part.work_id}'
+                result_json = redis_queue.queue.block_pop(result_queue_name, timeout=part.submission.total_timeout + 5)
+                redis_queue.delete(result_queue_name)
+                if result_json:
+                    results.append(SubmissionResult.model_validate_json(result_json[1]))
+                else:
+                    logger.warning(f'Part {part.work_id} is lost. Its test cases are timed out.')
+                    results.append(_lost_part_result(part.submission))
+            return _merge_test_cases_results(sub, results)
+        finally:
+            Path(artifact.path).unlink(missing_ok=True)
+
     def _run_loop(self):
         redis_queue = connect_queue(False)
         # warm up the connection
@@ -128,80 +588,313 @@ class Worker(Process):
             logger.warning(f'Clock skew detected: {time_offset:.2f} seconds. '
                            f'This may cause issues with timeouts.'
                            f'Please make sure MAX_QUEUE_WORK_LIFE_TIME{app_config.MAX_QUEUE_WORK_LIFE_TIME} is large enough.')
-        while True:
-            # register worker id
-            redis_queue.set(
-                f'{app_config.REDIS_WORKER_ID_PREFIX}{self.worker_id}',
-                1,
-                app_config.REDIS_WORKER_REGISTER_EXPIRE
+        self._prepare_leases(redis_queue)
+        queue_names = [app_config.REDIS_WORK_QUEUE_NAME]
+        if self.node_id:
+            # the compiled submissions (and fanned-out parts) of the node go before new work items
+            queue_names.insert(0, _node_queue_name('ready', self.node_id))
+        worker_key = f'{app_config.REDIS_WORKER_ID_PREFIX}{self.worker_id}'
+        last_register = 0
+        # the (payload json, score, claimed at) of the work items claimed ahead from the work queue
+        prefetched: deque[tuple[bytes, float, float]] = deque()
+        try:
+            while True:
+                self._requeue_prefetched(redis_queue, prefetched)
+                if not prefetched:
+                    # register worker id, which is also refreshed with every result
+                    if time() - last_register >= app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT:
+                        redis_queue.set(worker_key, 1, app_config.REDIS_WORKER_REGISTER_EXPIRE)
+                        last_register = time()
+                    self._set_idle(True)
+                    claimed = self._claim(redis_queue, queue_names)
+                    if not claimed:
+                        continue
+                    self._set_idle(False)
+                    payload_json, _, _ = claimed[0]
+                    claimed_at = monotonic()
+                    prefetched.extend((extra_json, score, claimed_at) for extra_json, score, _ in claimed[1:])
+                else:
+                    payload_json, _, _ = prefetched.popleft()
+                start = monotonic()
+                processed = self._process(redis_queue, payload_json)
+                lease = self._take_lease(payload_json)
+                if processed is not None:
+                    _push_result(redis_queue, *processed, worker_key=worker_key, lease=lease)
+                    last_register = time()
+                    self._update_judge_time(monotonic() - start)
+                elif lease:
+                    _lease_ops(redis_queue).release(*lease)
+        finally:
+            self._set_idle(False)
+            # the claimed work items are given back to the other workers
+            self._requeue_prefetched(redis_queue, prefetched, 0)
+
+    def _claim(self, redis_queue, queue_names: list[str]) -> list[tuple[bytes, float, bytes | None]]:
+        """
+        Pop the (payload json, score, id) of the next work item, followed by the ones prefetched from the work queue,
+        which are held by the worker (see `_hold_items`). The parts of the node are not prefetched, they are left to the idle workers.
+        """
+        size = self._prefetch_size()
+        if _STREAM_QUEUE:
+            items = self._claim_stale(redis_queue, size)
+            if not items:
+                # an idle worker also claims the stale entries
+                items = redis_queue.wqueue.pop(
+                    app_config.REDIS_WORK_QUEUE_NAME, self.worker_id, count=size,
+                    timeout=min(app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT, app_config.WORK_LEASE_REAP_INTERVAL),
+                    unleased_queue_names=queue_names[:-1]
+                )
+        elif _LEASED_QUEUE:
+            items = redis_queue.lease.block_pop(
+                app_config.REDIS_WORK_QUEUE_NAME, self._inflight_name, _lease_owners_name(), self.worker_id,
+                count=size, lease_time=_LEASE_TIME, unleased_queue_names=queue_names[:-1],
+                timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT
             )
-            work_item = redis_queue.pqueue.block_pop(app_config.REDIS_WORK_QUEUE_NAME, timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT)
-            if not work_item:
-                continue
-            _, payload_json, _ = work_item
+        else:
+            items = redis_queue.wqueue.pop(
+                app_config.REDIS_WORK_QUEUE_NAME, count=size, unindexed_queue_names=queue_names[:-1],
+                timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT
+            )
+        self._hold_items(items)
+        return items
 
-            payload = None
-            result = None
-            result_queue_name = None
-            long_running = False
+    def _claim_stale(self, redis_queue, count: int) -> list[tuple[bytes, float, bytes]]:
+        """Take the stream entries pending longer than a lease (e.g. of dead workers), every WORK_LEASE_REAP_INTERVAL"""
+        if monotonic() - self._last_claim < app_config.WORK_LEASE_REAP_INTERVAL:
+            return []
+        self._last_claim = monotonic()
+        items = redis_queue.wqueue.claim(app_config.REDIS_WORK_QUEUE_NAME, self.worker_id, _LEASE_TIME, count)
+        if items:
+            logger.warning(f'Worker {self.worker_id} claimed {len(items)} work items pending longer than {_LEASE_TIME} seconds')
+        return items
+
+    def _hold_items(self, items: list[tuple[bytes, float, bytes | None]]):
+        """
+        Keep the lease of every popped work item of the work queue to release it with `_lease_ops`:
+        (work queue, in-flight set, work id) with RELIABLE_QUEUE, or else (work queue, work id or stream entry id).
+        The parts of the node (without an id) are not held.
+        """
+        for payload_json, _, item_id in items:
+            if item_id:
+                self._leased[payload_json] = (app_config.REDIS_WORK_QUEUE_NAME, self._inflight_name, item_id) \
+                    if _LEASED_QUEUE else (app_config.REDIS_WORK_QUEUE_NAME, item_id)
+
+    def _prepare_leases(self, redis_queue):
+        """Create the consumer group of a stream work queue, and start renewing the work items held by the worker"""
+        if _STREAM_QUEUE:
+            redis_queue.wqueue.create_group(app_config.REDIS_WORK_QUEUE_NAME)
+        elif not _LEASED_QUEUE:
+            return
+        if self._renew_thread is None:
+            self._renew_thread = threading.Thread(target=self._renew_leases, name='lease-renewer', daemon=True)
+            self._renew_thread.start()
+
+    def _renew_leases(self):
+        """
+        Renew the work items held by the worker every third of a lease while it is alive, so they are not put back
+        or claimed by other workers however long they are judged (e.g. with a compilation or a cold lean REPL first).
+        """
+        redis_queue = connect_queue(False)
+        while True:
+            sleep(_LEASE_TIME / 3)
             try:
-                payload = WorkPayload.model_validate_json(payload_json)
-                long_running = payload.long_running
-                result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{payload.work_id}'
-                if not long_running and (lifetime := time() - payload.timestamp) >= app_config.MAX_QUEUE_WORK_LIFE_TIME:
-                    logger.warning(f'Work {payload.work_id} lifetime ({lifetime:.2f}>{app_config.MAX_QUEUE_WORK_LIFE_TIME}) timed out. '
-                                f'Ignored. Concurrency is too hight?')
-                    continue
-                # set the max process time
-                self.shared[self.worker_id] = payload.submission.timeout + 5
-                result = judge(payload.submission)
-            except ValidationError:
-                logger.exception(f'Failed to parse payload {payload_json}')
+                self._renew_held(redis_queue)
+            except Exception:
+                logger.exception('Failed to renew the work items of the worker')
+
+    def _renew_held(self, redis_queue, leases: list[tuple] | None = None):
+        """
+        Extend the `leases` (default all held by the worker) to a whole lease from now,
+        or reset the idle time of the stream entries.
+        """
+        leases = list(self._leased.values()) if leases is None else leases
+        if not leases:
+            return
+        if _STREAM_QUEUE:
+            redis_queue.wqueue.renew(app_config.REDIS_WORK_QUEUE_NAME, self.worker_id, *[lease[-1] for lease in leases])
+        else:
+            for _, inflight_name, member in leases:
+                redis_queue.lease.renew(inflight_name, member, _LEASE_TIME)
+
+    def _take_lease(self, payload_json: bytes) -> tuple[str, bytes] | None:
+        """The lease of a work item to release, or None if it is not leased"""
+        return self._leased.pop(payload_json, None)
+
+    def _take_over_lease(self, redis_queue, payload_json: bytes, payload: WorkPayload) -> bool:
+        """
+        Hold the lease carried by a work item handed off to the compile stage of the node (see `_hand_off`),
+        so it is put back to the work queue if this worker dies instead of the one which handed it off.
+        Return False if the lease is gone, e.g. it expired and the work item was put back.
+        """
+        if not payload.lease or not (_LEASED_QUEUE or _STREAM_QUEUE):
+            return True
+        if not self._transfer_lease(redis_queue, payload.lease):
+            return False
+        queue_name, *_, item_id = payload.lease
+        self._leased[payload_json] = (queue_name, self._inflight_name, item_id) if _LEASED_QUEUE else (queue_name, item_id)
+        return True
+
+    def _transfer_lease(self, redis_queue, lease: list[str]):
+        """Move a carried lease to this worker for a whole lease, whose result is empty if the lease is gone"""
+        if _LEASED_QUEUE:
+            _, inflight_name, member = lease
+            return redis_queue.lease.transfer(
+                inflight_name, self._inflight_name, _lease_owners_name(), self.worker_id, member, _LEASE_TIME
+            )
+        queue_name, entry_id = lease
+        return redis_queue.wqueue.renew(queue_name, self.worker_id, entry_id)
+
+    def _prefetch_size(self) -> int:
+        """The number of work items to claim at a time, so the claimed ones wait about WORKER_PREFETCH_TIME at most"""
+        if app_config.WORKER_PREFETCH <= 1 or self._judge_time is None:
+            return 1
+        return max(1, min(app_config.WORKER_PREFETCH, int(app_config.WORKER_PREFETCH_TIME / max(self._judge_time, 1e-3))))
+
+    def _update_judge_time(self, seconds: float):
+        # moving average of the recent judge times
+        self._judge_time = seconds if self._judge_time is None else 0.8 * self._judge_time + 0.2 * seconds
+
+    def _requeue_prefetched(self, redis_queue, prefetched: deque, max_wait: float | None = None):
+        """Put the claimed work items waiting longer than `max_wait` (default WORKER_PREFETCH_TIME) back to the work queue"""
+        max_wait = app_config.WORKER_PREFETCH_TIME if max_wait is None else max_wait
+        now = monotonic()
+        expired = {payload_json: score for payload_json, score, claimed_at in prefetched if now - claimed_at >= max_wait}
+        if not expired:
+            return
+        # the prefetched work items are all held, and put back by their ids
+        items = [(payload_json, score, self._leased.pop(payload_json)[-1]) for payload_json, score in expired.items()]
+        if _LEASED_QUEUE:
+            redis_queue.lease.requeue(
+                app_config.REDIS_WORK_QUEUE_NAME, self._inflight_name, _lease_owners_name(), self.worker_id,
+                *[item_id for _, _, item_id in items]
+            )
+        else:
+            redis_queue.wqueue.requeue(app_config.REDIS_WORK_QUEUE_NAME, items)
+        remaining = [item for item in prefetched if item[0] not in expired]
+        prefetched.clear()
+        prefetched.extend(remaining)
+
+    def _set_max_process_time(self, seconds: float):
+        """Let the manager know how long a command of the current work item can run before it is considered hanged"""
+        self.shared[self.worker_id] = seconds
+
+    def _process(self, redis_queue, payload_json: bytes) -> tuple[str, SubmissionResult | BatchSubmissionResult, bool] | None:
+        """
+        Judge a work item, and return the (result queue name, result, long_running) to push, or None if there is none.
+        Without `redis_queue`, the work item is not handed off or fanned out.
+        """
+        payload = None
+        result = None
+        result_queue_name = None
+        long_running = False
+        try:
+            payload = WorkPayload.model_validate_json(payload_json)
+            long_running = payload.long_running
+            result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{payload.work_id}'
+            if not self._take_over_lease(redis_queue, payload_json, payload):
+                logger.warning(f'Work {payload.work_id} lost its lease after it was handed off. Ignored.')
+                if payload.artifact and payload.parent_id is None:
+                    Path(payload.artifact.path).unlink(missing_ok=True)
+                return None
+            # a compiled submission has been taken before the compilation
+            if not long_running and payload.artifact is None \
+                    and (lifetime := time() - payload.timestamp) >= app_config.MAX_QUEUE_WORK_LIFE_TIME:
+                logger.warning(f'Work {payload.work_id} lifetime ({lifetime:.2f}>{app_config.MAX_QUEUE_WORK_LIFE_TIME}) timed out. '
+                            f'Ignored. Concurrency is too hight?')
+                return None
+            if redis_queue is not None and self._hand_off(redis_queue, payload, payload_json):
+                return None
+            # set the max process time
+            self._set_max_process_time(_max_process_time(payload.submission))
+            if isinstance(payload.submission, BatchSubmission):
+                result = judge_batch(payload.submission)
+            elif redis_queue is None or (result := self._fan_out(redis_queue, payload)) is None:
                 try:
-                    payload_dict = json.load(payload_json)
-                    work_id = payload_dict.get('work_id')
-                    sub_id = payload_dict.get('submission', {}).get('sub_id')
-                    long_running = payload_dict.get('long_running', False)
-                except Exception:
-                    work_id = None
-                    sub_id = None
-                    long_running = False
-                if work_id and sub_id:
-                    result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{work_id}'
-                    result = SubmissionResult(
-                        sub_id=sub_id,
-                        run_success=False,
-                        success=False,
-                        cost=0,
-                        reason=ResultReason.INVALID_INPUT
-                    )
-                else:
-                    logger.error(f'Failed to parse payload {payload_json}')
-                    continue
+                    result = judge(payload.submission, payload.artifact)
+                finally:
+                    # the artifact of a part is removed by the worker which fanned it out
+                    if payload.artifact and payload.parent_id is None:
+                        Path(payload.artifact.path).unlink(missing_ok=True)
+        except ValidationError:
+            logger.exception(f'Failed to parse payload {payload_json}')
+            try:
+                payload_dict = json.load(payload_json)
+                work_id = payload_dict.get('work_id')
+                sub_id = payload_dict.get('submission', {}).get('sub_id')
+                long_running = payload_dict.get('long_running', False)
             except Exception:
-                logger.exception(f'Worker failed to process work item {payload_json}')
-                if payload is not None and result_queue_name is not None:
-                    long_running = payload.long_running
-                    result = SubmissionResult(
+                work_id = None
+                sub_id = None
+                long_running = False
+            if work_id and sub_id:
+                result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{work_id}'
+                result = SubmissionResult(
+                    sub_id=sub_id,
+                    run_success=False,
+                    success=False,
+                    cost=0,
+                    reason=ResultReason.INVALID_INPUT
+                )
+            else:
+                logger.error(f'Failed to parse payload {payload_json}')
+                return None
+        except Exception:
+            logger.exception(f'Worker failed to process work item {payload_json}')
+            if payload is not None and result_queue_name is not None:
+                long_running = payload.long_running
+                result = SubmissionResult(
+                    sub_id=payload.submission.sub_id,
+                    run_success=False,
+                    success=False,
+                    cost=0,
+                    reason=ResultReason.INTERNAL_ERROR
+                )
+                if isinstance(payload.submission, BatchSubmission):
+                    result = BatchSubmissionResult(
                         sub_id=payload.submission.sub_id,
-                        run_success=False,
-                        success=False,
-                        cost=0,
-                        reason=ResultReason.INTERNAL_ERROR
+                        results=[result.model_copy(update={'sub_id': s.sub_id}) for s in payload.submission.submissions]
                     )
-                else:
-                    logger.error(f'Failed to process work item {payload_json}')
-                    continue
+            else:
+                logger.error(f'Failed to process work item {payload_json}')
+                return None
+
+        return result_queue_name, result, long_running
 
-            redis_queue.queue.push(result_queue_name, result.model_dump_json())
-            redis_queue.expire(
-                result_queue_name,
-                app_config.REDIS_RESULT_EXPIRE
-                    if not long_running
-                    else app_config.REDIS_RESULT_LONG_BATCH_EXPIRE
+    def _create_cgroup_slots(self):
+        global _cgroup_slots
+        if not self.cgroup_root or app_config.CGROUP_SLOTS <= 0:
+            return
+        try:
+            _cgroup_slots = CgroupSlotPool(
+                self.cgroup_root, f'worker-{os.getpid()}', max(app_config.CGROUP_SLOTS, self.concurrency)
             )
+            # fail early if the limits can't be set
+            for slot in _cgroup_slots.slots:
+                slot.configure(1, app_config.MAX_MEMORY * 1024 * 1024)
+        except (CgroupError, OSError):
+            logger.exception('Failed to create cgroup slots. Falling back to systemd-run.')
+            if _cgroup_slots:
+                _cgroup_slots.close()
+            _cgroup_slots = None
+
+    def _create_workspaces(self):
+        global _workspaces
+        if not app_config.WORKSPACE_ROOT:
+            return
+        try:
+            # one per work item judged at a time, whatever the cgroup slots are
+            _workspaces = WorkspacePool(app_config.WORKSPACE_ROOT, f'worker-{os.getpid()}', self.concurrency)
+        except WorkspaceError:
+            logger.exception('Failed to create workspaces. Falling back to temporary directories.')
+            _workspaces = None
 
     def run(self):
+        self._create_cgroup_slots()
+        self._create_workspaces()
+        # let the manager know which child processes are long-lived helpers instead of hanged submissions
+        set_persistent_listener(
+            lambda pgids: self.shared.__setitem__(f'{self.worker_id}:persistent', list(pgids))
+        )
         while True:
             try:
                 self._run_loop()
@@ -210,18 +903,258 @@ class Worker(Process):
                 sleep(60)
 
 
+class AsyncWorker(Worker):
+    """
+    A worker judging WORKER_SLOTS work items at the same time in one process, instead of one process per work item.
+    The work items are popped with one async redis client when a slot is free, and judged in a thread per slot,
+    whose commands are killed by the worker itself when they run over the max process time of their work item.
+    Compiled submissions are not handed off and test cases are not fanned out, as the slots already use the cores.
+    """
+    concurrency = app_config.WORKER_SLOTS
+
+    def __init__(self, shared_dict: dict, cgroup_root: Path | None = None, node_id: str | None = None):
+        super().__init__(shared_dict, cgroup_root, node_id)
+        # the max process time of the work item judged by every slot thread
+        self._max_process_times: dict[int, float] = {}
+
+    def _set_max_process_time(self, seconds: float):
+        self._max_process_times[threading.get_ident()] = seconds
+
+    def _judge(self, payload_json: bytes):
+        try:
+            return self._process(None, payload_json)
+        finally:
+            self._max_process_times.pop(threading.get_ident(), None)
+
+    def _transfer_lease(self, redis_queue, lease: list[str]):
+        # called in a slot thread, while the async client belongs to the event loop
+        return asyncio.run_coroutine_threadsafe(super()._transfer_lease(self._redis_queue, lease), self._loop).result()
+
+    async def _claim_async(self, redis_queue, queue_names: list[str]) -> bytes | None:
+        """Pop the payload json of the next work item, which is held by the worker (see `_hold_items`)"""
+        if _STREAM_QUEUE:
+            if monotonic() - self._last_claim >= app_config.WORK_LEASE_REAP_INTERVAL:
+                self._last_claim = monotonic()
+                items = await redis_queue.wqueue.claim(app_config.REDIS_WORK_QUEUE_NAME, self.worker_id, _LEASE_TIME)
+            else:
+                items = []
+            if not items:
+                # an idle worker also claims the stale entries
+                items = await redis_queue.wqueue.pop(
+                    app_config.REDIS_WORK_QUEUE_NAME, self.worker_id,
+                    timeout=min(app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT, app_config.WORK_LEASE_REAP_INTERVAL),
+                    unleased_queue_names=queue_names[:-1]
+                )
+            # one work item per slot
+            if extra := [item for item in items[1:] if item[2]]:
+                await redis_queue.wqueue.requeue(app_config.REDIS_WORK_QUEUE_NAME, extra)
+        elif _LEASED_QUEUE:
+            items = await redis_queue.lease.block_pop(
+                app_config.REDIS_WORK_QUEUE_NAME, self._inflight_name, _lease_owners_name(), self.worker_id,
+                lease_time=_LEASE_TIME, unleased_queue_names=queue_names[:-1],
+                timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT
+            )
+        else:
+            items = await redis_queue.wqueue.pop(
+                app_config.REDIS_WORK_QUEUE_NAME, unindexed_queue_names=queue_names[:-1],
+                timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT
+            )
+        if not items:
+            return None
+        self._hold_items(items[:1])
+        return items[0][0]
+
+    async def _watch_deadlines(self):
+        while True:
+            await asyncio.sleep(1)
+            now = monotonic()
+            for thread_id, (pgid, start) in running_pgids().items():
+                max_process_time = self._max_process_times.get(thread_id, app_config.MAX_PROCESS_TIME)
+                if now - start > max_process_time:
+                    logger.info(f'Worker {self.worker_id} command is running for {now - start} seconds. Terminating...')
+                    nothrow_killpg(pgid=pgid)
+
+    async def _run_slot(self, redis_queue, executor: ThreadPoolExecutor, slots: asyncio.Semaphore, payload_json: bytes):
+        try:
+            processed = await asyncio.get_running_loop().run_in_executor(executor, self._judge, payload_json)
+            lease = self._take_lease(payload_json)
+            if processed is not None:
+                await _push_result_async(redis_queue, *processed, lease=lease)
+            elif lease:
+                await _lease_ops(redis_queue).release(*lease)
+        except Exception:
+            logger.exception(f'Worker failed to push the result of work item {payload_json}')
+        finally:
+            slots.release()
+
+    async def _run_loop_async(self):
+        redis_queue = connect_queue(True)
+        self._redis_queue = redis_queue
+        self._loop = asyncio.get_running_loop()
+        # the group is created with a sync client, as it is done once
+        self._prepare_leases(connect_queue(False))
+        queue_names = [app_config.REDIS_WORK_QUEUE_NAME]
+        if self.node_id:
+            queue_names.insert(0, _node_queue_name('ready', self.node_id))
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='slot') as executor:
+            watchdog = asyncio.create_task(self._watch_deadlines())
+            try:
+                while True:
+                    await slots.acquire()
+                    try:
+                        await redis_queue.set(
+                            f'{app_config.REDIS_WORKER_ID_PREFIX}{self.worker_id}',
+                            1,
+                            app_config.REDIS_WORKER_REGISTER_EXPIRE
+                        )
+                        payload_json = await self._claim_async(redis_queue, queue_names)
+                    except BaseException:
+                        slots.release()
+                        raise
+                    if payload_json is None:
+                        slots.release()
+                        continue
+                    task = asyncio.create_task(self._run_slot(redis_queue, executor, slots, payload_json))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            finally:
+                watchdog.cancel()
+                # the running work items are finished before the loop is retried
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _run_loop(self):
+        asyncio.run(self._run_loop_async())
+
+
+class CompileWorker(Worker):
+    """
+    The compile stage of a node: compiles the c++ submissions handed off by the workers of the node
+    to CPP_ARTIFACT_PATH, and queues them back for the workers, which run them before new work items.
+    """
+    def _create_cgroup_slots(self):
+        # the compiler doesn't run in a slot
+        pass
+
+    def _run_loop(self):
+        redis_queue = connect_queue(False)
+        compile_queue = _node_queue_name('compile', self.node_id)
+        ready_queue = _node_queue_name('ready', self.node_id)
+        artifact_dir = Path(app_config.CPP_ARTIFACT_PATH) / self.node_id
+        artifact_dir.mkdir(parents=True, exist_ok=True)
+        while True:
+            redis_queue.set(
+                f'{app_config.REDIS_WORKER_ID_PREFIX}{self.worker_id}',
+                1,
+                app_config.REDIS_WORKER_REGISTER_EXPIRE
+            )
+            work_item = redis_queue.pqueue.block_pop(compile_queue, timeout=app_config.REDIS_WORK_QUEUE_BLOCK_TIMEOUT)
+            if not work_item:
+                continue
+            _, payload_json, score = work_item
+            payload = WorkPayload.model_validate_json(payload_json)
+            sub = payload.submission
+            result_queue_name = f'{app_config.REDIS_RESULT_PREFIX}{payload.work_id}'
+            if not self._take_over_lease(redis_queue, payload_json, payload):
+                logger.warning(f'Work {payload.work_id} lost its lease before it was compiled. Ignored.')
+                continue
+            self.shared[self.worker_id] = sub.timeout + 5
+            try:
+                with _workspace() as workspace:
+                    executor = executor_factory(
+                        type=sub.type, timeout=sub.timeout, memory_limit=sub.memory_limit, cpu_core=sub.cpu_core,
+                        options=sub.options, workspace=workspace
+                    )
+                    payload.artifact = executor.compile(sub.solution, str(artifact_dir / payload.work_id), sub.timeout)
+            except CompileError as e:
+                result = _to_submission_result(
+                    sub, ProcessExecuteResult(stdout='', stderr=str(e), exit_code=COMPILE_ERROR_EXIT_CODE, cost=0)
+                )
+                _push_result(redis_queue, result_queue_name, result, payload.long_running, lease=self._take_lease(payload_json))
+                continue
+            except Exception as e:
+                logger.exception(f'Compile worker failed to compile submission {sub.sub_id}')
+                save_error_case(sub, None, e)
+                result = SubmissionResult(
+                    sub_id=sub.sub_id, run_success=False, success=False, cost=0, reason=ResultReason.INTERNAL_ERROR
+                )
+                _push_result(redis_queue, result_queue_name, result, payload.long_running, lease=self._take_lease(payload_json))
+                continue
+            if lease := self._take_lease(payload_json):
+                # a whole lease for the wait in the ready queue, until a worker takes it over
+                self._renew_held(redis_queue, [lease])
+                payload.lease = _carried_lease(lease)
+            redis_queue.pqueue.push(ready_queue, {payload.model_dump_json(): score})
+
+
+def _remove_stale_artifacts():
+    """Remove the artifacts left by the compile workers of previous runs"""
+    root = Path(app_config.CPP_ARTIFACT_PATH)
+    if not root.is_dir():
+        return
+    for path in root.iterdir():
+        try:
+            if time() - path.stat().st_mtime > app_config.LONG_BATCH_MAX_QUEUE_WAIT_TIME:
+                shutil.rmtree(path, ignore_errors=True)
+        except FileNotFoundError:
+            pass
+
+
 class WorkerManager:
     def __init__(self):
         # global dict shared with all workers for timeout control
         self.shared = Manager().dict()
         max_workers = app_config.MAX_WORKERS
+        self.cgroup_root = None
+        if app_config.CGROUP_SLOTS > 0:
+            try:
+                self.cgroup_root = prepare_cgroup_root(app_config.CGROUP_ROOT)
+            except CgroupError:
+                logger.warning('cgroup v2 is not available. Falling back to systemd-run.', exc_info=True)
+        # identifies the queues shared by the workers and compile workers of this node
+        self.node_id = uuid.uuid4().hex
         self.workers: list[Worker] = []
+        if app_config.WORKSPACE_ROOT:
+            remove_stale_workspaces(app_config.WORKSPACE_ROOT)
+        # several work items are judged by every worker with WORKER_SLOTS
+        worker_type = AsyncWorker if app_config.WORKER_SLOTS > 1 else Worker
         logger.info(f'Starting {max_workers} workers...')
         for _ in range(max_workers):
-            worker = Worker(self.shared)
+            worker = worker_type(self.shared, self.cgroup_root, self.node_id)
             worker.start()
             self.workers.append(worker)
         logger.info(f'Started {max_workers} workers')
+        if app_config.CPP_COMPILE_WORKERS > 0:
+            _remove_stale_artifacts()
+            for _ in range(app_config.CPP_COMPILE_WORKERS):
+                worker = CompileWorker(self.shared, self.cgroup_root, self.node_id)
+                worker.start()
+                self.workers.append(worker)
+            logger.info(f'Started {app_config.CPP_COMPILE_WORKERS} compile workers')
+        if _LEASED_QUEUE:
+            self._redis_queue = connect_queue(False)
+            self._reap_thread = threading.Thread(target=self._reap_leases, name='lease-reaper')
+            self._reap_thread.daemon = True
+            self._reap_thread.start()
+
+    def _requeue_leases(self, worker_id: str, expired_only: bool = True) -> int:
+        return self._redis_queue.lease.requeue(
+            app_config.REDIS_WORK_QUEUE_NAME, _inflight_name(worker_id), _lease_owners_name(), worker_id,
+            expired_only=expired_only
+        )
+
+    def _reap_leases(self):
+        """Put the work items of the expired leases (e.g. of the dead workers of any node) back to the work queue"""
+        while True:
+            try:
+                for worker_id in self._redis_queue.lease.owners(_lease_owners_name()):
+                    worker_id = worker_id.decode()
+                    if requeued := self._requeue_leases(worker_id):
+                        logger.warning(f'Requeued {requeued} work items whose leases of worker {worker_id} expired')
+            except Exception:
+                logger.exception('Failed to requeue the expired leases')
+            sleep(app_config.WORK_LEASE_REAP_INTERVAL)
 
     def run(self):
         while True:
@@ -244,7 +1177,17 @@ class WorkerManager:
         for i, worker in enumerate(self.workers):
             if not worker.is_alive():
                 logger.error('Worker dead. Restarting...')
-                worker = Worker()
+                if _LEASED_QUEUE:
+                    # its work items are judged by other workers right away
+                    requeued = self._requeue_leases(worker.worker_id, expired_only=False)
+                    logger.info(f'Requeued {requeued} work items of dead worker {worker.worker_id}')
+                # a dead worker doesn't take parts of the fan-out
+                self.shared.pop(_idle_key(worker.worker_id), None)
+                if self.cgroup_root:
+                    remove_slots(self.cgroup_root, f'worker-{worker.pid}')
+                if app_config.WORKSPACE_ROOT:
+                    remove_workspaces(app_config.WORKSPACE_ROOT, f'worker-{worker.pid}')
+                worker = type(worker)(self.shared, self.cgroup_root, self.node_id)
                 worker.start()
                 self.workers[i] = worker
                 failed_workers += 1
@@ -252,11 +1195,18 @@ class WorkerManager:
                 try:
                     worker_p = psutil.Process(worker.pid)
                     max_process_time = self.shared.get(worker.worker_id, app_config.MAX_PROCESS_TIME)
+                    persistent_pgids = set(self.shared.get(f'{worker.worker_id}:persistent', []))
                     is_busy = 0
                     is_hanged = 0
                     for subp in worker_p.children(recursive=True):
+                        try:
+                            if os.getpgid(subp.pid) in persistent_pgids:
+                                continue
+                        except OSError:
+                            continue
                         is_busy = 1
-                        if subp.is_running() and time() - subp.create_time() > max_process_time:
+                        # an async worker kills the commands of its slots by itself
+                        if not isinstance(worker, AsyncWorker) and subp.is_running() and time() - subp.create_time() > max_process_time:
                             is_hanged = 1
                             logger.info(f'Worker {worker.worker_id} is running for {time() - subp.create_time()} seconds. Terminating...')
                             nothrow_killpg(pid=subp.pid)
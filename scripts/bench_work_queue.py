@@ -0,0 +1,67 @@
+"""
+Benchmark the throughput and tail latency of the work queue backends (see WORK_QUEUE_BACKEND) on a redis server.
+
+    python scripts/bench_work_queue.py --redis redis://localhost:6379/0 --count 2000
+
+It needs a live redis server: the fakeredis of the tests has no meaningful timing. The setup and the numbers of a run are in updated.md.
+"""
+import argparse
+import json
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.libs.redis_queue import RedisQueue  # noqa: E402
+
+
+def bench(redis_uri: str, backend: str, count: int, consumers: int, payload_size: int):
+    queue = RedisQueue(redis_uri, socket_timeout=30, work_queue_backend=backend)
+    queue_name = f'benchmark:{backend}:{uuid.uuid4()}'
+    if backend == 'stream':
+        queue.wqueue.create_group(queue_name)
+    padding = 'x' * payload_size
+
+    def consume(consumer):
+        latencies = []
+        while True:
+            if backend == 'stream':
+                items = queue.wqueue.pop(queue_name, consumer, timeout=1)
+            else:
+                items = queue.wqueue.pop(queue_name, timeout=1)
+            if not items:
+                return latencies
+            queue.wqueue.release(queue_name, *[item_id for _, _, item_id in items])
+            for payload, _, _ in items:
+                latencies.append(time.time() - json.loads(payload)['time'])
+
+    try:
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=consumers) as executor:
+            futures = [executor.submit(consume, f'consumer-{i}') for i in range(consumers)]
+            for i in range(count):
+                queue.wqueue.push(
+                    queue_name, {str(i): time.time()},
+                    {str(i): json.dumps({'id': i, 'time': time.time(), 'padding': padding})}
+                )
+            latencies = sorted(latency for future in futures for latency in future.result())
+        elapsed = time.time() - start - 1  # the last wait of the consumers
+    finally:
+        queue.delete(queue_name, queue.payloads_name(queue_name))
+    print(f'{backend}: {len(latencies) / elapsed:.0f} items/s, '
+          f'p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the work queue backends.")
+    parser.add_argument('--redis', default='redis://localhost:6379/0', help="The redis to benchmark on.")
+    parser.add_argument('--backend', choices=['zset', 'stream'], action='append', help="Default: both.")
+    parser.add_argument('--count', type=int, default=2000, help="The number of work items.")
+    parser.add_argument('--consumers', type=int, default=4, help="The number of consumer threads.")
+    parser.add_argument('--payload-size', type=int, default=1024, help="The padding of every payload in bytes.")
+    args = parser.parse_args()
+    for backend in args.backend or ['zset', 'stream']:
+        bench(args.redis, backend, args.count, args.consumers, args.payload_size)
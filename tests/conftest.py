@@ -67,3 +67,21 @@ def test_client():
 
         redis_process.kill()
         redis_process.join()
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """
+    An in-memory redis (with lua scripts) for every RedisQueue created in the test,
+    to test the queues and the workers without the test client and its workers.
+    """
+    from app.libs.redis_queue import RedisQueue
+
+    server = fakeredis.FakeServer()
+
+    def _init_redis(self, socket_timeout):
+        Redis = fakeredis.FakeAsyncRedis if self.is_async else fakeredis.FakeRedis
+        return Redis(server=server)
+
+    monkeypatch.setattr(RedisQueue, '_init_redis', _init_redis)
+    return server
@@ -1,5 +1,7 @@
 import pytest
 import json
+import uuid
+import time
 
 def test_status(test_client):
     """
@@ -967,4 +969,1514 @@ theorem imo_2019_p1 (f : ℤ → ℤ) :
     assert  results[0]['success']
     assert  results[0]['run_success']
     assert not results[1]['success']
-    assert results[1]['run_success']
\ No newline at end of file
+    assert results[1]['run_success']
+
+@pytest.mark.parametrize("type", ["run"])
+@pytest.mark.parametrize("batch_type", ["batch", "long-batch"])
+def test_lean_packed_batch(test_client, type, batch_type):
+    # submissions with the same resource limits are checked in one REPL session
+    solutions = [
+        "theorem t1 (a b : ℕ) : a + b = b + a := by\n  exact Nat.add_comm a b",
+        "theorem t2 (a b : ℕ) : a + b = b + a := by\n  sorry",
+        "theorem t3 (x : ℝ) (h : 2 * x = 4) : x = 2 := by\n  linarith",
+        "theorem t4 (a : ℕ) : a = a + 1 := by\n  simp",
+    ]
+    data = {
+        'type': 'batch',
+        'submissions': [{
+            "type": "lean",
+            "solution": solution,
+            "expected_output": "",
+            'timeout': 600,
+        } for solution in solutions]
+    }
+    response = test_client.post(f'{type}/{batch_type}', json=data)
+
+    print(response.json())
+    assert response.status_code == 200
+    results = response.json()['results']
+
+    assert len(results) == 4
+    assert [r['success'] for r in results] == [True, False, True, False]
+    assert all(r['run_success'] for r in results)
+    assert json.loads(results[1]['stderr'])['sorries'][0]['proofState'] == 0
+
+
+@pytest.mark.parametrize("type", ["run"])
+@pytest.mark.parametrize("imports", ["Mathlib.Tactic.Linarith Mathlib.Data.Real.Basic", "auto"])
+def test_lean_minimal_imports(test_client, type, imports):
+    data = {
+        "type": "lean",
+        "options": {"imports": imports},
+        "solution": "theorem t (x : ℝ) (h : 2 * x = 4) : x = 2 := by\n  linarith",
+        "expected_output": "",
+        'timeout': 600,
+    }
+    response = test_client.post(f'/{type}', json=data)
+
+    print(response.json())
+    assert response.status_code == 200
+    assert response.json()['success']
+    assert response.json()['run_success']
+
+
+@pytest.mark.parametrize("type", ["run"])
+def test_lean_prefix_cache(test_client, type):
+    # the submissions share the leading lemma, which is only elaborated once
+    prefix = "theorem helper (a b : ℕ) : a + b = b + a := by\n  exact Nat.add_comm a b\n\n"
+    data = {
+        'type': 'batch',
+        'submissions': [{
+            "type": "lean",
+            "solution": prefix + solution,
+            "expected_output": "",
+            'timeout': 600,
+        } for solution in [
+            "theorem t1 (x y : ℕ) : x + y = y + x := helper x y",
+            "theorem t2 (x : ℕ) : x + 0 = 0 + x := helper x 0",
+        ]]
+    }
+    response = test_client.post(f'{type}/batch', json=data)
+
+    print(response.json())
+    assert response.status_code == 200
+    results = response.json()['results']
+
+    assert [r['success'] for r in results] == [True, True]
+    assert results[0]['cache'] == {'hits': 0, 'misses': 1}
+    assert results[1]['cache'] == {'hits': 1, 'misses': 0}
+
+
+def test_cpp_binary_cache(test_client):
+    # the second submission of the same solution reuses the compiled binary
+    data = {
+        "type": "cpp",
+        "solution": f"""#include <cstdio>
+int main(){{puts("{uuid.uuid4()}");return 0;}}
+""",
+    }
+    results = []
+    for _ in range(2):
+        response = test_client.post('/run', json=data)
+        print(response.json())
+        assert response.status_code == 200
+        assert response.json()['success']
+        results.append(response.json())
+    assert results[0]['cache'] == {'hits': 0, 'misses': 1}
+    assert results[1]['cache'] == {'hits': 1, 'misses': 0}
+    assert results[0]['stdout'] == results[1]['stdout']
+
+
+def test_cpp_binary_cache_across_limits(test_client):
+    # the limits are applied when the binary starts, so they don't invalidate the cached binary
+    solution = f"""#include <cstdio>
+int main(){{puts("{uuid.uuid4()}");return 0;}}
+"""
+    results = []
+    for timeout, memory_limit in [(5, 256), (10, 512)]:
+        data = {
+            "type": "cpp",
+            "solution": solution,
+            "timeout": timeout,
+            "memory_limit": memory_limit,
+        }
+        response = test_client.post('/run', json=data)
+        print(response.json())
+        assert response.status_code == 200
+        assert response.json()['success']
+        results.append(response.json())
+    assert results[0]['cache'] == {'hits': 0, 'misses': 1}
+    assert results[1]['cache'] == {'hits': 1, 'misses': 0}
+
+
+@pytest.mark.parametrize("stop_on_failure", [False, True])
+def test_cpp_test_cases(test_client, stop_on_failure):
+    # compiled once, and run against every test case
+    data = {
+        "type": "cpp",
+        "solution": """#include <cstdio>
+int main(){int a;scanf("%d",&a);printf("%d\\n",a*2);return 0;}
+""",
+        "test_cases": [
+            {"input": "1", "expected_output": "2"},
+            {"input": "2", "expected_output": "5"},
+            {"input": "3", "expected_output": "6"},
+        ],
+        "stop_on_failure": stop_on_failure,
+    }
+    response = test_client.post('/run', json=data)
+    print(response.json())
+    assert response.status_code == 200
+    result = response.json()
+    assert not result['success']
+    assert result['run_success']
+    assert result['stdout'].strip() == '4'
+    verdicts = [r['success'] for r in result['test_results']]
+    assert verdicts == ([True, False] if stop_on_failure else [True, False, True])
+
+
+def test_python_test_cases(test_client):
+    data = {
+        "type": "python",
+        "solution": "print(int(input()) + 1)",
+        "test_cases": [
+            {"input": "1", "expected_output": "2"},
+            {"input": "2", "expected_output": "3"},
+        ],
+    }
+    response = test_client.post('/run', json=data)
+    print(response.json())
+    assert response.status_code == 200
+    assert response.json()['success']
+    assert [r['success'] for r in response.json()['test_results']] == [True, True]
+
+
+def test_cpp_test_cases_fan_out(test_client):
+    # at least CPP_FANOUT_MIN_CASES test cases are spread over the workers, and merged in order
+    data = {
+        "type": "cpp",
+        "solution": """#include <cstdio>
+int main(){int a;scanf("%d",&a);printf("%d\\n",a*2);return 0;}
+""",
+        "test_cases": [
+            {"input": str(i), "expected_output": str(i * 2 if i != 20 else -1)}
+            for i in range(32)
+        ],
+    }
+    response = test_client.post('/run', json=data)
+    print(response.json())
+    assert response.status_code == 200
+    result = response.json()
+    assert not result['success']
+    assert result['stdout'].strip() == '40'
+    assert [r['success'] for r in result['test_results']] == [i != 20 for i in range(32)]
+
+
+def test_python_entry_point(test_client):
+    # all test cases are function calls in one interpreter, compared as json values
+    data = {
+        "type": "python",
+        "solution": """
+class Solution:
+    def twoSum(self, nums, target):
+        seen = {}
+        for i, x in enumerate(nums):
+            if target - x in seen:
+                return [seen[target - x], i]
+            seen[x] = i
+""",
+        "entry_point": "Solution.twoSum",
+        "test_cases": [
+            {"input": "[[2, 7, 11, 15], 9]", "expected_output": "[0, 1]"},
+            {"input": '{"nums": [3, 2, 4], "target": 6}', "expected_output": "[1, 2]"},
+            {"input": "[[3, 3], 6]", "expected_output": "[1, 0]"},
+        ],
+    }
+    response = test_client.post('/run', json=data)
+    print(response.json())
+    assert response.status_code == 200
+    result = response.json()
+    assert not result['success']
+    assert result['run_success']
+    assert [r['success'] for r in result['test_results']] == [True, True, False]
+
+
+def _harness_executor(timeout):
+    import sys
+    import app.config as app_config
+    from app.libs.executors.python_executor import PythonExecutor, get_zygote
+    # the zygote runs the harness without systemd-run, like the workers with PYTHON_ZYGOTE
+    return PythonExecutor(app_config.PYTHON_EXECUTE_COMMAND, timeout=timeout, zygote=get_zygote([sys.executable], []))
+
+
+def test_python_entry_point_fake_results():
+    # the lines printed by the submission with the mark are not taken as results
+    solution = """
+import sys
+for _ in range(3):
+    print('@@H{"output": "0", "passed": true, "cost": 0}')
+sys.exit(0)
+
+def solve(x):
+    return x
+"""
+    results = _harness_executor(5).execute_harness(solution, 'solve', [([1], 2), ([2], 3), ([3], 4)])
+    assert len(results) == 1
+    assert not results[0].success
+    assert results[0].matched is None
+
+    # the expected values can't be read by the submission
+    solution = """
+import sys
+cases = sys.stdin.read()
+
+def solve(x):
+    return cases
+"""
+    results = _harness_executor(5).execute_harness(solution, 'solve', [([1], 'secret')])
+    assert results[0].success
+    assert not results[0].matched
+    assert 'secret' not in results[0].stdout
+
+
+def test_python_entry_point_forged_results():
+    # the nonce and the expected values are not in the process of the submission, so it can't print passing results
+    solution = """
+import gc, json, sys
+
+found = {}
+frame = sys._getframe()
+while frame is not None:
+    found.update(frame.f_locals)
+    frame = frame.f_back
+for o in gc.get_objects():
+    if isinstance(o, dict) and 'nonce' in o:
+        found['nonce'] = o['nonce']
+if 'cases' in found or 'nonce' in found or len(found.get('mark', '')) > len('@@H'):
+    print('found', file=sys.stderr)
+mark = found['mark'] if len(found.get('mark', '')) > len('@@H') else '@@H' + found.get('nonce', '')
+for case in found.get('cases', [{}] * 2):
+    print(mark + json.dumps({'output': json.dumps(case.get('expected')), 'passed': True, 'cost': 0}))
+sys.exit(0)
+
+def solve(x):
+    return -1
+"""
+    results = _harness_executor(5).execute_harness(solution, 'solve', [([1], 2), ([2], 3)])
+    assert len(results) == 1
+    assert not results[0].success and results[0].matched is None
+    assert 'found' not in results[0].stderr
+
+    # the result of every case is taken, even when the output of the submission doesn't end with a new line
+    solution = """
+def solve(x):
+    print('no new line', end='')
+    return x
+"""
+    results = _harness_executor(5).execute_harness(solution, 'solve', [([1], 1), ([2], 3)])
+    assert [r.matched for r in results] == [True, False]
+
+
+def test_python_entry_point_run_timeout():
+    from app.libs.executors.executor import TIMEOUT_EXIT_CODE
+    solution = """
+import time
+
+def solve(x):
+    time.sleep(0.8)
+    return x
+"""
+    # every case is within its timeout, but not all of them within the timeout of the whole run
+    start = time.time()
+    results = _harness_executor(2).execute_harness(solution, 'solve', [([i], i) for i in range(6)], timeout=1)
+    # killed by its timer at 2 seconds, before the executor kills it at 3 seconds
+    assert time.time() - start < 2.7
+    assert [r.matched for r in results[:-1]] == [True] * (len(results) - 1)
+    assert results[-1].exit_code == TIMEOUT_EXIT_CODE
+    assert len(results) < 6
+
+    # the timeout of a case still applies after the first cases
+    solution = """
+import time
+
+def solve(x):
+    time.sleep(x)
+    return x
+"""
+    results = _harness_executor(10).execute_harness(solution, 'solve', [([0], 0), ([0], 0), ([3], 3), ([0], 0)], timeout=1)
+    assert [r.exit_code for r in results] == [0, 0, TIMEOUT_EXIT_CODE, 0]
+
+
+@pytest.mark.parametrize("lang, solution", [
+    ("cpp", "#include <cstdio>\nint main(){for(;;)puts(\"1\");return 0;}"),
+    ("python", "while True:\n    print(1)"),
+])
+def test_wrong_answer_early(test_client, lang, solution):
+    # killed as soon as the output diverges, instead of running until the timeout
+    data = {
+        "type": lang,
+        "solution": solution,
+        "expected_output": "2",
+        "timeout": 5,
+    }
+    start = time.time()
+    response = test_client.post('/run', json=data)
+    print(response.json())
+    assert response.status_code == 200
+    assert not response.json()['success']
+    assert response.json()['reason'] == 'wrong_answer'
+    assert time.time() - start < 5
+
+
+@pytest.mark.parametrize("lang, solution", [
+    ("cpp", "#include <cstdio>\nint main(){for(;;)printf(\"aaaaaaaaaa\");return 0;}"),
+    ("python", "while True:\n    print('a' * 1000)"),
+])
+def test_output_limit(test_client, lang, solution):
+    # killed as soon as the output exceeds MAX_OUTPUT_SIZE, instead of running until the timeout
+    data = {
+        "type": lang,
+        "solution": solution,
+        "timeout": 5,
+    }
+    start = time.time()
+    response = test_client.post('/run', json=data)
+    print(response.json())
+    assert response.status_code == 200
+    assert not response.json()['success']
+    assert not response.json()['run_success']
+    assert response.json()['reason'] == 'output_limit_exceeded'
+    assert len(response.json()['stdout']) <= 1000
+    assert time.time() - start < 5
+
+
+def test_workspace_reset(test_client):
+    # the workspace of a run is emptied before it is reused
+    data = {
+        "type": "python",
+        "solution": "import os\nprint(sorted(os.listdir('.')))\nopen('leftover.txt', 'w').write('x')",
+    }
+    for _ in range(2):
+        response = test_client.post('/run', json=data)
+        print(response.json())
+        assert response.status_code == 200
+        assert response.json()['success']
+        assert 'leftover.txt' not in response.json()['stdout']
+
+
+def test_workspace_pool_size(monkeypatch, tmp_path):
+    # a worker has a workspace per work item judged at a time, whatever the cgroup slots are
+    import app.config as app_config
+    import app.worker_manager as worker_manager
+
+    monkeypatch.setattr(app_config, 'WORKSPACE_ROOT', str(tmp_path))
+    monkeypatch.setattr(app_config, 'CGROUP_SLOTS', 8)
+    monkeypatch.setattr(worker_manager, '_workspaces', None)
+    for worker_type, concurrency in ((worker_manager.Worker, 1), (worker_manager.AsyncWorker, 3)):
+        worker = worker_type({})
+        worker.concurrency = concurrency
+        worker._create_workspaces()
+        try:
+            assert len(worker_manager._workspaces.workspaces) == concurrency
+        finally:
+            worker_manager._workspaces.close()
+
+
+def test_python_unmodified_source(test_client):
+    # the submission is run as it is, with the limits set by the worker
+    data = {
+        "type": "python",
+        "solution": "from __future__ import annotations\nimport traceback\ndef f(x: int) -> int:\n    return x\ntry:\n    1 / 0\nexcept ZeroDivisionError:\n    print(traceback.format_exc().count('line 6'))",
+        "expected_output": "1",
+    }
+    response = test_client.post('/run', json=data)
+    print(response.json())
+    assert response.status_code == 200
+    assert response.json()['success']
+
+
+@pytest.mark.parametrize("lang, solution", [
+    ("cpp", "#include <cstdio>\nint main(){long s=0;for(long i=0;i<100000000;i++)s+=i%7;printf(\"%ld\\n\",s);return 0;}"),
+    ("python", "s = 0\nfor i in range(3000000):\n    s += i % 7\nprint(s)"),
+])
+def test_resource_usage(test_client, lang, solution):
+    data = {
+        "type": lang,
+        "solution": solution,
+    }
+    response = test_client.post('/run', json=data)
+    print(response.json())
+    assert response.status_code == 200
+    usage = response.json()['usage']
+    assert usage['wall_time'] > 0
+    assert usage['user_time'] > 0
+    assert usage['memory_peak'] > 0
+
+    response = test_client.post('/judge/batch', json={"submissions": [data, data]})
+    print(response.json())
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert response.json()['usage']['user_time'] == pytest.approx(sum(r['usage']['user_time'] for r in results))
+
+
+@pytest.mark.parametrize("backend", ["zset", "stream"])
+def test_work_queue_backend(fake_redis, backend):
+    # both backends deliver every work item once, in their order, and leave nothing behind when it is released.
+    # The throughput is measured by scripts/bench_work_queue.py
+    import threading
+    import app.config as app_config
+    from app.libs.redis_queue import RedisQueue
+
+    queue = RedisQueue(app_config.REDIS_URI, socket_timeout=30, work_queue_backend=backend)
+    queue_name = f'work:{backend}:{uuid.uuid4()}'
+    if backend == 'stream':
+        queue.wqueue.create_group(queue_name)
+
+    def pop(consumer, count=1, timeout=1):
+        if backend == 'stream':
+            return queue.wqueue.pop(queue_name, consumer, count=count, timeout=timeout)
+        return queue.wqueue.pop(queue_name, count=count, timeout=timeout)
+
+    def pending():
+        if backend == 'stream':
+            return queue.redis.xpending(queue_name, queue.wqueue.GROUP)['pending']
+        return queue.redis.hlen(queue.payloads_name(queue_name))
+
+    count = 20
+    # the submission times are not in the order the work items are pushed
+    scores = {str(i): (i * 7) % count for i in range(count)}
+    for i in range(count):
+        queue.wqueue.push(queue_name, {str(i): scores[str(i)]}, {str(i): json.dumps({'id': i})})
+    assert queue.wqueue.len(queue_name) == count
+
+    popped = []
+    while len(popped) < count:
+        popped.extend(pop(f'consumer-{len(popped) % 2}', count=3))
+    ids = [json.loads(payload)['id'] for payload, _, _ in popped]
+    assert sorted(ids) == list(range(count))
+    if backend == 'stream':
+        # in the order they are added
+        assert ids == list(range(count))
+        assert pending() == count
+    else:
+        # by the submission time, and the payloads are taken with the ids
+        assert ids == sorted(range(count), key=lambda i: scores[str(i)])
+        assert pending() == 0
+    assert [score for _, score, _ in popped] == [scores[str(i)] for i in ids]
+    assert queue.wqueue.len(queue_name) == 0
+
+    # a requeued work item is delivered again, once
+    queue.wqueue.requeue(queue_name, popped[:2])
+    requeued = pop('consumer-1', count=count)
+    assert [payload for payload, _, _ in requeued] == [payload for payload, _, _ in popped[:2]]
+    assert queue.wqueue.len(queue_name) == 0
+
+    # a blocked consumer gets the work item pushed while it waits
+    result = []
+    consumer = threading.Thread(target=lambda: result.extend(pop('consumer-0', timeout=5)))
+    consumer.start()
+    time.sleep(0.2)
+    queue.wqueue.push(queue_name, {'late': count}, {'late': json.dumps({'id': count})})
+    consumer.join()
+    assert [json.loads(payload)['id'] for payload, _, _ in result] == [count]
+
+    queue.wqueue.release(queue_name, *[item_id for _, _, item_id in popped[2:] + requeued + result])
+    assert pending() == 0
+    if backend == 'stream':
+        # acknowledged and deleted
+        assert queue.redis.xlen(queue_name) == 0
+    queue.delete(queue_name, queue.payloads_name(queue_name))
+
+
+def test_indexed_queue(fake_redis):
+    import threading
+    import app.config as app_config
+    from app.libs.redis_queue import RedisQueue
+
+    queue = RedisQueue(app_config.REDIS_URI, socket_timeout=30)
+    queue_name = f'indexed:{uuid.uuid4()}'
+    payloads_name = queue.payloads_name(queue_name)
+    ready_name = f'{{{queue_name}}}:ready'
+    solution = 'x' * 100000
+    queue.iqueue.push(queue_name, {'a': 2, 'b': 1, 'c': 3}, {'a': solution, 'b': 'payload-b', 'c': 'payload-c'})
+
+    # the sorted set only holds the ids
+    assert queue.redis.zrange(queue_name, 0, -1) == [b'b', b'a', b'c']
+    assert queue.iqueue.peak(queue_name) == (b'b', 1)
+    assert queue.iqueue.len(queue_name) == 3
+
+    # the unindexed queues go first, and the payloads are popped with their ids
+    queue.pqueue.push(ready_name, {'ready-payload': 0})
+    assert queue.iqueue.pop(queue_name, count=2, unindexed_queue_names=[ready_name], timeout=1) == [(b'ready-payload', 0, None)]
+    items = queue.iqueue.pop(queue_name, count=2, unindexed_queue_names=[ready_name], timeout=1)
+    assert items == [(b'payload-b', 1, b'b'), (solution.encode(), 2, b'a')]
+    # the payloads are removed by the pop, so nothing is left if the popper dies
+    assert sorted(queue.redis.hkeys(payloads_name)) == [b'c']
+
+    # a popped item is put back with its payload
+    queue.iqueue.requeue(queue_name, items[1:])
+    assert queue.iqueue.peak(queue_name) == (b'a', 2)
+    assert queue.redis.hget(payloads_name, 'a') == solution.encode()
+    queue.iqueue.release(queue_name, b'b')
+
+    # an id whose payload is discarded is dropped
+    queue.iqueue.discard(queue_name, 'a')
+    assert queue.iqueue.pop(queue_name, count=2, timeout=1) == [(b'payload-c', 3, b'c')]
+    assert queue.iqueue.pop(queue_name, timeout=1) == []
+
+    # an idle popper waits for the next id, and takes its payload
+    timer = threading.Timer(0.5, queue.iqueue.push, args=(queue_name, {'d': 4}, {'d': 'payload-d'}))
+    timer.start()
+    assert queue.iqueue.pop(queue_name, timeout=5) == [(b'payload-d', 4, b'd')]
+    timer.join()
+    assert queue.redis.hlen(payloads_name) == 0
+    assert queue.redis.zcard(queue_name) == 0
+
+
+def _fake_cgroup(path, controllers='cpu memory', subtree_control='', procs=''):
+    # a cgroup v2 directory with the files read by the slots, which are regular files here
+    path.mkdir(parents=True, exist_ok=True)
+    (path / 'cgroup.controllers').write_text(controllers)
+    (path / 'cgroup.subtree_control').write_text(subtree_control)
+    (path / 'cgroup.procs').write_text(procs)
+    return path
+
+
+def test_prepare_cgroup_root(tmp_path):
+    import os
+    from app.libs.cgroup import CgroupError, prepare_cgroup_root
+
+    # only the current process is moved to the leaf `manager`
+    root = _fake_cgroup(tmp_path / 'own', procs=f'{os.getpid()}\n')
+    assert prepare_cgroup_root(str(root)) == root
+    assert (root / 'manager' / 'cgroup.procs').read_text() == str(os.getpid())
+    assert (root / 'cgroup.subtree_control').read_text() == '+cpu +memory'
+
+    # a cgroup with other processes is refused, and nothing is moved
+    root = _fake_cgroup(tmp_path / 'shared', procs=f'{os.getpid()}\n1\n')
+    with pytest.raises(CgroupError):
+        prepare_cgroup_root(str(root))
+    assert not (root / 'manager').exists()
+    assert (root / 'cgroup.subtree_control').read_text() == ''
+
+    # missing controllers
+    with pytest.raises(CgroupError):
+        prepare_cgroup_root(str(_fake_cgroup(tmp_path / 'nomem', controllers='cpu')))
+
+    # already prepared
+    root = _fake_cgroup(tmp_path / 'ready', subtree_control='cpu memory', procs='1\n')
+    assert prepare_cgroup_root(str(root)) == root
+    assert not (root / 'manager').exists()
+
+
+def test_cgroup_slot(tmp_path):
+    from app.libs.cgroup import CgroupSlotPool
+    from app.libs.executors.executor import ProcessExecutor
+
+    pool = CgroupSlotPool(tmp_path, 'worker-1', 2)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['worker-1-0', 'worker-1-1']
+    slot = pool.acquire()
+    assert pool.acquire() is not None
+    assert pool.acquire() is None
+
+    # the limits of the submission, and the usage is reset
+    slot.configure(cpu_core=0.5, memory_limit=256 * 1024 * 1024)
+    assert (slot.path / 'cpu.max').read_text() == '50000 100000'
+    assert (slot.path / 'memory.max').read_text() == str(256 * 1024 * 1024)
+    assert (slot.path / 'memory.swap.max').read_text() == '0'
+    assert (slot.path / 'memory.peak').read_text() == 'reset'
+    assert (slot.path / 'cgroup.kill').read_text() == '1'
+    slot.configure()
+    assert (slot.path / 'cpu.max').read_text() == 'max 100000'
+    assert (slot.path / 'memory.max').read_text() == 'max'
+
+    # a command moves itself into the slot right before exec
+    (slot.path / 'cgroup.procs').write_text('')
+    result = ProcessExecutor().execute(['echo', 'ok'], cgroup_slot=slot)
+    assert result.stdout == 'ok\n'
+    assert (slot.path / 'cgroup.procs').read_text() == '0'
+
+    # the usage since the stats before the command
+    (slot.path / 'cpu.stat').write_text('usage_usec 100\nuser_usec 60\nsystem_usec 40\n')
+    (slot.path / 'memory.peak').write_text('1000')
+    start = slot.stats()
+    (slot.path / 'cpu.stat').write_text('usage_usec 2100\nuser_usec 1560\nsystem_usec 540\n')
+    (slot.path / 'memory.peak').write_text('4096')
+    assert slot.usage(start) == {'user_time': 0.0015, 'sys_time': 0.0005, 'memory_peak': 4096}
+
+    # the slot is killed when it is released
+    (slot.path / 'cgroup.kill').unlink()
+    pool.release(slot)
+    assert (slot.path / 'cgroup.kill').read_text() == '1'
+    assert pool.acquire() is slot
+
+
+def test_process_limits():
+    import signal
+    import sys
+    import threading
+    from app.libs.executors.executor import ProcessExecutor, ProcessLimits
+
+    executor = ProcessExecutor()
+    # the limits are set by exec_limits.py, without preexec_fn, so they can be used from several threads
+    results = {}
+
+    def run(name, args, limits):
+        results[name] = executor.execute(args, timeout=10, limits=limits)
+
+    threads = [
+        threading.Thread(target=run, args=('timeout', ['sleep', '5'], ProcessLimits(timeout=0.5))),
+        threading.Thread(target=run, args=('cpu', [sys.executable, '-c', 'while True: pass'], ProcessLimits(cpu_time=1))),
+        threading.Thread(target=run, args=('memory', [sys.executable, '-c', 'x = bytearray(512 * 1024 * 1024)'],
+                                           ProcessLimits(memory=256 * 1024 * 1024))),
+        threading.Thread(target=run, args=('ok', ['echo', 'ok'], ProcessLimits(timeout=5, cpu_time=5))),
+        threading.Thread(target=run, args=('missing', ['no-such-command'], ProcessLimits(timeout=5))),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results['timeout'].exit_code == -signal.SIGALRM
+    assert results['timeout'].cost < 3
+    assert results['cpu'].exit_code == -signal.SIGXCPU
+    assert results['memory'].exit_code == 1 and 'MemoryError' in results['memory'].stderr
+    assert results['ok'].success and results['ok'].stdout == 'ok\n'
+    assert results['missing'].exit_code == 127 and 'no-such-command' in results['missing'].stderr
+
+
+def test_async_worker_slots(fake_redis, tmp_path, monkeypatch):
+    # several work items are judged at the same time by the slot threads of one AsyncWorker,
+    # whose commands enter their cgroup slots (a fake cgroupfs here) and get their limits without preexec_fn
+    import asyncio
+    import app.config as app_config
+    from app.model import Submission, SubmissionResult, WorkPayload
+    from app.work_queue import connect_queue
+    import app.worker_manager as worker_manager
+
+    monkeypatch.setattr(app_config, 'CGROUP_SLOTS', 3)
+    monkeypatch.setattr(app_config, 'PYTHON_ZYGOTE', 0)
+    monkeypatch.setattr(app_config, 'REDIS_WORK_QUEUE_BLOCK_TIMEOUT', 1)
+    worker = worker_manager.AsyncWorker({}, cgroup_root=tmp_path)
+    worker.concurrency = 3
+    worker._create_cgroup_slots()
+    assert len(worker_manager._cgroup_slots.slots) == 3
+
+    payloads = [
+        WorkPayload(submission=Submission(
+            type='python', solution=f'import time\ntime.sleep(1)\nprint({i})', expected_output=str(i), timeout=10
+        ))
+        for i in range(6)
+    ]
+
+    async def run():
+        redis_queue = connect_queue(True)
+        await redis_queue.wqueue.push(
+            app_config.REDIS_WORK_QUEUE_NAME,
+            {p.work_id: p.timestamp for p in payloads}, {p.work_id: p.model_dump_json() for p in payloads}
+        )
+        start = time.time()
+        loop = asyncio.create_task(worker._run_loop_async())
+        try:
+            results = []
+            for p in payloads:
+                _, result_json = await redis_queue.queue.block_pop(f'{app_config.REDIS_RESULT_PREFIX}{p.work_id}', timeout=30)
+                results.append(SubmissionResult.model_validate_json(result_json))
+            return results, time.time() - start
+        finally:
+            loop.cancel()
+            await asyncio.gather(loop, return_exceptions=True)
+
+    slots = worker_manager._cgroup_slots.slots
+    try:
+        results, elapsed = asyncio.run(run())
+    finally:
+        worker_manager._cgroup_slots = None
+    assert all(r.success for r in results), results
+    assert [r.stdout.strip() for r in results] == [str(i) for i in range(6)]
+    # 3 at a time instead of one by one
+    assert elapsed < 5
+    # every slot has run a command
+    assert all((slot.path / 'cgroup.procs').read_text() == '0' for slot in slots)
+
+
+def test_binary_cache_threads(tmp_path):
+    # the same binary is put by several slot threads at once, with their own temporary files
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from app.libs.executors.binary_cache import BinaryCache
+
+    cache = BinaryCache(str(tmp_path / 'local'), 1024 * 1024, str(tmp_path / 'shared'))
+    binaries = []
+    for i in range(8):
+        binary = tmp_path / f'binary-{i}'
+        binary.write_bytes(b'x' * 100000)
+        binary.chmod(0o755)
+        binaries.append(binary)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda binary: cache.put('key', str(binary)), binaries))
+    assert sorted(p.name for p in (tmp_path / 'local').iterdir()) == ['key']
+    assert sorted(p.name for p in (tmp_path / 'shared').iterdir()) == ['key']
+    assert cache.get('key', str(tmp_path / 'exe'))
+    assert (tmp_path / 'exe').read_bytes() == b'x' * 100000
+    assert os.access(tmp_path / 'exe', os.X_OK)
+
+
+# a stand-in for the lean REPL: the header (the first command) is kept for its environments,
+# and a command fails by the words in it. Every command is logged with the pid of the REPL.
+_FAKE_LEAN_REPL = r'''
+import json, os, sys, time
+
+headers = {}
+log = open(sys.argv[1], 'a')
+
+def check(command):
+    if 'unpickleEnvFrom' in command:
+        with open(command['unpickleEnvFrom']) as f:
+            if f.read() != 'fresh':
+                return {'message': 'failed to unpickle'}
+        headers[len(headers)] = 'import Mathlib'
+        return {'env': len(headers) - 1}
+    if 'pickleTo' in command:
+        with open(command['pickleTo'], 'w') as f:
+            f.write('fresh' if headers[command['env']] == 'import Mathlib' else 'stale')
+        return {'env': command['env']}
+    cmd = command['cmd']
+    if 'env' not in command:
+        headers[len(headers)] = cmd
+        return {'env': len(headers) - 1}
+    if 'crash' in cmd:
+        sys.exit(1)
+    if 'hang' in cmd:
+        time.sleep(60)
+    if 'no_env' in cmd:
+        return {'message': 'unknown environment'}
+    header = headers[command['env']]
+    headers[len(headers)] = header
+    response = {'env': len(headers) - 1}
+    lines = [line.strip() for line in cmd.splitlines()]
+    if lines.count('mutual') != lines.count('end'):
+        response['messages'] = [{'severity': 'error', 'data': "invalid 'mutual' block"}]
+    for word, error in [('syntax_error', 'unexpected token'), ('wrong', 'type mismatch'),
+                        ('from_mathlib', 'unknown identifier')]:
+        if word in cmd and (word != 'from_mathlib' or header != 'import Mathlib'):
+            response['messages'] = [{'severity': 'error', 'data': f"{error} '{word}'"}]
+    if 'sorry' in cmd:
+        response['sorries'] = [{'proofState': 0, 'goal': 'True'}]
+    return response
+
+buffer = ''
+for line in sys.stdin:
+    if line.strip():
+        buffer += line
+        continue
+    if not buffer:
+        continue
+    command = json.loads(buffer)
+    buffer = ''
+    log.write(json.dumps({'pid': os.getpid(), **command}) + '\n')
+    log.flush()
+    print(json.dumps(check(command)) + '\n', flush=True)
+'''
+
+
+def _fake_lean_repl(tmp_path):
+    """The command of the fake REPL, and a function returning the commands it has received"""
+    import sys
+    script = tmp_path / 'fake_repl.py'
+    script.write_text(_FAKE_LEAN_REPL)
+    log = tmp_path / 'repl.log'
+    log.touch()
+
+    def commands():
+        return [json.loads(line) for line in log.read_text().splitlines()]
+    return [sys.executable, str(script), str(log)], commands
+
+
+def test_lean_prefix_without_env(tmp_path):
+    # a prefix of the script which the REPL fails to run fails the script, instead of merging the partial responses
+    from app.libs.executors.lean_executor import LeanExecutor
+
+    repl_cl, commands = _fake_lean_repl(tmp_path)
+    executor = LeanExecutor(run_cl='', timeout=10, repl_cl=repl_cl, env_cache_size=4)
+    script = ('theorem a : True := trivial\n\n'
+              'theorem no_env : True := trivial\n\n'
+              'theorem c : True := trivial\n')
+    result = executor.execute_script(script)
+    assert not result.success
+    assert 'unknown environment' in result.stderr
+    # the rest of the script is not sent to the REPL
+    assert [c['cmd'].strip() for c in commands()[1:]] == ['theorem a : True := trivial', 'theorem no_env : True := trivial']
+
+    result = executor.execute_script(script.replace('no_env', 'b'))
+    assert result.success and result.stdout == 'pass'
+
+
+def test_lean_make_header():
+    # every module has its own `import`, in one line like PRE_TEMPLATE
+    from app.libs.executors.lean_executor import LeanExecutor
+    from app.libs.executors.lean_imports import make_header
+
+    assert make_header(['Mathlib.Tactic.Linarith', 'Mathlib.Data.Real.Basic', 'Mathlib.Tactic.Linarith']) == \
+        'import Mathlib.Tactic.Linarith import Mathlib.Data.Real.Basic'
+    assert make_header(['Mathlib.Logic.Basic']) == 'import Mathlib.Logic.Basic'
+    assert make_header([]) == 'import Init'
+    executor = LeanExecutor(run_cl='', imports='Mathlib.Tactic.Linarith, Mathlib.Data.Real.Basic')
+    assert executor._header_for(['theorem a : True := trivial']) == \
+        'import Mathlib.Tactic.Linarith import Mathlib.Data.Real.Basic'
+
+
+def test_lean_auto_imports_retry(tmp_path):
+    # only a failure caused by a missing import is checked again with PRE_TEMPLATE
+    from app.libs.executors.lean_executor import LeanExecutor, PRE_TEMPLATE
+    from app.libs.executors.lean_imports import AUTO_IMPORTS
+
+    class ImportIndex:
+        def infer(self, script):
+            return ['Mathlib.Logic.Basic']
+
+    repl_cl, commands = _fake_lean_repl(tmp_path)
+    executor = LeanExecutor(run_cl='', timeout=10, repl_cl=repl_cl, imports=AUTO_IMPORTS, import_index=ImportIndex())
+    results = executor.execute_batch([
+        'theorem a : True := from_mathlib',
+        'theorem b : True := by syntax_error',
+        'theorem c : 1 = 2 := wrong',
+        'theorem d : True := trivial',
+    ])
+    assert [r.stdout for r in results] == ['pass', 'fail', 'fail', 'pass']
+    headers = [c['cmd'] for c in commands() if 'env' not in c]
+    assert headers == ['import Mathlib.Logic.Basic', PRE_TEMPLATE]
+    checked = [c['cmd'].strip() for c in commands() if 'env' in c]
+    assert checked == [
+        'theorem a : True := from_mathlib',
+        'theorem b : True := by syntax_error',
+        'theorem c : 1 = 2 := wrong',
+        'theorem d : True := trivial',
+        'theorem a : True := from_mathlib',
+    ]
+
+
+def test_lease_queue(fake_redis):
+    # the leased pops of RELIABLE_QUEUE, and the requeue of the expired leases by the reaper of the manager
+    import app.config as app_config
+    from app.work_queue import connect_queue
+    from app.worker_manager import WorkerManager, _inflight_name, _lease_owners_name
+
+    queue = connect_queue(False)
+    queue_name = app_config.REDIS_WORK_QUEUE_NAME
+    payloads_name = queue.payloads_name(queue_name)
+    registry = _lease_owners_name()
+    manager = WorkerManager.__new__(WorkerManager)
+    manager._redis_queue = queue
+    queue.iqueue.push(queue_name, {'a': 1, 'b': 2, 'c': 3, 'd': 4}, {k: f'payload-{k}' for k in 'abcd'})
+
+    def pop(owner, lease_time, count=1):
+        return queue.lease.pop(queue_name, _inflight_name(owner), registry, owner, count=count, lease_time=lease_time)
+
+    assert pop('w1', 0.5, count=2) == [(b'payload-a', 1, b'a'), (b'payload-b', 2, b'b')]
+    assert pop('w2', 0.5) == [(b'payload-c', 3, b'c')]
+    assert queue.lease.owners(registry) == {b'w1', b'w2'}
+    # the payloads are kept with the leases
+    assert queue.redis.hlen(payloads_name) == 4
+
+    # a renewed lease is not reaped, an expired one is put back exactly once with its score
+    assert queue.lease.renew(_inflight_name('w1'), b'a', 30) == 1
+    assert manager._requeue_leases('w1') == 0
+    time.sleep(0.6)
+    assert manager._requeue_leases('w1') == 1
+    assert manager._requeue_leases('w1') == 0
+    assert queue.redis.zrange(queue_name, 0, -1, withscores=True) == [(b'b', 2), (b'd', 4)]
+    # a lease which is gone can't be renewed
+    assert queue.lease.renew(_inflight_name('w1'), b'b', 30) == 0
+
+    # the reaper only requeues the leases of their owner
+    assert queue.redis.zrange(_inflight_name('w2'), 0, -1) == [b'c']
+    assert manager._requeue_leases('w2') == 1
+    assert queue.redis.zrange(queue_name, 0, -1) == [b'b', b'c', b'd']
+    # an owner without leases is removed from the registry
+    assert queue.lease.owners(registry) == {b'w1'}
+
+    # a released lease is gone with its payload, and is not put back
+    queue.lease.release(queue_name, _inflight_name('w1'), b'a')
+    assert not queue.redis.hexists(payloads_name, 'a')
+    assert queue.lease.requeue(queue_name, _inflight_name('w1'), registry, 'w1', b'a') == 0
+    assert queue.lease.owners(registry) == set()
+
+    # the leases of a dead worker are all put back, expired or not
+    assert pop('w3', 30, count=3) == [(b'payload-b', 2, b'b'), (b'payload-c', 3, b'c'), (b'payload-d', 4, b'd')]
+    assert manager._requeue_leases('w3') == 0
+    assert manager._requeue_leases('w3', expired_only=False) == 3
+    assert pop('w4', 30, count=3) == [(b'payload-b', 2, b'b'), (b'payload-c', 3, b'c'), (b'payload-d', 4, b'd')]
+
+
+@pytest.mark.parametrize("mode", ["zset", "leased", "stream"])
+def test_worker_prefetch(fake_redis, monkeypatch, mode):
+    # a worker claims several work items per pop, and puts the ones waiting over WORKER_PREFETCH_TIME back
+    from collections import deque
+    from time import monotonic
+    import app.config as app_config
+    import app.worker_manager as worker_manager
+    from app.libs.redis_queue import RedisQueue
+
+    monkeypatch.setattr(app_config, 'WORKER_PREFETCH', 3)
+    monkeypatch.setattr(app_config, 'WORKER_PREFETCH_TIME', 0.5)
+    monkeypatch.setattr(app_config, 'REDIS_WORK_QUEUE_BLOCK_TIMEOUT', 1)
+    monkeypatch.setattr(worker_manager, '_STREAM_QUEUE', mode == 'stream')
+    monkeypatch.setattr(worker_manager, '_LEASED_QUEUE', mode == 'leased')
+    queue = RedisQueue(app_config.REDIS_URI, socket_timeout=30, work_queue_backend='stream' if mode == 'stream' else 'zset')
+    queue_name = app_config.REDIS_WORK_QUEUE_NAME
+    queue_names = [queue_name]
+    if mode == 'stream':
+        queue.wqueue.create_group(queue_name)
+    queue.wqueue.push(queue_name, {f'w{i}': i for i in range(5)}, {f'w{i}': f'payload-{i}' for i in range(5)})
+
+    worker = worker_manager.Worker({})
+    # a single pop until a judge time is known
+    assert [payload for payload, _, _ in worker._claim(queue, queue_names)] == [b'payload-0']
+    worker._update_judge_time(0.1)
+    claimed = worker._claim(queue, queue_names)
+    assert [payload for payload, _, _ in claimed] == [b'payload-1', b'payload-2', b'payload-3']
+    # every claimed work item is held by the worker
+    assert set(worker._leased) == {b'payload-0', b'payload-1', b'payload-2', b'payload-3'}
+    prefetched = deque((payload, score, monotonic()) for payload, score, _ in claimed[1:])
+
+    worker._requeue_prefetched(queue, prefetched)
+    assert len(prefetched) == 2
+    time.sleep(0.6)
+    worker._requeue_prefetched(queue, prefetched)
+    assert not prefetched
+    assert set(worker._leased) == {b'payload-0', b'payload-1'}
+
+    # the prefetched work items go to another worker, with their scores
+    other = worker_manager.Worker({})
+    other._update_judge_time(0.1)
+    items = other._claim(queue, queue_names)
+    assert sorted((payload, score) for payload, score, _ in items) == [(b'payload-2', 2), (b'payload-3', 3), (b'payload-4', 4)]
+
+    # the work items are released with the leases held by the workers
+    for w in (worker, other):
+        for payload in list(w._leased):
+            worker_manager._lease_ops(queue).release(*w._take_lease(payload))
+    if mode == 'leased':
+        assert queue.redis.zcard(worker._inflight_name) == 0
+        assert queue.redis.zcard(other._inflight_name) == 0
+        assert queue.redis.hlen(queue.payloads_name(queue_name)) == 0
+    elif mode == 'stream':
+        assert queue.redis.xpending(queue_name, queue.wqueue.GROUP)['pending'] == 0
+        assert queue.redis.xlen(queue_name) == 0
+    else:
+        assert queue.redis.hlen(queue.payloads_name(queue_name)) == 0
+    assert queue.wqueue.len(queue_name) == 0
+
+
+@pytest.mark.parametrize("mode", ["leased", "stream"])
+def test_lease_renew_and_hand_off(fake_redis, monkeypatch, mode):
+    # a held work item is renewed while it is judged, and its lease goes with it to the compile stage of the node
+    import app.config as app_config
+    import app.worker_manager as worker_manager
+    from app.libs.redis_queue import RedisQueue
+    from app.model import CompileArtifact, Submission, WorkPayload
+
+    monkeypatch.setattr(app_config, 'CPP_COMPILE_WORKERS', 1)
+    monkeypatch.setattr(app_config, 'CPP_BINARY_CACHE_SIZE', 0)
+    monkeypatch.setattr(app_config, 'REDIS_WORK_QUEUE_BLOCK_TIMEOUT', 1)
+    monkeypatch.setattr(worker_manager, '_STREAM_QUEUE', mode == 'stream')
+    monkeypatch.setattr(worker_manager, '_LEASED_QUEUE', mode == 'leased')
+    monkeypatch.setattr(worker_manager, '_LEASE_TIME', 1)
+    queue = RedisQueue(app_config.REDIS_URI, socket_timeout=30, work_queue_backend='stream' if mode == 'stream' else 'zset')
+    queue_name = app_config.REDIS_WORK_QUEUE_NAME
+    registry = worker_manager._lease_owners_name()
+    if mode == 'stream':
+        queue.wqueue.create_group(queue_name)
+
+    def reap(worker):
+        # the expired leases put back by the manager, or the stale entries claimed by another worker
+        if mode == 'leased':
+            return queue.lease.requeue(queue_name, worker._inflight_name, registry, worker.worker_id)
+        return len(queue.wqueue.claim(queue_name, 'reaper', worker_manager._LEASE_TIME))
+
+    def holder(item_id):
+        if mode == 'leased':
+            return next(w for w in workers if queue.redis.zscore(w._inflight_name, item_id) is not None)
+        pending = queue.redis.xpending_range(queue_name, queue.wqueue.GROUP, min='-', max='+', count=10)
+        return next(w for w in workers if any(p['consumer'].decode() == w.worker_id for p in pending))
+
+    worker = worker_manager.Worker({}, node_id='node-1')
+    compile_worker = worker_manager.CompileWorker({}, node_id='node-1')
+    other = worker_manager.Worker({}, node_id='node-1')
+    workers = [worker, compile_worker, other]
+    payloads = [
+        WorkPayload(submission=Submission(type='cpp', solution=f'int main(){{return {i};}}', expected_output=''))
+        for i in range(2)
+    ]
+    queue.wqueue.push(queue_name, {p.work_id: i for i, p in enumerate(payloads)}, {p.work_id: p.model_dump_json() for p in payloads})
+
+    # a lease renewed while the work item is judged is not taken by others, however long it is judged
+    [(payload_json, _, item_id)] = worker._claim(queue, [queue_name])
+    for _ in range(3):
+        time.sleep(0.6)
+        worker._renew_held(queue)
+        assert reap(worker) == 0
+
+    # the lease is handed off with the work item, and held by the compile worker
+    payload = WorkPayload.model_validate_json(payload_json)
+    assert worker._hand_off(queue, payload, payload_json)
+    assert payload_json not in worker._leased
+    compile_queue = worker_manager._node_queue_name('compile', 'node-1')
+    _, handed_json, _ = queue.pqueue.block_pop(compile_queue, timeout=1)
+    handed = WorkPayload.model_validate_json(handed_json)
+    assert handed.lease[-1] == (item_id.decode() if isinstance(item_id, bytes) else item_id)
+    assert compile_worker._take_over_lease(queue, handed_json, handed)
+    assert holder(item_id) is compile_worker
+
+    # the compiled work item is taken over by the worker judging it, which releases the lease with its result
+    lease = compile_worker._take_lease(handed_json)
+    ready = handed.model_copy(update={'artifact': CompileArtifact(path='run'), 'lease': worker_manager._carried_lease(lease)})
+    ready_json = ready.model_dump_json().encode()
+    assert other._take_over_lease(queue, ready_json, ready)
+    assert holder(item_id) is other
+    worker_manager._lease_ops(queue).release(*other._take_lease(ready_json))
+    # a released lease can't be taken over again
+    assert not worker._take_over_lease(queue, ready_json, ready)
+
+    # the work item of a compile worker which died is put back to the work queue
+    [(payload_json, _, item_id)] = worker._claim(queue, [queue_name])
+    assert worker._hand_off(queue, WorkPayload.model_validate_json(payload_json), payload_json)
+    _, handed_json, _ = queue.pqueue.block_pop(compile_queue, timeout=1)
+    assert compile_worker._take_over_lease(queue, handed_json, WorkPayload.model_validate_json(handed_json))
+    time.sleep(1.1)
+    if mode == 'leased':
+        assert reap(worker) == 0
+        assert reap(compile_worker) == 1
+        assert [payload for payload, _, _ in other._claim(queue, [queue_name])] == [payload_json]
+    else:
+        assert reap(compile_worker) == 1
+
+
+def test_cpp_compile_stage(fake_redis, monkeypatch, tmp_path):
+    # a worker hands a c++ submission to the compile workers of its node, and judges the compiled artifact
+    import os
+    import threading
+    import app.config as app_config
+    import app.worker_manager as worker_manager
+    from app.model import CompileArtifact, Submission, WorkPayload
+    from app.work_queue import connect_queue
+
+    monkeypatch.setattr(app_config, 'CPP_COMPILE_WORKERS', 1)
+    monkeypatch.setattr(app_config, 'CPP_ARTIFACT_PATH', str(tmp_path / 'artifacts'))
+    monkeypatch.setattr(app_config, 'CPP_BINARY_CACHE_SIZE', 0)
+    monkeypatch.setattr(app_config, 'CPP_PCH_HEADERS', '')
+    monkeypatch.setattr(app_config, 'CPP_RUNTIME_PATH', '')
+    monkeypatch.setattr(app_config, 'REDIS_WORK_QUEUE_BLOCK_TIMEOUT', 1)
+    queue = connect_queue(False)
+    monkeypatch.setattr(worker_manager, 'connect_queue', lambda is_async=False: queue)
+
+    worker = worker_manager.Worker({}, node_id='node-1')
+    payload = WorkPayload(submission=Submission(
+        type='cpp', solution='#include <cstdio>\nint main(){printf("ok");return 0;}', expected_output='ok'
+    ))
+    assert worker._hand_off(queue, payload)
+    compile_queue = worker_manager._node_queue_name('compile', 'node-1')
+    ready_queue = worker_manager._node_queue_name('ready', 'node-1')
+    assert queue.pqueue.len(compile_queue) == 1
+    # a compiled submission is not handed off again
+    assert not worker._hand_off(queue, payload.model_copy(update={'artifact': CompileArtifact(path='run')}))
+
+    class Stop(Exception):
+        pass
+
+    stop = threading.Event()
+    register = queue.set
+
+    def set_key(*args, **kwargs):
+        if stop.is_set():
+            raise Stop()
+        return register(*args, **kwargs)
+
+    monkeypatch.setattr(queue, 'set', set_key)
+
+    def run_compile_worker():
+        try:
+            worker_manager.CompileWorker({}, node_id='node-1')._run_loop()
+        except Stop:
+            pass
+
+    compile_worker = threading.Thread(target=run_compile_worker)
+    compile_worker.start()
+    try:
+        deadline = time.time() + 30
+        while not queue.pqueue.len(ready_queue) and time.time() < deadline:
+            time.sleep(0.1)
+    finally:
+        stop.set()
+        compile_worker.join()
+
+    # the compiled submission is put in the ready queue of the node, which the workers pop before new work items
+    ready = queue.wqueue.pop(app_config.REDIS_WORK_QUEUE_NAME, unindexed_queue_names=[ready_queue], timeout=1)
+    assert len(ready) == 1 and ready[0][2] is None
+    compiled = WorkPayload.model_validate_json(ready[0][0])
+    assert compiled.work_id == payload.work_id
+    assert os.path.exists(compiled.artifact.path)
+
+    result_queue_name, result, _ = worker._process(queue, ready[0][0])
+    assert result_queue_name == f'{app_config.REDIS_RESULT_PREFIX}{payload.work_id}'
+    assert result.success and result.stdout == 'ok'
+    # the artifact is removed once it is judged
+    assert not os.path.exists(compiled.artifact.path)
+
+
+def test_python_zygote(tmp_path):
+    # a submission forked from the zygote gets the same result as with a new interpreter
+    import os
+    import sys
+    import app.config as app_config
+    from app.libs.cgroup import CgroupSlot
+    from app.libs.executors.executor import TIMEOUT_EXIT_CODE
+    from app.libs.executors.python_executor import PythonExecutor, get_zygote
+
+    # the limits are set on a (fake) slot, instead of systemd-run
+    slot = CgroupSlot(tmp_path / 'slot')
+
+    def executor(zygote):
+        return PythonExecutor(app_config.PYTHON_EXECUTE_COMMAND.replace(app_config.PYTHON_EXECUTOR_PATH, sys.executable),
+                              timeout=1, memory_limit=256 * 1024 * 1024, cpu_core=1, zygote=zygote, cgroup_slot=slot)
+
+    zygote = get_zygote([sys.executable], ['json'])
+    scripts = [
+        ('import sys\nline = input()\nprint(line[::-1])\nprint("warning", file=sys.stderr)', 'abc'),
+        ('import sys\nprint(__name__, sys.argv[1:])\nsys.exit(3)', None),
+        ('print("before")\nraise ValueError("bad input")', None),
+        ('x = bytearray(1024 * 1024 * 1024)', None),
+    ]
+    for script, stdin in scripts:
+        forked = executor(zygote).execute_script(script, stdin)
+        started = executor(None).execute_script(script, stdin)
+        assert (forked.stdout, forked.exit_code) == (started.stdout, started.exit_code), script
+        # the tracebacks only differ in the path of the workspace
+        assert forked.stderr.splitlines()[-1:] == started.stderr.splitlines()[-1:], script
+
+    # a timed-out child is killed with its process group
+    pid_file = tmp_path / 'pid'
+    for script in ['while True: pass', 'import time\ntime.sleep(30)', 'import os, time\nif os.fork() == 0: time.sleep(30)\ntime.sleep(30)']:
+        result = executor(zygote).execute_script(f'import os\nopen({str(pid_file)!r}, "w").write(str(os.getpid()))\n' + script)
+        assert result.exit_code == TIMEOUT_EXIT_CODE
+        assert result.cost < 3
+        with pytest.raises(ProcessLookupError):
+            os.kill(int(pid_file.read_text()), 0)
+        assert zygote.alive
+
+    # a dead zygote falls back to a new interpreter
+    zygote.process.kill()
+    zygote.process.wait()
+    dead = executor(zygote)
+    result = dead.execute_script('print(input())', 'fallback')
+    assert result.success and result.stdout == 'fallback\n'
+    assert dead.zygote is None
+    # and it is restarted for the next submission
+    restarted = get_zygote([sys.executable], ['json'])
+    assert restarted is not zygote and restarted.alive
+    restarted.close()
+
+
+def test_lean_repl_pool(tmp_path):
+    # the submissions are checked by warm REPLs with the header loaded, which are replaced after a failure
+    from app.libs.executors.executor import TIMEOUT_EXIT_CODE
+    from app.libs.executors.lean_executor import LeanExecutor, PRE_TEMPLATE
+    from app.libs.executors.lean_repl import LeanReplPool
+
+    repl_cl, commands = _fake_lean_repl(tmp_path)
+    pool = LeanReplPool(repl_cl, PRE_TEMPLATE, size=1)
+    executor = LeanExecutor(run_cl='', timeout=2, repl_pool_factory=lambda header: pool)
+    try:
+        results = executor.execute_batch([
+            'theorem a : True := trivial',
+            'theorem b : 1 = 2 := wrong',
+            'theorem c : True := sorry',
+            'theorem d : True := trivial',
+        ])
+        assert [r.stdout for r in results] == ['pass', 'fail', 'fail', 'pass']
+        # one REPL loads the header once, and every submission is checked against the header environment
+        assert len({c['pid'] for c in commands()}) == 1
+        header, *checked = commands()
+        assert header['cmd'] == PRE_TEMPLATE and 'env' not in header
+        assert [c['env'] for c in checked] == [0] * 4
+
+        # a crashed or hanged REPL is replaced, and the next submission goes to a new one
+        results = executor.execute_batch(['theorem crash : True := trivial', 'theorem e : True := trivial'])
+        assert not results[0].success and results[1].stdout == 'pass'
+        result = executor.execute_script('theorem hang : True := trivial')
+        assert result.exit_code == TIMEOUT_EXIT_CODE
+        assert executor.execute_script('theorem f : True := trivial').stdout == 'pass'
+        pids = list(dict.fromkeys(c['pid'] for c in commands()))
+        assert len(pids) == 3
+        assert [c['cmd'] for c in commands() if 'env' not in c] == [PRE_TEMPLATE] * 3
+        assert [c['cmd'].strip() for c in commands() if c['pid'] == pids[-1] and 'env' in c] == ['theorem f : True := trivial']
+    finally:
+        pool.close()
+
+
+def test_lean_header_pickle(tmp_path, monkeypatch):
+    # the header pickled by bootstrap is loaded by the REPLs, and a stale pickle falls back to elaborating the header
+    import shlex
+    import app.config as app_config
+    from app.libs.executors.lean_executor import LeanExecutor, PRE_TEMPLATE
+    from app.libs.executors.lean_repl import LeanReplPool
+    from app.worker_bootstrap import build_lean_header_pickle
+
+    repl_cl, commands = _fake_lean_repl(tmp_path)
+    pickle_path = tmp_path / 'header.olean'
+    state_file = tmp_path / 'state.json'
+    monkeypatch.setattr(app_config, 'LEAN_HEADER_PICKLE_PATH', str(pickle_path))
+    monkeypatch.setattr(app_config, 'LEAN_REPL_RUNTIME_PATH', None)
+    monkeypatch.setattr(app_config, 'LEAN_REPL_COMMAND', shlex.join(repl_cl))
+    monkeypatch.setattr(app_config, 'LEAN_REPL_START_TIMEOUT', 10)
+
+    state = {}
+    build_lean_header_pickle(state, state_file)
+    assert pickle_path.read_text() == 'fresh'
+    assert [c.get('cmd') for c in commands()] == [PRE_TEMPLATE, None]
+    # not rebuilt while the header and the REPL are the same
+    build_lean_header_pickle(state, state_file)
+    assert len(commands()) == 2
+    assert not list(tmp_path.glob('*.tmp'))
+
+    def check(pool):
+        executor = LeanExecutor(run_cl='', timeout=5, repl_pool_factory=lambda header: pool)
+        try:
+            return executor.execute_script('theorem a : True := from_mathlib')
+        finally:
+            pool.close()
+
+    # the fresh pickle is loaded instead of the header
+    start = len(commands())
+    pool = LeanReplPool(repl_cl, PRE_TEMPLATE, pickle_path=str(pickle_path), start_timeout=10)
+    assert check(pool).stdout == 'pass'
+    assert pool.pickle_path == str(pickle_path)
+    assert [('cmd' in c, 'unpickleEnvFrom' in c) for c in commands()[start:]] == [(False, True), (True, False)]
+
+    # a stale pickle is dropped, and the header is elaborated instead
+    pickle_path.write_text('stale')
+    start = len(commands())
+    pool = LeanReplPool(repl_cl, PRE_TEMPLATE, pickle_path=str(pickle_path), start_timeout=10)
+    assert check(pool).stdout == 'pass'
+    assert pool.pickle_path is None
+    loaded = commands()[start:]
+    assert 'unpickleEnvFrom' in loaded[0]
+    assert [c['cmd'] for c in loaded[1:] if 'env' not in c] == [PRE_TEMPLATE]
+    assert loaded[0]['pid'] != loaded[1]['pid']
+
+
+def test_lean_repl_runtime(tmp_path, monkeypatch):
+    # the REPL binary resolved by bootstrap is executed directly, with the lake environment and workdir
+    import os
+    import shlex
+    import app.config as app_config
+    from app.libs.executors.lean_executor import LeanExecutor
+    from app.libs.executors.lean_repl import repl_command
+    from app.worker_bootstrap import resolve_lean_repl_runtime
+
+    repl_cl, commands = _fake_lean_repl(tmp_path)
+    workdir = tmp_path / 'repl'
+    repl = workdir / '.lake' / 'build' / 'bin' / 'repl'
+    repl.parent.mkdir(parents=True)
+    started = tmp_path / 'started'
+    # records the environment the REPL is started with
+    repl.write_text(f'#!/bin/sh\necho "$PWD $LEAN_PATH" >> {started}\nexec {shlex.join(repl_cl)}\n')
+    repl.chmod(0o755)
+    runtime_path = tmp_path / 'runtime.json'
+    monkeypatch.setattr(app_config, 'LEAN_WORKDIR', str(workdir))
+    # `lake env` with the lean path of the workspace
+    monkeypatch.setattr(app_config, 'LEAN_COMPILER_PATH', 'env LEAN_PATH=/lean/lib')
+    monkeypatch.setattr(app_config, 'LEAN_REPL_RUNTIME_PATH', str(runtime_path))
+
+    state = {}
+    resolve_lean_repl_runtime(state, tmp_path / 'state.json')
+    runtime = json.loads(runtime_path.read_text())
+    assert runtime['repl'] == str(repl) and runtime['cwd'] == str(workdir)
+    assert runtime['env']['LEAN_PATH'] == '/lean/lib'
+    assert set(runtime['env']) <= {'LEAN_PATH', 'LEAN_SRC_PATH', 'LEAN_SYSROOT', 'LD_LIBRARY_PATH', 'DYLD_LIBRARY_PATH', 'PATH'}
+
+    args, env, cwd = repl_command(str(runtime_path), 'lake exe repl')
+    assert args == [str(repl)] and cwd == str(workdir)
+    assert env['LEAN_PATH'] == '/lean/lib' and env['HOME'] == os.environ['HOME']
+    executor = LeanExecutor(run_cl='', timeout=10, repl_cl=args, repl_env=env, repl_cwd=cwd)
+    assert executor.execute_script('theorem a : True := trivial').stdout == 'pass'
+    assert started.read_text().split() == [str(workdir), '/lean/lib']
+    assert [c['cmd'].strip() for c in commands() if 'env' in c] == ['theorem a : True := trivial']
+
+    # the command line is used when the binary is not executable or the runtime is missing
+    repl.chmod(0o644)
+    runtime_path.rename(tmp_path / 'runtime_noexec.json')
+    assert repl_command(str(tmp_path / 'runtime_noexec.json'), 'lake exe repl') == (['lake', 'exe', 'repl'], None, None)
+    assert repl_command(str(tmp_path / 'missing.json'), 'lake exe repl') == (['lake', 'exe', 'repl'], None, None)
+
+
+def test_cpp_pch(tmp_path):
+    # a precompiled header is included when the script includes its headers first, and a full compile is done otherwise
+    import pathlib
+    from app.libs.executors.cpp_executor import CppExecutor
+    from app.libs.executors.cpp_pch import build_pch, load_pch, select_pch
+
+    compiler_cl = 'g++ -O2 -o {exe} {source}'
+    manifest = build_pch(str(tmp_path), compiler_cl, [['cstdio'], ['cstdio', 'vector'], ['no_such_header']])
+    # a header set failing to compile is skipped
+    assert [s['headers'] for s in manifest['sets']] == [['cstdio'], ['cstdio', 'vector']]
+    pch = load_pch(str(tmp_path), compiler_cl)
+    small, large = manifest['sets'][0]['header'], manifest['sets'][1]['header']
+    assert [header for _, header in pch] == [large, small]
+
+    both = '// vector\n#include <vector>\n#include <cstdio>\nint main(){std::vector<int> v{1};printf("%d", v[0]);return 0;}'
+    only_cstdio = '#include <cstdio>\nint main(){printf("1");return 0;}'
+    late_include = 'int x = 1;\n#include <cstdio>\nint main(){printf("%d", x);return 0;}'
+    unrelated = '#include <iostream>\nint main(){std::cout << 1;return 0;}'
+    assert select_pch(both, pch) == large
+    assert select_pch(only_cstdio, pch) == small
+    # including it first would change the meaning of the script
+    assert select_pch(late_include, pch) is None
+    assert select_pch(unrelated, pch) is None
+    assert select_pch(both, []) is None
+
+    executor = CppExecutor(compiler_cl, '{exe}', timeout=10, pch=pch)
+
+    def compile_args(script):
+        return executor._compile_command(str(tmp_path), script, str(tmp_path / 'run'))
+
+    assert ['-include', large] == compile_args(both)[-3:-1]
+    assert '-include' not in compile_args(late_include) and '-include' not in compile_args(unrelated)
+    for script in [both, only_cstdio, late_include, unrelated]:
+        result = executor.execute_script(script)
+        assert result.success and result.stdout == '1', result.stderr
+
+    # gcc parses the header instead when its precompiled header doesn't match (e.g. it was built by another compiler)
+    gch = pathlib.Path(f'{large}.gch')
+    gch.write_bytes(b'not a precompiled header')
+    result = executor.execute_script(both)
+    assert result.success and result.stdout == '1', result.stderr
+    gch.unlink()
+    result = executor.execute_script(both)
+    assert result.success and result.stdout == '1', result.stderr
+
+
+def test_entry_point_max_process_time(fake_redis, tmp_path, monkeypatch):
+    # the harness runs all test cases in one command, which is not killed as hanged after the timeout of one case
+    import asyncio
+    import app.config as app_config
+    from app.model import BatchSubmission, Submission, SubmissionResult, TestCase, WorkPayload
+    from app.work_queue import connect_queue
+    import app.worker_manager as worker_manager
+
+    solution = 'import time\n\ndef solve(x):\n    time.sleep(x)\n    return x'
+    sub = Submission(
+        type='python', solution=solution, entry_point='solve', timeout=1,
+        test_cases=[TestCase(input='[0.9]', expected_output='0.9')] * 7
+    )
+    # 6.3 seconds in total, over the timeout of a case + 5
+    assert worker_manager._max_process_time(sub) == 12
+    assert worker_manager._max_process_time(sub.model_copy(update={'entry_point': None})) == 6
+    assert worker_manager._max_process_time(BatchSubmission(submissions=[sub, sub])) == 19
+
+    monkeypatch.setattr(app_config, 'CGROUP_SLOTS', 1)
+    monkeypatch.setattr(app_config, 'PYTHON_ZYGOTE', 0)
+    monkeypatch.setattr(app_config, 'REDIS_WORK_QUEUE_BLOCK_TIMEOUT', 1)
+    worker = worker_manager.AsyncWorker({}, cgroup_root=_fake_cgroup(tmp_path / 'cgroup'))
+    worker.concurrency = 1
+    worker._create_cgroup_slots()
+    payload = WorkPayload(submission=sub)
+
+    async def run():
+        redis_queue = connect_queue(True)
+        await redis_queue.wqueue.push(
+            app_config.REDIS_WORK_QUEUE_NAME, {payload.work_id: payload.timestamp}, {payload.work_id: payload.model_dump_json()}
+        )
+        loop = asyncio.create_task(worker._run_loop_async())
+        try:
+            _, result_json = await redis_queue.queue.block_pop(f'{app_config.REDIS_RESULT_PREFIX}{payload.work_id}', timeout=30)
+            return SubmissionResult.model_validate_json(result_json)
+        finally:
+            loop.cancel()
+            await asyncio.gather(loop, return_exceptions=True)
+
+    try:
+        result = asyncio.run(run())
+    finally:
+        worker_manager._cgroup_slots = None
+    assert result.success, result
+    assert [r.success for r in result.test_results] == [True] * 7
+
+
+def test_cpp_fan_out(fake_redis, monkeypatch, tmp_path):
+    # the test cases are split over the idle workers of the node, and a lost part or a failure doesn't fail the worker
+    import app.config as app_config
+    import app.worker_manager as worker_manager
+    from app.model import ResultReason, Submission, TestCase, WorkPayload
+    from app.work_queue import connect_queue
+
+    monkeypatch.setattr(app_config, 'CPP_FANOUT_MIN_CASES', 2)
+    monkeypatch.setattr(app_config, 'CPP_COMPILE_WORKERS', 0)
+    monkeypatch.setattr(app_config, 'CPP_ARTIFACT_PATH', str(tmp_path / 'artifacts'))
+    monkeypatch.setattr(app_config, 'CPP_BINARY_CACHE_SIZE', 0)
+    monkeypatch.setattr(app_config, 'CPP_PCH_HEADERS', '')
+    monkeypatch.setattr(app_config, 'CPP_RUNTIME_PATH', '')
+    queue = connect_queue(False)
+    shared = {}
+    worker = worker_manager.Worker(shared, node_id='node-1')
+
+    def fan_out(cases, stop_on_failure=False, taken=(), lost=()):
+        # the parts (by their first test case) in `taken` are popped by other workers, which never push the results of the ones in `lost`
+        sub = Submission(
+            type='cpp', solution='#include <cstdio>\nint main(){int n;scanf("%d",&n);printf("%d",n);return 0;}',
+            test_cases=[TestCase(input=str(i), expected_output=str(expected)) for i, expected in cases],
+            stop_on_failure=stop_on_failure, timeout=5
+        )
+        payload = WorkPayload(submission=sub)
+        remove, block_pop = queue.pqueue.remove, queue.queue.block_pop
+        waited = []
+
+        def remove_part(queue_name, part_json):
+            if WorkPayload.model_validate_json(part_json).work_id in [f'{payload.work_id}:{i}' for i in taken]:
+                return 0
+            return remove(queue_name, part_json)
+
+        def wait_part(result_queue_name, timeout):
+            waited.append(result_queue_name.rsplit(':', 1)[-1])
+            return None if int(waited[-1]) in lost else block_pop(result_queue_name, timeout=timeout)
+
+        monkeypatch.setattr(queue.pqueue, 'remove', remove_part)
+        monkeypatch.setattr(queue.queue, 'block_pop', wait_part)
+        try:
+            return worker._fan_out(queue, payload), waited
+        finally:
+            monkeypatch.setattr(queue.pqueue, 'remove', remove)
+            monkeypatch.setattr(queue.queue, 'block_pop', block_pop)
+            queue.delete(worker_manager._node_queue_name('ready', 'node-1'))
+
+    # not split without another idle worker
+    assert fan_out([(i, i) for i in range(6)])[0] is None
+    # two other idle workers: 3 parts of 2 test cases
+    shared.update({'a:idle': True, 'b:idle': True, 'c:idle': False, 'a': 10})
+    result, waited = fan_out([(i, i) for i in range(6)])
+    assert result.success and len(result.test_results) == 6 and waited == []
+
+    # the test cases of a lost part time out, instead of failing the whole submission
+    result, waited = fan_out([(i, i) for i in range(6)], taken=[4], lost=[4])
+    assert waited == ['4']
+    assert not result.success and result.reason == ResultReason.WORKER_TIMEOUT
+    assert [r.success for r in result.test_results] == [True, True, True, True, False, False]
+    assert [r.reason for r in result.test_results[4:]] == [ResultReason.WORKER_TIMEOUT] * 2
+
+    # with stop_on_failure, a lost part stops the rest
+    result, waited = fan_out([(i, i) for i in range(6)], stop_on_failure=True, taken=[2, 4], lost=[2])
+    assert waited == ['2']
+    assert [r.success for r in result.test_results] == [True, True, False]
+
+    # and the parts taken by other workers after a failure are not waited for
+    result, waited = fan_out([(0, 0), (1, 5), (2, 2), (3, 3), (4, 4), (5, 5)], stop_on_failure=True, taken=[2, 4], lost=[2, 4])
+    assert waited == []
+    assert [r.success for r in result.test_results] == [True, False]
+    assert not list((tmp_path / 'artifacts' / 'node-1').iterdir())
+
+
+def test_lean_prefix_mutual(tmp_path):
+    # a mutual block is not split, and a script whose prefix fails is checked again as a whole
+    from app.libs.executors.lean_executor import LeanExecutor, _split_commands
+
+    mutual = ('mutual\n\n'
+              'def even : Nat → Bool\n  | 0 => true\n  | n+1 => odd n\n\n'
+              'def odd : Nat → Bool\n  | 0 => false\n  | n+1 => even n\n\n'
+              'end\n\n')
+    script = 'theorem a : True := trivial\n\n' + mutual + 'theorem b : True := trivial\n'
+    assert _split_commands(script) == ['theorem a : True := trivial\n\n', mutual, 'theorem b : True := trivial\n']
+    # a comment mentioning `mutual` doesn't start a block
+    commented = '/-\nmutual\n-/\ntheorem a : True := trivial\n\ntheorem b : True := trivial\n'
+    assert len(_split_commands(commented)) == 2
+
+    repl_cl, commands = _fake_lean_repl(tmp_path)
+    executor = LeanExecutor(run_cl='', timeout=10, repl_cl=repl_cl, env_cache_size=4)
+    assert executor.execute_script(script).stdout == 'pass'
+    assert len([c for c in commands() if 'env' in c]) == 3
+
+    # the split can't see every block, e.g. one opened by a macro: the failure is checked in one command
+    start = len(commands())
+    result = executor.execute_script('theorem a : 1 = 2 := wrong\n\ntheorem b : True := trivial\n')
+    assert result.stdout == 'fail' and 'type mismatch' in result.stderr
+    checked = [c['cmd'].strip() for c in commands()[start:] if 'env' in c]
+    assert checked == ['theorem a : 1 = 2 := wrong', 'theorem a : 1 = 2 := wrong\n\ntheorem b : True := trivial']